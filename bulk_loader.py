@@ -0,0 +1,162 @@
+import datetime
+import logging
+import os
+import tempfile
+from db_connection import DBConnection
+
+
+class BulkLoader(object):
+    """Collects rows for one table and writes them with a single set-based
+    merge instead of a statement (and usually an existence check) per row.
+    Meant for backfills; enable with [bulk_load] enabled in config.ini.
+
+    On MySQL the rows are staged to a temporary TSV file, loaded into a
+    temporary table with LOAD DATA LOCAL INFILE and merged with one
+    INSERT IGNORE ... SELECT (or REPLACE ... SELECT). LOCAL INFILE has to be
+    allowed on both ends: local_infile=ON on the server and
+    database_local_infile: true in vm_passwords.yml. Without it the staging
+    table is filled with multi-row inserts instead, and the merge is the
+    same. On SQLite the rows are inserted with executemany in one
+    transaction, which is already the fast path there.
+
+    Rows whose key already exists are left alone unless replace=True.
+    """
+
+    # target table -> columns, in the order rows are given
+    TARGETS = {
+        'dois': ('doi', 'issn', 'published_date', 'journal_title', 'downloaded', 'full_path', 'article_title'),
+        'crossref_journal_data': ('doi', 'title'),
+        'found_scan_lines': ('doi', 'line', 'score', 'matched_string'),
+        'matched_specimen_ids': ('doi', 'identifier'),
+    }
+
+    def __init__(self, table, replace=False, batch_rows=50000):
+        """
+        :param table: Target table, one of TARGETS
+        :type table: str
+        :param replace: Overwrite existing rows with the same key instead of keeping them, defaults to False
+        :type replace: bool, optional
+        :param batch_rows: Rows staged before add() flushes automatically, defaults to 50000
+        :type batch_rows: int, optional
+        :raises ValueError: If the table isn't a known bulk load target
+        """
+        if table not in BulkLoader.TARGETS:
+            raise ValueError(f"No bulk load target '{table}', expected one of {list(BulkLoader.TARGETS)}")
+        self.table = table
+        self.columns = BulkLoader.TARGETS[table]
+        self.replace = replace
+        self.batch_rows = batch_rows
+        self.rows = []
+        self.total_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, row):
+        """Stages one row, flushing once batch_rows are waiting.
+
+        :param row: Values in TARGETS column order
+        :type row: list or tuple
+        """
+        if len(row) != len(self.columns):
+            raise ValueError(f"{self.table} rows have {len(self.columns)} columns, got {len(row)}")
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        """Merges every staged row into the target table in one transaction.
+
+        :return: Number of rows merged
+        :rtype: int
+        """
+        rows = self.rows
+        if not rows:
+            return 0
+        self.rows = []
+        if DBConnection.get_backend().name == 'sqlite':
+            verb = "REPLACE" if self.replace else "INSERT IGNORE"
+            placeholders = ",".join(["%s"] * len(self.columns))
+            sql = f"{verb} INTO {self.table} ({','.join(self.columns)}) VALUES ({placeholders})"
+            DBConnection.run_in_transaction(DBConnection.execute_many, sql, rows, len(rows))
+        else:
+            self._merge_mysql(rows)
+        self.total_rows += len(rows)
+        logging.info(f"Bulk loaded {len(rows)} rows into {self.table}")
+        return len(rows)
+
+    def _merge_mysql(self, rows):
+        path = None
+        if DBConnection.get_backend().db_config.get('database_local_infile', False):
+            path = self._write_tsv(rows)
+        try:
+            DBConnection.run_in_transaction(self._load_and_merge, rows, path)
+        finally:
+            if path is not None:
+                os.remove(path)
+
+    def _load_and_merge(self, rows, path):
+        stage = f"bulk_stage_{self.table}"
+        column_list = ','.join(self.columns)
+        # temporary tables are per connection and don't commit the transaction;
+        # drop first in case an aborted load left one on this pooled connection
+        DBConnection.execute_query(f"DROP TEMPORARY TABLE IF EXISTS {stage}")
+        DBConnection.execute_query(self.create_stage_sql(stage))
+        try:
+            if path is not None:
+                sql = (f"LOAD DATA LOCAL INFILE %s INTO TABLE {stage} CHARACTER SET utf8mb4 "
+                       r"FIELDS TERMINATED BY '\t' ESCAPED BY '\\' LINES TERMINATED BY '\n' "
+                       f"({column_list})")
+                DBConnection.execute_query(sql, [path])
+            else:
+                placeholders = ",".join(["%s"] * len(self.columns))
+                sql = f"INSERT IGNORE INTO {stage} ({column_list}) VALUES ({placeholders})"
+                DBConnection.execute_many(sql, rows, batch_size=1000)
+            verb = "REPLACE" if self.replace else "INSERT IGNORE"
+            DBConnection.execute_query(f"{verb} INTO {self.table} ({column_list}) SELECT {column_list} FROM {stage}")
+        finally:
+            DBConnection.execute_query(f"DROP TEMPORARY TABLE IF EXISTS {stage}")
+
+    def create_stage_sql(self, stage):
+        """The staging table has the loaded columns and nothing else. Not
+        CREATE ... LIKE, which would copy the target's partitioning (MySQL
+        has no partitioned temporary tables) and its keys; the merge into the
+        target drops duplicates.
+
+        :param stage: Name of the temporary table
+        :type stage: str
+        :return: The CREATE TEMPORARY TABLE statement
+        :rtype: str
+        """
+        return f"CREATE TEMPORARY TABLE {stage} AS SELECT {','.join(self.columns)} FROM {self.table} LIMIT 0"
+
+    @staticmethod
+    def _tsv_field(value):
+        if value is None:
+            return r'\N'
+        if value is True or value is False:
+            return '1' if value else '0'
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        return (str(value).replace('\\', '\\\\')
+                .replace('\t', '\\t')
+                .replace('\n', '\\n')
+                .replace('\r', '\\r')
+                .replace('\0', '\\0'))
+
+    def _write_tsv(self, rows):
+        # mkstemp: readable only by us; LOCAL INFILE is limited to the temp directory
+        handle, path = tempfile.mkstemp(prefix=f"bulk_{self.table}_", suffix=".tsv")
+        with os.fdopen(handle, 'w', encoding='utf-8', newline='') as tsv:
+            for row in rows:
+                tsv.write('\t'.join(BulkLoader._tsv_field(value) for value in row))
+                tsv.write('\n')
+        return path
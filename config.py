@@ -4,6 +4,8 @@ import json
 import sys
 
 CONFIGFILE = "./config.ini"
+# marks a parameter that has to be in config.ini
+_REQUIRED = object()
 
 
 class Config():
@@ -17,14 +19,23 @@ class Config():
         else:
             self.config.read(CONFIGFILE)
 
-    def get_int(self, section, param):
-        return self.config.getint(section, param)
+    # pass fallback for settings that older config.ini files may not have;
+    # without it a missing setting raises as before
 
-    def get_string(self, section, param):
-        return self.config[section][param]
+    def get_int(self, section, param, fallback=_REQUIRED):
+        if fallback is _REQUIRED:
+            return self.config.getint(section, param)
+        return self.config.getint(section, param, fallback=fallback)
 
-    def get_boolean(self, section, param):
-        return self.config.getboolean(section, param)
+    def get_string(self, section, param, fallback=_REQUIRED):
+        if fallback is _REQUIRED:
+            return self.config[section][param]
+        return self.config.get(section, param, fallback=fallback)
+
+    def get_boolean(self, section, param, fallback=_REQUIRED):
+        if fallback is _REQUIRED:
+            return self.config.getboolean(section, param)
+        return self.config.getboolean(section, param, fallback=fallback)
 
     def get_list(self, section, param):
         results = self.get_string(section, param)
@@ -0,0 +1,184 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+
+class ConnectionPool(object):
+    """A bounded pool of database connections.
+
+    Connections are checked out for the duration of a statement (or a
+    transaction) and checked back in afterwards, so threads never share a
+    live connection and workers stop re-creating one per query.
+
+    The pool is fork-aware: if it is used from a process other than the one
+    that created its connections (e.g. a ProcessPoolExecutor worker), the
+    inherited connections are abandoned without being closed - closing them
+    would send a quit on the parent's socket - and the child builds its own.
+    """
+
+    def __init__(self, connect, max_size=8, max_idle_seconds=300,
+                 health_check_seconds=30, checkout_timeout=60, name="primary"):
+        """
+        :param connect: Zero-argument callable returning a new DB-API connection.
+        :type connect: callable
+        :param max_size: Maximum number of connections (idle + checked out), defaults to 8.
+        :type max_size: int, optional
+        :param max_idle_seconds: Idle connections older than this are closed rather than reused, defaults to 300.
+        :type max_idle_seconds: int, optional
+        :param health_check_seconds: Idle connections older than this are pinged before reuse, defaults to 30.
+        :type health_check_seconds: int, optional
+        :param checkout_timeout: Seconds to wait for a free connection before giving up, defaults to 60.
+        :type checkout_timeout: int, optional
+        :param name: Label used in logging and stats, defaults to "primary".
+        :type name: str, optional
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.health_check_seconds = health_check_seconds
+        self.checkout_timeout = checkout_timeout
+        self.name = name
+
+        self._condition = threading.Condition()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        # (connection, time of last checkin)
+        self._idle = deque()
+        self._in_use = 0
+        self.stats = {'created': 0,
+                      'checkouts': 0,
+                      'checkins': 0,
+                      'waits': 0,
+                      'recycled': 0,
+                      'failed_health_checks': 0,
+                      'discarded': 0,
+                      'fork_resets': 0}
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            fork_resets = self.stats['fork_resets'] + 1
+            # A fresh condition too; the parent's lock may have been held
+            # by another thread at the moment of the fork.
+            self._condition = threading.Condition()
+            self._reset_state()
+            self.stats['fork_resets'] = fork_resets
+            logging.debug(f"Connection pool '{self.name}' reset after fork (pid {self._pid})")
+
+    @staticmethod
+    def _is_healthy(connection):
+        try:
+            if hasattr(connection, 'is_connected'):
+                return connection.is_connected()
+            connection.execute("select 1")
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        """Take a connection from the pool, creating one if the pool isn't full.
+        Blocks up to checkout_timeout seconds when all connections are in use.
+
+        :raises PoolExhaustedException: If no connection frees up in time.
+        :return: A live connection; return it with checkin().
+        :rtype: connection
+        """
+        self._check_fork()
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._condition:
+            while True:
+                while self._idle:
+                    connection, last_used = self._idle.pop()
+                    idle_time = time.monotonic() - last_used
+                    if idle_time > self.max_idle_seconds:
+                        self.stats['recycled'] += 1
+                        self._close(connection)
+                        continue
+                    if idle_time > self.health_check_seconds and not self._is_healthy(connection):
+                        self.stats['failed_health_checks'] += 1
+                        self._close(connection)
+                        continue
+                    self._in_use += 1
+                    self.stats['checkouts'] += 1
+                    return connection
+                if self._in_use < self.max_size:
+                    # reserve the slot; connect outside the lock
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhaustedException(
+                        f"No free connection in pool '{self.name}' after {self.checkout_timeout} seconds")
+                self.stats['waits'] += 1
+                self._condition.wait(remaining)
+
+        try:
+            connection = self.connect()
+        except Exception:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self.stats['created'] += 1
+            self.stats['checkouts'] += 1
+        return connection
+
+    def checkin(self, connection, discard=False):
+        """Return a connection to the pool.
+
+        :param connection: A connection obtained from checkout().
+        :type connection: connection
+        :param discard: Close the connection instead of keeping it, e.g. after a
+            connection-level error, defaults to False.
+        :type discard: bool, optional
+        """
+        if self._pid != os.getpid():
+            # checked out before a fork; belongs to the parent
+            return
+        with self._condition:
+            self._in_use = max(0, self._in_use - 1)
+            self.stats['checkins'] += 1
+            if discard:
+                self.stats['discarded'] += 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+        if discard:
+            self._close(connection)
+
+    def close_idle(self):
+        """Close every idle connection. Checked out connections are unaffected."""
+        self._check_fork()
+        with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+        for connection, last_used in idle:
+            self._close(connection)
+
+    def get_stats(self):
+        """
+        :return: Counters plus current idle and in-use sizes.
+        :rtype: dict
+        """
+        self._check_fork()
+        with self._condition:
+            stats = dict(self.stats)
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._in_use
+            stats['max_size'] = self.max_size
+        return stats
+
+
+class PoolExhaustedException(Exception):
+    pass
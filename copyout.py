@@ -96,8 +96,8 @@ class CopyOut(Utils):
         :rtype: str
         """
         # Query to get the issn and published year based on the DOI
-        sql = f"SELECT issn, YEAR(published_date) FROM collections_papers.dois WHERE doi='{doi}'"
-        results = DBConnection.execute_query(sql)
+        sql = "SELECT issn, YEAR(published_date) FROM collections_papers.dois WHERE doi = %s"
+        results = DBConnection.execute_query(sql, (doi,))
 
         if len(results) > 0:
             issn, year = results[0]
@@ -169,8 +169,8 @@ class CopyOut(Utils):
         write_string = f"{doi}\t{collection}\t{journal_title}\t{title}\t{published_date}\t{date_added}\t{notes}\t{digital_only}"
         write_string = write_string.replace('None', '-')
         filehandle.write(write_string)
-        sql = f"select identifier from matched_collection_ids where matched_collection_ids.doi='{doi}'"
-        results = DBConnection.execute_query(sql)
+        sql = "select identifier from matched_collection_ids where matched_collection_ids.doi = %s"
+        results = DBConnection.execute_query(sql, (doi,))
 
         if len(results) > 0:
             filehandle.write("\t")
@@ -214,8 +214,8 @@ class CopyOut(Utils):
         fh.write("doi\tcollection\tjournal_title\ttitle\tpublished_date\tdate_added\tnotes\tdigital_only\n")
 
         for cur_match in self.get_matches():
-            sql = f"select line from found_scan_lines where doi = '{cur_match[0]}'"
-            scan_db_results = DBConnection.execute_query(sql)
+            sql = "select line from found_scan_lines where doi = %s"
+            scan_db_results = DBConnection.execute_query(sql, (cur_match[0],))
             found_special_note = False
             for line_array in scan_db_results:
                 line = line_array[0]
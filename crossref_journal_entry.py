@@ -3,12 +3,20 @@ import json
 
 
 class CrossrefJournalEntry():
-    def __init__(self, json_details):
+    def __init__(self, json_details, insert=True):
         self.doi = json_details['DOI']
         self.title = json_details['title'][0]
-        if not self._check_exists():
+        if insert and not self._check_exists():
             self._insert_database()
 
+    def bulk_row(self):
+        """
+        :return: The row for BulkLoader('crossref_journal_data')
+        :rtype: list
+        """
+        return [self.doi,
+                self.title]
+
     def _insert_database(self):
         sql_insert = f"""INSERT INTO crossref_journal_data (doi,
                                             title)
@@ -19,9 +27,22 @@ class CrossrefJournalEntry():
                 self.title]
         DBConnection.execute_query(sql_insert, args)
 
+    @staticmethod
+    def insert_many(entries):
+        """Insert entries created with insert=False in multi-row statements;
+        ones already in crossref_journal_data are skipped.
+
+        :param entries: The entries
+        :type entries: list[CrossrefJournalEntry]
+        """
+        rows = [entry.bulk_row() for entry in entries]
+        if rows:
+            sql_insert = "INSERT IGNORE INTO crossref_journal_data (doi, title) VALUES (%s,%s)"
+            DBConnection.execute_many(sql_insert, rows)
+
     def _check_exists(self):
-        query = f"select doi from crossref_journal_data where doi=\"{self.doi}\""
-        results = DBConnection.execute_query(query)
+        query = "select doi from crossref_journal_data where doi = %s"
+        results = DBConnection.execute_query(query, [self.doi])
         if len(results) >= 1:
             return True
         return False
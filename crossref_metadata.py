@@ -0,0 +1,130 @@
+import json
+import zlib
+from db_connection import DBConnection
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CrossrefMetadata(object):
+    """The crossref JSON for each DOI, kept compressed in the
+    crossref_metadata side table so that direct links, dates and titles can
+    be re-derived without asking crossref again. The rows are written during
+    ingest from the pages already fetched.
+
+    New rows are compressed with zstd when the zstandard package is
+    installed and with zlib otherwise; the codec is stored per row, so
+    either can always be read back (zstd rows need zstandard).
+    """
+
+    CODEC = 'zstd' if zstandard is not None else 'zlib'
+    ZLIB_LEVEL = 6
+    ZSTD_LEVEL = 9
+
+    @staticmethod
+    def create_tables():
+        sql_create_database_table = """ CREATE TABLE IF NOT EXISTS crossref_metadata (
+                                            doi       varchar(255)  not null  primary key,
+                                            codec     varchar(8)    not null,
+                                            metadata  mediumblob    not null
+                                        ); """
+        DBConnection.execute_query(sql_create_database_table)
+
+    @staticmethod
+    def compress(details):
+        """
+        :param details: A crossref work item
+        :type details: dict
+        :return: (codec, compressed JSON)
+        :rtype: tuple
+        """
+        data = json.dumps(details, separators=(',', ':')).encode('utf-8')
+        if CrossrefMetadata.CODEC == 'zstd':
+            return 'zstd', zstandard.ZstdCompressor(level=CrossrefMetadata.ZSTD_LEVEL).compress(data)
+        return 'zlib', zlib.compress(data, CrossrefMetadata.ZLIB_LEVEL)
+
+    @staticmethod
+    def decompress(codec, metadata):
+        """
+        :param codec: 'zstd' or 'zlib', as stored with the row
+        :type codec: str
+        :param metadata: Compressed JSON
+        :type metadata: bytes
+        :return: The crossref work item
+        :rtype: dict
+        :raises CrossrefMetadataException: For a codec that can't be read here
+        """
+        if codec == 'zlib':
+            data = zlib.decompress(metadata)
+        elif codec == 'zstd':
+            if zstandard is None:
+                raise CrossrefMetadataException("zstd compressed metadata needs the zstandard package")
+            data = zstandard.ZstdDecompressor().decompress(metadata)
+        else:
+            raise CrossrefMetadataException(f"Unknown metadata codec '{codec}'")
+        return json.loads(data)
+
+    @staticmethod
+    def get(doi):
+        """
+        :param doi: The DOI
+        :type doi: str
+        :return: The stored crossref item, or None if there isn't one
+        :rtype: dict or None
+        """
+        # from the primary: a lagging replica would report metadata that was just written as missing
+        results = DBConnection.execute_query("select codec, metadata from crossref_metadata where doi = %s", [doi])
+        if len(results) == 0:
+            return None
+        return CrossrefMetadata.decompress(results[0][0], bytes(results[0][1]))
+
+    @staticmethod
+    def insert_many(items, replace=False):
+        """Stores crossref items in multi-row statements.
+
+        :param items: Crossref work items, each with a 'DOI'
+        :type items: list[dict]
+        :param replace: Overwrite stored metadata for the same DOI instead of
+            keeping it, defaults to False
+        :type replace: bool, optional
+        """
+        rows = [[item['DOI'], *CrossrefMetadata.compress(item)] for item in items]
+        if not rows:
+            return
+        # INSERT rather than REPLACE, which execute_many can't send as one multi-row statement
+        if replace:
+            sql = """INSERT INTO crossref_metadata (doi, codec, metadata) VALUES (%s,%s,%s)
+                     ON DUPLICATE KEY UPDATE codec=VALUES(codec), metadata=VALUES(metadata)"""
+        else:
+            sql = "INSERT IGNORE INTO crossref_metadata (doi, codec, metadata) VALUES (%s,%s,%s)"
+        DBConnection.execute_many(sql, rows)
+
+    @staticmethod
+    def iterate(dois=None, fetch_size=1000):
+        """Reads stored metadata back, for offline re-derivation.
+
+        :param dois: Only these DOIs, defaults to None (all of them)
+        :type dois: list[str], optional
+        :param fetch_size: Rows per round trip, defaults to 1000
+        :type fetch_size: int, optional
+        :return: (doi, crossref item) pairs
+        :rtype: iterator
+        """
+        if dois is None:
+            rows = DBConnection.iter_query("select doi, codec, metadata from crossref_metadata",
+                                           fetch_size=fetch_size, read_only=True)
+            for doi, codec, metadata in rows:
+                yield doi, CrossrefMetadata.decompress(codec, bytes(metadata))
+            return
+        dois = list(dois)
+        for start in range(0, len(dois), fetch_size):
+            batch = dois[start:start + fetch_size]
+            query = f"select doi, codec, metadata from crossref_metadata where doi in ({','.join(['%s'] * len(batch))})"
+            for doi, codec, metadata in DBConnection.execute_query(query, batch, read_only=True, prepare=False):
+                yield doi, CrossrefMetadata.decompress(codec, bytes(metadata))
+
+
+class CrossrefMetadataException(Exception):
+    pass
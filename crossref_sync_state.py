@@ -0,0 +1,53 @@
+import datetime
+from db_connection import DBConnection
+
+
+class CrossrefSyncState(object):
+    """Per-ISSN high-water mark for delta sync: the published years that have
+    been harvested from crossref, and when the last complete sync of them
+    started. The next sync only asks crossref for works updated since then.
+    """
+
+    @staticmethod
+    def create_tables():
+        sql_create_database_table = """ CREATE TABLE IF NOT EXISTS crossref_sync_state (
+                                            issn            varchar(100)  not null  primary key,
+                                            first_year      integer       not null,
+                                            last_year       integer       not null,
+                                            synced_through  datetime      not null
+                                        ); """
+        DBConnection.execute_query(sql_create_database_table)
+
+    @staticmethod
+    def get(issn):
+        """
+        :param issn: Journal ISSN
+        :type issn: str
+        :return: (first_year, last_year, synced_through), or None if the journal
+            hasn't been synced yet
+        :rtype: tuple or None
+        """
+        sql = "select first_year, last_year, synced_through from crossref_sync_state where issn = %s"
+        results = DBConnection.execute_query(sql, [issn])
+        if len(results) == 0:
+            return None
+        first_year, last_year, synced_through = results[0]
+        if isinstance(synced_through, str):
+            synced_through = datetime.datetime.fromisoformat(synced_through)
+        return int(first_year), int(last_year), synced_through
+
+    @staticmethod
+    def record(issn, first_year, last_year, synced_through):
+        """
+        :param issn: Journal ISSN
+        :type issn: str
+        :param first_year: First published year now covered
+        :type first_year: int
+        :param last_year: Last published year now covered
+        :type last_year: int
+        :param synced_through: When the sync that covered them started
+        :type synced_through: datetime.datetime
+        """
+        sql = """REPLACE INTO crossref_sync_state (issn, first_year, last_year, synced_through)
+                 VALUES (%s,%s,%s,%s)"""
+        DBConnection.execute_query(sql, [issn, first_year, last_year, synced_through])
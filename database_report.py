@@ -1,17 +1,24 @@
-from doi_entry import DoiFactory
 from db_connection import DBConnection
+from doi_catalog import DoiCatalog
 from tabulate import tabulate
 
 
 class DatabaseReport:
     categories = ['downloaded', 'missing', 'total']
 
-    def __init__(self, doi_database, start_year=None, end_year=None, issn=None):
+    def __init__(self, doi_database, start_year=None, end_year=None, issn=None, catalog=None):
+        """
+        :param catalog: DOIs to report on, e.g. from DoiCatalog.cached(); defaults to
+            None, which loads the year range from the database
+        :type catalog: DoiCatalog, optional
+        """
         self.doi_database = doi_database
         self.good_download_count = 0
         self.start_year = start_year
         self.end_year = end_year
-        self.dois = None
+        self.total_dois = 0
+        self.journal_tallies = None
+        self.catalog = catalog
         self._load_dois(issn=issn)
 
 
@@ -35,6 +42,9 @@ class DatabaseReport:
         return retval
 
     def _sql_journal_suffix(self, issn, and_var=True):
+        """ Constructs a SQL suffix filtering on one journal. The ISSN itself
+        is passed separately; see _journal_args.
+        """
         retval = ""
         if issn is not None:
             if and_var:
@@ -42,39 +52,45 @@ class DatabaseReport:
             else:
                 retval += " where"
 
-            retval += f""" issn='{issn}'"""
+            retval += " issn = %s"
         return retval
 
-    def _load_dois(self, issn=None):
-        """ Load DOIs from a database, and potentially filter
-        by a specific journal title if desired
+    def _journal_args(self, issn):
+        """
+        :return: Arguments matching _sql_journal_suffix(issn)
+        :rtype: list or None
+        """
+        if issn is None:
+            return None
+        return [issn]
 
-        :param journal: The journal title to filter the DOIs by, defaults to None
-        :type journal: str, optional
-        """        
-        select_dois = f"""select * from dois"""
-        select_dois += self._sql_date_suffix(False)
-        if issn is not None:
-            select_dois += f' and issn="{issn}"'
+    def _load_dois(self, issn=None):
+        """ Tally DOIs per journal, and potentially filter by a specific
+        journal if desired. The tallies are vectorized group-bys over the
+        columnar catalog, not a loop over rows.
 
-        doif = DoiFactory(select_dois)
-        self.dois = doif.dois
+        :param issn: The journal ISSN to filter the DOIs by, defaults to None
+        :type issn: str, optional
+        """
+        if self.catalog is None:
+            self.catalog = DoiCatalog.load(self.start_year, self.end_year)
+        self.selected = self.catalog.mask(self.start_year, self.end_year)
+        journal_selected = self.selected & self.catalog.mask(issn=issn) if issn is not None else self.selected
+        self.total_dois = self.catalog.count(journal_selected)
+        self.journal_tallies = self.catalog.journal_tallies(journal_selected)
 
     def _get_journals(self):
-        """Get a list of distinct journal titles from the database.
+        """Get a list of distinct journal ISSNs in the year range.
 
-        :return: A list of unique journal titles present in the database.
+        :return: A list of unique journal ISSNs.
         :rtype: List[str]
-        """        
-        sql = f"""select distinct issn from dois"""
-        sql += self._sql_date_suffix(False)
-
-        return DBConnection.execute_query(sql)
+        """
+        return self.catalog.journals(self.selected)
 
     def _get_journal_title(self,issn):
-        sql = f"""select name from journals where issn ='{issn}'"""
+        sql = """select name from journals where issn = %s"""
 
-        value = DBConnection.execute_query(sql)
+        value = DBConnection.execute_query(sql, [issn], read_only=True, cache=True)
         return value
 
     def _get_downloaded(self, issn=None):
@@ -89,7 +105,7 @@ class DatabaseReport:
         sql += self._sql_date_suffix()
         sql += self._sql_journal_suffix(issn)
 
-        return DBConnection.execute_query(sql)[0][0]
+        return DBConnection.execute_query(sql, self._journal_args(issn), read_only=True)[0][0]
 
     # def _get_pending_downloads(self, journal=None):
     #     sql = f"""select count(*) from dois where downloaded=FALSE and long_retry=0 and not_found_count=0"""
@@ -110,7 +126,7 @@ class DatabaseReport:
         sql += self._sql_date_suffix()
         sql += self._sql_journal_suffix(issn)
 
-        return DBConnection.execute_query(sql)[0][0]
+        return DBConnection.execute_query(sql, self._journal_args(issn), read_only=True)[0][0]
 
     # def _get_unresolved_downloads(self, journal=None):
     #     sql = f"""select count(*) from dois where downloaded=FALSE and not_found_count=0 and long_retry > 0"""
@@ -131,9 +147,8 @@ class DatabaseReport:
 
         sql += self._sql_date_suffix()
         sql += self._sql_journal_suffix(issn)
-        sql = sql.replace("'s", "''s")  # hack. this should be by issn
 
-        return int(DBConnection.execute_query(sql)[0][0])
+        return int(DBConnection.execute_query(sql, self._journal_args(issn), read_only=True)[0][0])
 
     def _get_unpaywall_has_err_code(self, issn=None):
         sql = f"""select count(*) from dois,unpaywall_downloader where dois.doi = unpaywall_downloader.doi 
@@ -141,8 +156,7 @@ class DatabaseReport:
 
         sql += self._sql_date_suffix()
         sql += self._sql_journal_suffix(issn)
-        sql = sql.replace("'s", "''s")
-        return int(DBConnection.execute_query(sql)[0][0])
+        return int(DBConnection.execute_query(sql, self._journal_args(issn), read_only=True)[0][0])
 
     def _get_unpaywall_failed_download(self, issn=None):
         sql = f"""select count(*) from dois,unpaywall_downloader where dois.doi = unpaywall_downloader.doi 
@@ -150,8 +164,7 @@ class DatabaseReport:
 
         sql += self._sql_date_suffix()
         sql += self._sql_journal_suffix(issn)
-        sql = sql.replace("'s", "''s")
-        return int(DBConnection.execute_query(sql)[0][0])
+        return int(DBConnection.execute_query(sql, self._journal_args(issn), read_only=True)[0][0])
 
     def report(self, issn=None, summary=True):
         """Generate a report on the database statistics. Note this takes a while
@@ -168,38 +181,33 @@ class DatabaseReport:
         """        
         str = ""
         if summary:
-            str += f"Total DOI entries: {len(self.dois)}"
+            str += f"Total DOI entries: {self.total_dois}"
             if self.start_year is not None:
                 str += f" years: {self.start_year} -> {self.end_year}\n"
             else:
                 str += "\n"
 
-            str += f"Successful downloads: {self._get_downloaded()}\n"
-            str += f"Not downloaded: {self._get_not_downloaded()}\n"
+            downloaded = self.catalog.count(self.selected & self.catalog.downloaded)
+            str += f"Successful downloads: {downloaded}\n"
+            str += f"Not downloaded: {self.catalog.count(self.selected) - downloaded}\n"
         if issn is None:
             issns = self._get_journals()
         else:
-            issns = [[issn]]
+            issns = [issn]
         journal_stats = {}
-        for cur_issn in issns:
-            issn = cur_issn[0]
+        for issn in issns:
             dict = {'journal': issn}
             for category in DatabaseReport.categories:
                 dict[category] = 0
             journal_stats[issn] = dict
 
-        for doi in self.dois:
-            issn = doi.issn
+        # the year range was already applied when the tallies were loaded
+        for issn, tally in self.journal_tallies.items():
             try:
                 stats = journal_stats[issn]
-
-                if not self.start_year <= doi.date.year <= self.end_year:
-                    continue
-                stats['total'] += 1
-                if doi.downloaded:
-                    stats['downloaded'] += 1
-                else:
-                    stats['missing'] += 1
+                stats['downloaded'] += tally['downloaded']
+                stats['missing'] += tally['missing']
+                stats['total'] += tally['downloaded'] + tally['missing']
             except KeyError as e:
                 # usually a doi with a missing journal
                 pass
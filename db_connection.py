@@ -1,33 +1,255 @@
 import logging
 import mysql.connector
+import sqlite3
+import datetime
+import re
 import yaml
 import traceback
 import time
-from pymysql.converters import escape_string
+import tempfile
+import threading
+import weakref
+from contextlib import contextmanager
+from functools import lru_cache
+from connection_pool import ConnectionPool
+from retry_policy import RetryPolicy
+from sql_profiler import SqlProfiler
+from query_cache import QueryCache
+from statement_cache import StatementCache
+
+
+class MySQLBackend(object):
+    """The shared deployment: a MySQL server reached over the network."""
+    name = 'mysql'
+
+    # statements worth preparing: parameterized DML and SELECTs
+    PREPARABLE = re.compile(r'^\s*(select|insert|update|delete|replace)\b', re.IGNORECASE)
+
+    def __init__(self, db_config):
+        self.db_config = db_config
+        self.prepared_statements = db_config.get('database_prepared_statements', True)
+        self.statement_cache_size = db_config.get('database_statement_cache_size', 64)
+        # above this many placeholders a statement is almost always a batch
+        # (IN lists, multi-row CASE), whose text changes with the batch size
+        self.prepared_max_params = db_config.get('database_prepared_statement_max_params', 32)
+        # connection -> StatementCache; entries go when the connection does
+        self._statement_caches = weakref.WeakKeyDictionary()
+        self._statement_caches_lock = threading.Lock()
+
+    def _setting(self, key, replica):
+        # replica_* keys fall back to the primary's value
+        if replica:
+            return self.db_config.get('replica_' + key, self.db_config[key])
+        return self.db_config[key]
+
+    def has_replica(self):
+        return bool(self.db_config.get('replica_database_url'))
+
+    def connect(self, replica=False):
+        options = {}
+        if self.db_config.get('database_local_infile', False) and not replica:
+            # BulkLoader stages its LOAD DATA files here; nothing else is readable
+            options['allow_local_infile_in_path'] = tempfile.gettempdir()
+        connection = mysql.connector.connect(
+            host=self._setting('database_url', replica),
+            user=self._setting('database_user', replica),  # Replace with your username
+            password=self._setting('database_password', replica),
+
+            database=self.db_config['database_name'],  # Replace with your database name
+            port=self._setting('database_port', replica),
+            # every statement stands alone; pooled connections must not carry
+            # an open read snapshot from one checkout to the next
+            autocommit=True,
+            **options
+        )
+        if replica:
+            # a write routed here by mistake fails loudly instead of diverging
+            cursor = connection.cursor()
+            cursor.execute("SET SESSION TRANSACTION READ ONLY")
+            cursor.close()
+        if self.prepared_statements:
+            with self._statement_caches_lock:
+                self._statement_caches[connection] = StatementCache(self.statement_cache_size)
+        return connection
+
+    def translate(self, query):
+        return query
+
+    def begin(self, connection):
+        connection.start_transaction()
+
+    def cursor(self, connection, streaming=False):
+        if streaming:
+            return connection.cursor(buffered=False)
+        return connection.cursor()
+
+    def statement_cache(self, connection, query, args):
+        """
+        :return: The connection's StatementCache if this statement should run
+            as a server-side prepared statement, otherwise None
+        :rtype: StatementCache or None
+        """
+        if args is None or not MySQLBackend.PREPARABLE.match(query):
+            return None
+        if len(args) > self.prepared_max_params:
+            return None
+        return self._statement_caches.get(connection)
+
+    def statement_cache_stats(self):
+        with self._statement_caches_lock:
+            caches = list(self._statement_caches.values())
+        totals = {'connections': len(caches), 'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0}
+        for cache in caches:
+            stats = cache.get_stats()
+            for key in ('hits', 'misses', 'evictions', 'size'):
+                totals[key] += stats[key]
+        return totals
+
+    def is_deadlock(self, e):
+        # 1213 deadlock, 1205 lock wait timeout: both resolved by backing off
+        return isinstance(e, mysql.connector.errors.Error) and e.errno in (1213, 1205)
+
+    def is_connection_error(self, e):
+        return isinstance(e, (mysql.connector.errors.OperationalError,
+                              mysql.connector.errors.InterfaceError))
+
+
+class SQLiteBackend(object):
+    """Embedded single-node database: no server and no network round trip.
+    Runs in WAL mode so readers don't block the writer, and translates the
+    MySQL dialect the rest of the code is written in.
+    """
+    name = 'sqlite'
+
+    PRAGMAS = ["PRAGMA journal_mode=WAL",
+               "PRAGMA synchronous=NORMAL",
+               "PRAGMA temp_store=MEMORY",
+               "PRAGMA cache_size=-65536",  # KiB, i.e. 64MB
+               "PRAGMA mmap_size=268435456",
+               "PRAGMA busy_timeout=30000"]
+
+    def __init__(self, db_config):
+        self.db_config = db_config
+        self.path = db_config.get('sqlite_path', 'doi_database.db')
+        self.statement_cache_size = db_config.get('database_statement_cache_size', 64)
+        schema_names = {'collections_papers', db_config.get('database_name') or 'collections_papers'}
+        self.schema_prefix = re.compile(r'\b(' + '|'.join(schema_names) + r')\.')
+        sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+        sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+        sqlite3.register_converter("date", SQLiteBackend._convert_date)
+        sqlite3.register_converter("datetime", SQLiteBackend._convert_datetime)
+
+    @staticmethod
+    def _convert_date(value):
+        return datetime.date.fromisoformat(value.decode()[:10])
+
+    @staticmethod
+    def _convert_datetime(value):
+        return datetime.datetime.fromisoformat(value.decode())
+
+    @staticmethod
+    def _year(value):
+        if value is None:
+            return None
+        return int(str(value)[:4])
+
+    def has_replica(self):
+        # one file, one node
+        return False
+
+    def connect(self, replica=False):
+        # isolation_level=None: autocommit, transactions are begun explicitly
+        connection = sqlite3.connect(self.path,
+                                     timeout=30.0,
+                                     isolation_level=None,
+                                     check_same_thread=False,
+                                     detect_types=sqlite3.PARSE_DECLTYPES,
+                                     # sqlite3 keeps its own per-connection LRU of
+                                     # compiled statements, keyed by the SQL text
+                                     cached_statements=self.statement_cache_size)
+        for pragma in SQLiteBackend.PRAGMAS:
+            connection.execute(pragma)
+        connection.create_function("YEAR", 1, SQLiteBackend._year, deterministic=True)
+        return connection
+
+    # quoted strings and identifiers, kept as they are by translate()
+    _quoted = re.compile(r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`[^`]*`)""")
+    _insert_ignore = re.compile(r'(?i)\binsert\s+ignore\b')
+    _upsert = re.compile(r'(?i)\bon\s+duplicate\s+key\s+update\b')
+    _inserted_value = re.compile(r'(?i)\bvalues\s*\(\s*(\w+)\s*\)')
+
+    @lru_cache(maxsize=1024)
+    def translate(self, query):
+        """Rewrites a MySQL-dialect statement for SQLite: %s placeholders,
+        INSERT IGNORE, ON DUPLICATE KEY UPDATE col = VALUES(col) and the
+        collections_papers. schema prefix. REPLACE INTO and YEAR() (registered
+        as a function on connect) work as-is. Quoted strings and identifiers
+        are left alone, so e.g. a '%s' in a LIKE pattern stays a literal.
+        """
+        # split() with a group: text outside quotes at even indices, quoted at odd
+        parts = SQLiteBackend._quoted.split(query)
+        upsert = False
+        for index in range(0, len(parts), 2):
+            text = self.schema_prefix.sub('', parts[index])
+            text = SQLiteBackend._insert_ignore.sub('INSERT OR IGNORE', text)
+            if upsert:
+                text = SQLiteBackend._inserted_value.sub(r'excluded.\1', text)
+            else:
+                match = SQLiteBackend._upsert.search(text)
+                if match is not None:
+                    upsert = True
+                    text = (text[:match.start()] + 'ON CONFLICT DO UPDATE SET' +
+                            SQLiteBackend._inserted_value.sub(r'excluded.\1', text[match.end():]))
+            parts[index] = text.replace('%s', '?')
+        return ''.join(parts)
+
+    def begin(self, connection):
+        # take the write lock up front; upgrading a read lock mid-transaction
+        # is how SQLite deadlocks
+        connection.execute("BEGIN IMMEDIATE")
+
+    def cursor(self, connection, streaming=False):
+        # sqlite cursors step through results lazily already
+        return connection.cursor()
+
+    def statement_cache(self, connection, query, args):
+        # compiled statements are cached by sqlite3 itself (cached_statements)
+        return None
+
+    def statement_cache_stats(self):
+        return {'connections': 0, 'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0}
+
+    def is_deadlock(self, e):
+        return isinstance(e, sqlite3.OperationalError) and 'locked' in str(e)
+
+    def is_connection_error(self, e):
+        return isinstance(e, sqlite3.ProgrammingError) and 'closed' in str(e)
+
+
+BACKENDS = {MySQLBackend.name: MySQLBackend,
+            SQLiteBackend.name: SQLiteBackend}
+
 
 class DBConnector(object):
 
     def __init__(self):
         self.dbconn = None
         self.db_config = self.read_db_config()
+        backend_name = self.db_config.get('database_backend', MySQLBackend.name)
+        if backend_name not in BACKENDS:
+            raise ValueError(f"Unknown database_backend '{backend_name}', expected one of {list(BACKENDS)}")
+        self.backend = BACKENDS[backend_name](self.db_config)
 
     def read_db_config(self):
         with open('./vm/vm_passwords.yml', 'r') as file:
             config = yaml.safe_load(file)
         return config
 
-    # def create_connection(self):
-    #     return sqlite3.connect('doi_database.db', timeout=30.0)
-
     def create_connection(self):
-        return mysql.connector.connect(
-            host=self.db_config['database_url'],
-            user=self.db_config['database_user'],  # Replace with your username
-            password=self.db_config['database_password'],
+        return self.backend.connect()
 
-            database=self.db_config['database_name'],  # Replace with your database name
-            port=self.db_config['database_port']
-        )
+    def create_replica_connection(self):
+        return self.backend.connect(replica=True)
 
 
     # For explicitly opening database connection
@@ -40,78 +262,492 @@ class DBConnector(object):
 
 
 class DBConnection(object):
-    connection = None
-
-    @classmethod
-    def get_connection(cls, new=False):
-        """Creates return new Singleton database connection"""
-        if new or not cls.connection:
-            cls.connection = DBConnector().create_connection()
-        return cls.connection
-
-    @classmethod
-    def log_sql(cls, query, stack_trace):
-        # for debugging, enable if there are issues.
-        # works with ./vm/sql_log_scan.sh
-        return
-        formatted_stack_trace = ''.join(stack_trace)
-        log_string = (
-            f"SQL Query: {query}\n"
-            "Stack Trace:\n"
-            f"{formatted_stack_trace}\n"
-            f"{'-' * 40}\n"
-        )
-        with open('./sql.log', 'a') as log_file:
-            log_file.write(log_string)
+    pool = None
+    # read-only SELECTs go here when replica_database_url is configured
+    replica_pool = None
+    backend = None
+    retry_policy = None
+    # SqlProfiler, when sql_profiler_enabled is set in vm_passwords.yml
+    profiler = None
+    # QueryCache for execute_query(..., cache=True); None unless query_cache_enabled is set
+    query_cache = None
+    _pool_lock = threading.Lock()
+    # per-thread connection bound by transaction()
+    _local = threading.local()
+    # after a replica failure, reads go to the primary until this time.monotonic()
+    _replica_down_until = 0.0
+    replica_retry_seconds = 30
+
+    @classmethod
+    def get_pool(cls):
+        """Returns the process-wide connection pool, creating it on first use.
+        Pool sizing comes from the optional database_pool_* keys in vm_passwords.yml.
+        A second, replica pool is created alongside it if replica_database_url is set.
+
+        :return: The connection pool
+        :rtype: ConnectionPool
+        """
+        if cls.pool is None:
+            with cls._pool_lock:
+                if cls.pool is None:
+                    connector = DBConnector()
+                    db_config = connector.db_config
+                    cls.backend = connector.backend
+                    cls.retry_policy = RetryPolicy(
+                        max_attempts=db_config.get('database_retry_max_attempts', 5),
+                        base_delay_ms=db_config.get('database_retry_base_delay_ms', 10),
+                        max_delay_ms=db_config.get('database_retry_max_delay_ms', 5000),
+                        budget_ratio=db_config.get('database_retry_budget_ratio', 0.1),
+                        budget_max=db_config.get('database_retry_budget_max', 20))
+                    if db_config.get('query_cache_enabled', False):
+                        cls.query_cache = QueryCache(max_entries=db_config.get('query_cache_max_entries', 10000),
+                                                     default_ttl_seconds=db_config.get('query_cache_ttl_seconds', 60),
+                                                     table_ttls=db_config.get('query_cache_table_ttls'))
+                    if db_config.get('sql_profiler_enabled', False):
+                        cls.profiler = SqlProfiler(log_path=db_config.get('sql_profiler_log', './sql.log'),
+                                                   sample_rate=db_config.get('sql_profiler_sample_rate', 0.0),
+                                                   slow_query_ms=db_config.get('sql_profiler_slow_query_ms', 1000))
+                    cls.pool = ConnectionPool(connector.create_connection,
+                                              max_size=db_config.get('database_pool_size', 8),
+                                              max_idle_seconds=db_config.get('database_pool_max_idle_seconds', 300),
+                                              health_check_seconds=db_config.get('database_pool_health_check_seconds', 30),
+                                              checkout_timeout=db_config.get('database_pool_timeout', 60))
+                    if cls.backend.has_replica():
+                        cls.replica_retry_seconds = db_config.get('replica_database_retry_seconds', 30)
+                        cls.replica_pool = ConnectionPool(connector.create_replica_connection,
+                                                          max_size=db_config.get('replica_database_pool_size',
+                                                                                 db_config.get('database_pool_size', 8)),
+                                                          max_idle_seconds=db_config.get('database_pool_max_idle_seconds', 300),
+                                                          health_check_seconds=db_config.get('database_pool_health_check_seconds', 30),
+                                                          checkout_timeout=db_config.get('database_pool_timeout', 60),
+                                                          name="replica")
+        return cls.pool
+
+    @classmethod
+    def get_backend(cls):
+        """
+        :return: The backend (MySQL or SQLite) selected by database_backend in vm_passwords.yml
+        :rtype: MySQLBackend or SQLiteBackend
+        """
+        cls.get_pool()
+        return cls.backend
+
+    @classmethod
+    def _pool_for(cls, read_only):
+        """The replica pool for read-only work when one is configured and
+        hasn't failed recently, otherwise the primary pool.
+        """
+        primary = cls.get_pool()
+        if read_only and cls.replica_pool is not None and time.monotonic() >= cls._replica_down_until:
+            return cls.replica_pool
+        return primary
+
+    @classmethod
+    def _replica_failed(cls, e):
+        logging.warning(f"Read replica unavailable, reading from the primary for "
+                        f"{cls.replica_retry_seconds} seconds: {e}")
+        cls._replica_down_until = time.monotonic() + cls.replica_retry_seconds
+
+    @classmethod
+    def _checkout(cls, read_only):
+        """
+        :return: (pool, connection)
+        :rtype: tuple
+        """
+        pool = cls._pool_for(read_only)
+        try:
+            return pool, pool.checkout()
+        except Exception as e:
+            if pool is not cls.replica_pool or not cls._is_connection_error(e):
+                raise
+            cls._replica_failed(e)
+        pool = cls.get_pool()
+        return pool, pool.checkout()
+
+    @classmethod
+    @contextmanager
+    def connection(cls, read_only=False):
+        """Checks a connection out of the pool for the duration of the with block.
+        The connection is discarded rather than returned if the block raises a
+        connection-level error.
+
+        :param read_only: The block only reads and may see slightly stale data,
+            so it can run on the read replica if one is configured, defaults to False
+        :type read_only: bool, optional
+        """
+        pool, connection = cls._checkout(read_only)
+        discard = False
+        try:
+            yield connection
+        except Exception as e:
+            discard = cls._is_connection_error(e)
+            if discard and pool is cls.replica_pool:
+                cls._replica_failed(e)
+            raise
+        finally:
+            pool.checkin(connection, discard=discard)
+
     @classmethod
-    def execute_query(cls, query, args=None):
+    def get_retry_policy(cls):
+        cls.get_pool()
+        return cls.retry_policy
+
+    @classmethod
+    def pool_stats(cls, replica=False):
+        if replica:
+            cls.get_pool()
+            return cls.replica_pool.get_stats() if cls.replica_pool is not None else None
+        return cls.get_pool().get_stats()
+
+    @classmethod
+    def retry_stats(cls):
+        return cls.get_retry_policy().get_stats()
+
+    @classmethod
+    def _is_deadlock(cls, e):
+        return cls.get_backend().is_deadlock(e)
+
+    @classmethod
+    def _is_connection_error(cls, e):
+        return cls.get_backend().is_connection_error(e)
+
+    @classmethod
+    def _retry_kind(cls, e):
+        """
+        :return: RetryPolicy.DEADLOCK or RetryPolicy.CONNECTION if the error is
+            worth retrying, otherwise None
+        :rtype: str or None
+        """
+        if cls._is_deadlock(e):
+            return RetryPolicy.DEADLOCK
+        if cls._is_connection_error(e):
+            return RetryPolicy.CONNECTION
+        return None
+
+    @classmethod
+    def _retry_delay(cls, e, attempt, description):
+        """Asks the retry policy whether to try again after e.
+
+        :return: Seconds to back off before the next attempt, or None to give up
+        :rtype: float or None
+        """
+        kind = cls._retry_kind(e)
+        if kind is None:
+            return None
+        policy = cls.get_retry_policy()
+        if not policy.allow_retry(kind, attempt):
+            logging.error(f"Giving up on {description} after {attempt + 1} attempts ({kind}): {e}")
+            return None
+        delay = policy.backoff(attempt)
+        reason = "Deadlock" if kind == RetryPolicy.DEADLOCK else "Lost connection"
+        logging.warning(
+            f"{reason} on {description}, attempt {attempt + 1}. Retrying in {delay * 1000:.0f} ms.")
+        return delay
+
+    @classmethod
+    def _bound_connection(cls):
+        return getattr(cls._local, 'connection', None)
+
+    @classmethod
+    def in_transaction(cls):
+        return cls._bound_connection() is not None
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        """Unit of work: every execute_query/execute_many issued by this thread
+        inside the with block runs on one connection and is committed once at
+        the end. Any exception rolls the whole block back and is re-raised.
+        Nested blocks join the outermost one.
+
+        Statements inside a transaction are not retried individually; a deadlock
+        aborts the block. Use run_in_transaction() to have the block replayed.
+        """
+        connection = cls._bound_connection()
+        if connection is not None:
+            yield connection
+            return
+
+        pool = cls.get_pool()
+        connection = pool.checkout()
+        discard = False
+        cls._local.connection = connection
+        cls._local.written_tables = set()
+        try:
+            cls.get_backend().begin(connection)
+            yield connection
+            connection.commit()
+            # another thread may have re-cached the old rows between the write
+            # and the commit
+            if cls.query_cache is not None:
+                for table in cls._local.written_tables:
+                    cls.query_cache.invalidate_table(table)
+        except BaseException as e:
+            discard = cls._is_connection_error(e)
+            if not discard:
+                try:
+                    connection.rollback()
+                except Exception:
+                    discard = True
+            raise
+        finally:
+            cls._local.connection = None
+            cls._local.written_tables = None
+            pool.checkin(connection, discard=discard)
+
+    @classmethod
+    def run_in_transaction(cls, func, *args, **kwargs):
+        """Calls func inside transaction(), replaying the whole call if the
+        transaction is chosen as a deadlock victim or loses its connection
+        (nothing was committed in either case). Backoff and retry limits come
+        from the RetryPolicy. If a transaction is already open on this
+        thread, func simply joins it.
+
+        :param func: Callable doing the database work
+        :type func: callable
+        :return: Whatever func returns
+        """
+        if cls.in_transaction():
+            return func(*args, **kwargs)
+
+        attempt = 0
+        while True:
+            try:
+                with cls.transaction():
+                    result = func(*args, **kwargs)
+                cls.get_retry_policy().record_success()
+                return result
+            except Exception as e:
+                delay = cls._retry_delay(e, attempt, "transaction")
+                if delay is None:
+                    raise e
+            time.sleep(delay)
+            attempt += 1
+
+    @classmethod
+    def statement_cache_stats(cls):
+        return cls.get_backend().statement_cache_stats()
+
+    @classmethod
+    def query_cache_stats(cls):
+        cls.get_pool()
+        return cls.query_cache.get_stats() if cls.query_cache is not None else None
+
+    @classmethod
+    def _invalidate_cache(cls, query):
+        if cls.query_cache is None:
+            return
+        table = cls.query_cache.invalidate(query)
+        if table is not None and cls.in_transaction():
+            cls._local.written_tables.add(table)
+
+    @classmethod
+    def _execute(cls, connection, query, args, prepare=True):
+        backend = cls.get_backend()
+        statement_cache = backend.statement_cache(connection, query, args) if prepare else None
+        if statement_cache is not None:
+            # prepared once per connection, re-executed with new arguments
+            operation, cursor = statement_cache.get(connection, query)
+        else:
+            operation, cursor = backend.translate(query), backend.cursor(connection)
+        try:
+            start = time.perf_counter() if cls.profiler is not None else None
+            if args is None:
+                cursor.execute(operation)
+            else:
+                cursor.execute(operation, args)
+
+            # anything that returns rows: SELECT, but also EXPLAIN and SHOW
+            if cursor.description is not None:
+                result = cursor.fetchall()
+                rows = len(result)
+            else:
+                result = None
+                rows = cursor.rowcount
+                cls._invalidate_cache(query)
+            if start is not None:
+                cls.profiler.record(query, args, time.perf_counter() - start, rows)
+            return result
+        except Exception:
+            if statement_cache is not None:
+                statement_cache.discard(query)
+            raise
+        finally:
+            if statement_cache is None:
+                cursor.close()
+
+    @classmethod
+    def execute_query(cls, query, args=None, read_only=False, cache=False, prepare=True):
         """
-        Execute a SQL query with retry mechanism on deadlock.
+        Execute a SQL query, retrying with jittered backoff on deadlock or a lost
+        connection; a lost connection is discarded and the statement re-run on a
+        fresh one. Inside transaction() the statement runs on the transaction's
+        connection, is committed with it, and is not retried on its own.
 
         :param query: The SQL query
         :param args: Arguments for the query
-        :return: Query result for SELECT, or None for other types
+        :param read_only: A SELECT that tolerates replication lag; it runs on the
+            read replica when one is configured. Ignored inside transaction(),
+            where reads must see the transaction's own writes. Defaults to False
+        :type read_only: bool, optional
+        :param cache: Serve a repeated SELECT from the query cache; see QueryCache
+            for how staleness is bounded. Ignored inside transaction(). Defaults to False
+        :type cache: bool, optional
+        :param prepare: Allow running it as a cached server-side prepared statement.
+            Pass False for SQL built per call, such as an IN list sized to its
+            batch, so each variant doesn't take a cache slot. Defaults to True
+        :type prepare: bool, optional
+        :return: Query result for statements that return rows (SELECT, EXPLAIN), or None for other types
         """
-        max_retries = 3
-        retry_delay = 60  # seconds
+        connection = cls._bound_connection()
+        if connection is not None:
+            try:
+                return cls._execute(connection, query, args, prepare)
+            except Exception as e:
+                if not cls._is_deadlock(e):
+                    logging.critical(f"Bad SQL: {e}:\n{query}")
+                raise e
 
-        for attempt in range(max_retries):
-            connection = cls.get_connection()
+        query_cache = None
+        if cache:
+            cls.get_pool()
+            query_cache = cls.query_cache
+        if query_cache is not None:
+            hit, result = query_cache.get(query, args)
+            if hit:
+                return result
+            generations = query_cache.snapshot(query)
+
+        attempt = 0
+        while True:
             try:
-                cursor = connection.cursor()
-                if args is None:
-                    cursor.execute(query)
-                    formatted_query = query
-                else:
-                    cursor.execute(query, args)
-                    formatted_query = query
-                    for arg in args:
-                        formatted_query = formatted_query.replace('%s', f"'{escape_string(str(arg))}'", 1)
-
-                cls.log_sql(formatted_query, traceback.format_stack())
-                if query.strip().upper().startswith("SELECT"):
-                    result = cursor.fetchall()
-                    cursor.close()
-                    return result
-                else:
-                    connection.commit()
-                    cursor.close()
-                    return None
-            except mysql.connector.errors.InternalError as e:
-                if e.errno == 1213:  # Deadlock error code
-                    logging.warning(
-                        f"Deadlock detected, attempt {attempt + 1} of {max_retries}. Retrying in {retry_delay} seconds.")
-                    time.sleep(retry_delay)
-                else:
-                    raise e
+                with cls.connection(read_only=read_only) as connection:
+                    # connections run in autocommit, so a write is committed here
+                    result = cls._execute(connection, query, args, prepare)
+                cls.get_retry_policy().record_success()
+                if query_cache is not None and result is not None:
+                    query_cache.put(query, args, result, generations)
+                return result
             except Exception as e:
+                delay = cls._retry_delay(e, attempt, "query")
+                if delay is None:
+                    if cls._retry_kind(e) is None:
+                        logging.critical(f"Bad SQL: {e}:\n{query}")
+                        print(traceback.format_exc())
+                    raise e
+            time.sleep(delay)
+            attempt += 1
+
+    @classmethod
+    def execute_many(cls, query, rows, batch_size=500):
+        """
+        Execute one parameterized write statement for many rows. Rows are sent
+        in batches; an INSERT ... VALUES (%s, ...) batch goes to the server as a
+        single multi-row insert. Each batch is committed as one transaction and
+        retried on deadlock; inside transaction() the batches are committed
+        with the enclosing transaction instead.
+
+        :param query: The SQL statement, with %s placeholders
+        :type query: str
+        :param rows: Argument sequences, one per row
+        :type rows: iterable
+        :param batch_size: Rows per round trip and commit, defaults to 500
+        :type batch_size: int, optional
+        :return: Number of rows sent
+        :rtype: int
+        """
+        rows = list(rows)
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            cls.run_in_transaction(cls._execute_batch, query, batch)
+        return len(rows)
+
+    @classmethod
+    def _execute_batch(cls, query, batch):
+        cursor = cls.get_backend().cursor(cls._bound_connection())
+        try:
+            start = time.perf_counter() if cls.profiler is not None else None
+            cursor.executemany(cls.get_backend().translate(query), batch)
+            cls._invalidate_cache(query)
+            if start is not None:
+                cls.profiler.record(query, None, time.perf_counter() - start, len(batch))
+        except Exception as e:
+            if not cls._is_deadlock(e):
                 logging.critical(f"Bad SQL: {e}:\n{query}")
-                print(traceback.format_exc())
+            raise e
+        finally:
+            cursor.close()
 
-                cursor.close()
-                raise e
+    @classmethod
+    def iter_query(cls, query, args=None, fetch_size=1000, read_only=False):
+        """
+        Stream the rows of a SELECT instead of loading them all at once. Rows
+        are read from an unbuffered (server-side) cursor fetch_size at a time,
+        so memory stays constant however large the result set is.
 
-        # If all retries fail, rethrow the last exception
-        raise Exception(f"Failed to execute query after {max_retries} attempts due to deadlock.")
+        The generator holds its own pooled connection until it is exhausted or
+        closed. Don't leave one paused for long stretches (e.g. waiting on user
+        input); the server drops unread results after net_write_timeout. Inside
+        transaction() the rows come from the transaction's connection instead,
+        buffered, so they see the transaction's own writes.
 
+        :param query: The SELECT statement
+        :type query: str
+        :param args: Arguments for the query, defaults to None
+        :type args: list, optional
+        :param fetch_size: Rows fetched per round trip, defaults to 1000
+        :type fetch_size: int, optional
+        :param read_only: Stream from the read replica when one is configured,
+            see execute_query, defaults to False
+        :type read_only: bool, optional
+        :return: Generator of result rows
+        :rtype: generator
+        """
+        if cls.in_transaction():
+            for row in cls.execute_query(query, args):
+                yield row
+            return
 
+        pool, connection = cls._checkout(read_only)
+        cursor = None
+        exhausted = False
+        discard = False
+        try:
+            backend = cls.get_backend()
+            cursor = backend.cursor(connection, streaming=True)
+            # time spent in the database only, not in the consumer's loop body
+            elapsed = 0.0
+            row_count = 0
+            start = time.perf_counter()
+            if args is None:
+                cursor.execute(backend.translate(query))
+            else:
+                cursor.execute(backend.translate(query), args)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                elapsed += time.perf_counter() - start
+                if not rows:
+                    exhausted = True
+                    if cls.profiler is not None:
+                        cls.profiler.record(query, args, elapsed, row_count)
+                    break
+                row_count += len(rows)
+                for row in rows:
+                    yield row
+                start = time.perf_counter()
+        except Exception as e:
+            logging.critical(f"Bad SQL: {e}:\n{query}")
+            discard = cls._is_connection_error(e)
+            if discard and pool is cls.replica_pool:
+                cls._replica_failed(e)
+            raise e
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Exception:
+                    # unread rows left on the wire; the connection can't be reused
+                    discard = True
+            # abandoned part way through: don't hand back a connection that
+            # may still be mid-result
+            pool.checkin(connection, discard=discard or not exhausted)
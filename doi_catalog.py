@@ -0,0 +1,216 @@
+import logging
+import os
+import time
+import numpy as np
+from db_connection import DBConnection
+
+
+class DoiCatalog(object):
+    """The dois table held column-wise in NumPy arrays, one element per DOI,
+    for reports and planning queries over the whole collection. Filters,
+    group-bys and histograms are vectorized, so once loaded they take
+    milliseconds instead of a query or a Python loop per journal.
+
+    Columns: issn_code (index into issns), year, downloaded and score (the
+    scans score, NaN if the DOI hasn't been scanned). A catalog is a
+    snapshot; reload it, or use cached() with a maximum age, to see new rows.
+    """
+
+    def __init__(self, issns, issn_code, year, downloaded, score):
+        """
+        :param issns: Distinct ISSNs; issn_code values index into this
+        :type issns: list[str]
+        :param issn_code: Per DOI, the position of its ISSN in issns
+        :type issn_code: numpy.ndarray
+        :param year: Per DOI, the published year
+        :type year: numpy.ndarray
+        :param downloaded: Per DOI, whether the PDF is downloaded
+        :type downloaded: numpy.ndarray
+        :param score: Per DOI, the scan score or NaN
+        :type score: numpy.ndarray
+        """
+        self.issns = list(issns)
+        self._issn_index = {issn: code for code, issn in enumerate(self.issns)}
+        self.issn_code = issn_code
+        self.year = year
+        self.downloaded = downloaded
+        self.score = score
+
+    def __len__(self):
+        return len(self.year)
+
+    @classmethod
+    def load(cls, start_year=None, end_year=None, issn=None, fetch_size=10000):
+        """Reads the catalog from the database, streamed so that only the
+        arrays are kept in memory.
+
+        :param start_year: First published year to include, defaults to None (no lower bound)
+        :type start_year: int, optional
+        :param end_year: Last published year to include, defaults to None (no upper bound)
+        :type end_year: int, optional
+        :param issn: Only this journal, defaults to None (all journals)
+        :type issn: str, optional
+        :param fetch_size: Rows fetched per round trip, defaults to 10000
+        :type fetch_size: int, optional
+        :return: The catalog
+        :rtype: DoiCatalog
+        """
+        conditions = []
+        args = []
+        if start_year is not None:
+            conditions.append("dois.published_date >= %s")
+            args.append(f"{start_year}-01-01")
+        if end_year is not None:
+            conditions.append("dois.published_date <= %s")
+            args.append(f"{end_year}-12-31")
+        if issn is not None:
+            conditions.append("dois.issn = %s")
+            args.append(issn)
+        sql = """select dois.issn, YEAR(dois.published_date), dois.downloaded, scans.score
+                 from dois left join scans on scans.doi = dois.doi"""
+        if conditions:
+            sql += " where " + " and ".join(conditions)
+
+        start = time.time()
+        issn_index = {}
+        issn_code, year, downloaded, score = [], [], [], []
+        for row_issn, row_year, row_downloaded, row_score in DBConnection.iter_query(
+                sql, args or None, fetch_size=fetch_size, read_only=True):
+            issn_code.append(issn_index.setdefault(row_issn, len(issn_index)))
+            year.append(row_year)
+            downloaded.append(bool(row_downloaded))
+            score.append(np.nan if row_score is None else row_score)
+        catalog = cls(list(issn_index),
+                      np.array(issn_code, dtype=np.int32),
+                      np.array(year, dtype=np.int16),
+                      np.array(downloaded, dtype=bool),
+                      np.array(score, dtype=np.float32))
+        logging.info(f"Loaded {len(catalog)} DOIs into the catalog in {time.time() - start:.1f}s")
+        return catalog
+
+    def save(self, path):
+        """Writes the catalog to a compressed .npz snapshot.
+
+        :param path: Snapshot file
+        :type path: str
+        """
+        np.savez_compressed(path,
+                            issns=np.array(self.issns, dtype=str),
+                            issn_code=self.issn_code,
+                            year=self.year,
+                            downloaded=self.downloaded,
+                            score=self.score)
+
+    @classmethod
+    def load_snapshot(cls, path):
+        """
+        :param path: A file written by save()
+        :type path: str
+        :return: The catalog
+        :rtype: DoiCatalog
+        """
+        with np.load(path) as snapshot:
+            return cls(snapshot['issns'].tolist(),
+                       snapshot['issn_code'],
+                       snapshot['year'],
+                       snapshot['downloaded'],
+                       snapshot['score'])
+
+    @classmethod
+    def cached(cls, path, max_age_seconds=3600):
+        """The whole collection, from the snapshot at path if it is recent
+        enough, otherwise loaded from the database and saved there.
+
+        :param path: Snapshot file
+        :type path: str
+        :param max_age_seconds: Oldest snapshot to reuse, defaults to 3600
+        :type max_age_seconds: float, optional
+        :return: The catalog
+        :rtype: DoiCatalog
+        """
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age_seconds:
+            return cls.load_snapshot(path)
+        catalog = cls.load()
+        catalog.save(path)
+        return catalog
+
+    def mask(self, start_year=None, end_year=None, issn=None, downloaded=None, scanned=None, min_score=None):
+        """Selects DOIs. Every criterion left as None matches everything.
+
+        :param issn: Only this journal
+        :type issn: str, optional
+        :param downloaded: Only downloaded (True) or missing (False) PDFs
+        :type downloaded: bool, optional
+        :param scanned: Only DOIs with (True) or without (False) a scan score
+        :type scanned: bool, optional
+        :param min_score: Only scores at least this high
+        :type min_score: float, optional
+        :return: Boolean array, one element per DOI
+        :rtype: numpy.ndarray
+        """
+        selected = np.ones(len(self), dtype=bool)
+        if start_year is not None:
+            selected &= self.year >= start_year
+        if end_year is not None:
+            selected &= self.year <= end_year
+        if issn is not None:
+            code = self._issn_index.get(issn)
+            if code is None:
+                return np.zeros(len(self), dtype=bool)
+            selected &= self.issn_code == code
+        if downloaded is not None:
+            selected &= self.downloaded == downloaded
+        if scanned is not None:
+            selected &= np.isnan(self.score) != scanned
+        if min_score is not None:
+            selected &= self.score >= min_score
+        return selected
+
+    def count(self, selected=None):
+        return int(np.count_nonzero(selected)) if selected is not None else len(self)
+
+    def journal_tallies(self, selected=None):
+        """Downloaded and missing counts per journal.
+
+        :param selected: From mask(), defaults to None (every DOI)
+        :type selected: numpy.ndarray, optional
+        :return: issn -> {'downloaded': n, 'missing': n}, journals with no selected DOIs left out
+        :rtype: dict
+        """
+        codes = self.issn_code if selected is None else self.issn_code[selected]
+        downloaded = self.downloaded if selected is None else self.downloaded[selected]
+        totals = np.bincount(codes, minlength=len(self.issns))
+        got = np.bincount(codes, weights=downloaded, minlength=len(self.issns)).astype(np.int64)
+        return {self.issns[code]: {'downloaded': int(got[code]), 'missing': int(totals[code] - got[code])}
+                for code in np.flatnonzero(totals)}
+
+    def journals(self, selected=None):
+        """
+        :return: ISSNs with at least one selected DOI
+        :rtype: list[str]
+        """
+        codes = self.issn_code if selected is None else self.issn_code[selected]
+        return [self.issns[code] for code in np.unique(codes)]
+
+    def year_histogram(self, selected=None):
+        """
+        :return: year -> number of selected DOIs, for years that have any
+        :rtype: dict
+        """
+        years = self.year if selected is None else self.year[selected]
+        if len(years) == 0:
+            return {}
+        first = int(years.min())
+        counts = np.bincount(years.astype(np.int64) - first)
+        return {first + int(offset): int(counts[offset]) for offset in np.flatnonzero(counts)}
+
+    def score_histogram(self, bins=10, selected=None):
+        """Distribution of scan scores; unscanned DOIs are left out.
+
+        :param bins: Number of bins, or the bin edges, defaults to 10
+        :type bins: int or sequence
+        :return: (counts, bin edges), as numpy.histogram
+        :rtype: tuple
+        """
+        scores = self.score if selected is None else self.score[selected]
+        return np.histogram(scores[~np.isnan(scores)], bins=bins)
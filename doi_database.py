@@ -1,4 +1,8 @@
 import os
+import copy
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests.exceptions
 
@@ -10,12 +14,19 @@ import urllib
 import time
 import csv
 from crossref_journal_entry import CrossrefJournalEntry
-from doi_entry import EntryExistsException
+from crossref_metadata import CrossrefMetadata
+from crossref_sync_state import CrossrefSyncState
 from db_connection import DBConnection
 from database_report import DatabaseReport
+from doi_catalog import DoiCatalog
 from downloaders import Downloaders
 from scan_database import ScanDatabase
 from validator import Validator
+from schema_migrations import SchemaMigrations
+from bulk_loader import BulkLoader
+from existence_filter import DoiExistenceFilter
+from rate_limiter import RateLimiter
+from write_behind import WriteBehind
 import json
 from datetime import datetime
 
@@ -30,6 +41,8 @@ class DoiDatabase(Utils):
     headers = {
         'User-Agent': 'development; mailto:jrussack@calacademy.org',
     }
+    # crossref pages fetched ahead of the one being written
+    PREFETCH_PAGES = 2
 
     # "do_setup" creates the db tables (if they don't exist) and polls crossref.org for
     # the journals listed in journals.tsv. If the PDF already exists
@@ -43,6 +56,14 @@ class DoiDatabase(Utils):
                  end_year=None):
         super().__init__()
         self.config = config
+        # table -> BulkLoader while download_issn runs in bulk load mode
+        self._bulk_loaders = None
+        # DOIs already stored for the issn/years download_issn is fetching
+        self._existence_filter = None
+        # download_issn is fetching changes (delta sync): update existing DOIs
+        self._upsert = False
+        # shared by the harvest threads; None fetches with _get_url_'s own back-off
+        self.rate_limiter = None
 
         self._setup()
         if start_year is not None:
@@ -50,12 +71,16 @@ class DoiDatabase(Utils):
             self._query_journals(start_year, end_year)
 
     def _setup(self):
-        """Creates seven SQL database tables 
+        """Creates the SQL database tables, then brings their indexes up to
+        the current schema version.
         """        
         CrossrefJournalEntry.create_tables()
         DoiEntry.create_tables()
+        CrossrefMetadata.create_tables()
+        CrossrefSyncState.create_tables()
         ScanDatabase.create_tables()
         Validator.create_tables()
+        SchemaMigrations.migrate()
 
     def _print_journal_actions(self, issn, check_year, journal, type):
         """Prints the intended actions for a journal record."""
@@ -124,7 +149,17 @@ class DoiDatabase(Utils):
 
         if not skip_crossref_precheck:
             self._query_journals_tsv(start_year,end_year, self._print_journal_actions)
-        self._query_journals_tsv(start_year,end_year, self._execute_journal_actions)
+        tasks = []
+        self._query_journals_tsv(start_year, end_year, lambda *task: tasks.append(task))
+        if self.config.get_boolean('crossref', 'delta_sync', fallback=False):
+            # one task per journal covering every year, not one per journal year
+            journals = {}
+            for issn, check_year, journal, type in tasks:
+                journals.setdefault(issn, (journal, type))
+            tasks = [(issn, start_year, end_year, journal, type) for issn, (journal, type) in journals.items()]
+            self._harvest(DoiDatabase._sync_journal, tasks)
+        else:
+            self._harvest(DoiDatabase._execute_journal_actions, tasks)
 
                 # if self._check_journal_record(issn, start_year):
                 #     self.download_issn(issn, start_year, end_year)
@@ -139,15 +174,124 @@ class DoiDatabase(Utils):
         :param start_year: The start year for the update, defined in config.ini as 'force_update_year = xxxx'
         :type start_year: int
         """        
-        end_year = start_year
         query = f"select issn,name,type from journals"
         results = DBConnection.execute_query(query)
-        for journal in results:
-            issn = journal[0]
-            name = journal[1]
-            type = journal[2]
-            self.download_issn(issn, start_year, end_year)
-            self._update_journal_record(issn, name, type)
+        tasks = [(issn, start_year, name, type) for issn, name, type in results]
+        self._harvest(DoiDatabase._force_journal_update, tasks)
+
+    def _sync_journal(self, issn, start_year, end_year, journal, type):
+        """Delta sync for one journal. Years already covered by its high-water
+        mark (crossref_sync_state) are brought up to date with one query for the
+        works crossref has had updated or deposited since the last sync; those
+        are upserted. Years not covered yet are harvested in full. The first
+        sync of a journal takes the years that already have DOIs as covered
+        (see _harvested_years). The mark only moves once everything was fetched.
+
+        :param issn: Journal ISSN
+        :type issn: str
+        :param start_year: First published year
+        :type start_year: int
+        :param end_year: Last published year
+        :type end_year: int
+        """
+        started = datetime.now()
+        state = CrossrefSyncState.get(issn)
+        if state is None:
+            covered, synced_through = self._harvested_years(issn, start_year, end_year)
+            synced_through = min(synced_through, started) if synced_through is not None else None
+            first_year, last_year = start_year, end_year
+        else:
+            first_year, last_year, synced_through = state
+            covered = set(range(first_year, last_year + 1))
+            if first_year <= end_year + 1 and start_year <= last_year + 1:
+                first_year, last_year = min(start_year, first_year), max(end_year, last_year)
+            else:
+                # not adjacent to the recorded years: keep the mark to what this sync covers
+                first_year, last_year = start_year, end_year
+        delta_years = [year for year in range(start_year, end_year + 1) if year in covered]
+        full_years = [year for year in range(start_year, end_year + 1) if year not in covered]
+        complete = True
+        if delta_years:
+            logging.info(f"Delta sync of {journal} issn: {issn} since {synced_through}")
+            complete = self.download_issn(issn, delta_years[0], delta_years[-1],
+                                          updated_since=synced_through.date())
+        for year in full_years:
+            logging.info(f"Downloading {journal} issn: {issn} year: {year}")
+            complete = self.download_issn(issn, year, year) and complete
+        self._update_journal_record(issn, journal, type)
+        if complete:
+            CrossrefSyncState.record(issn, first_year, last_year, started)
+
+    @staticmethod
+    def _harvested_years(issn, start_year, end_year):
+        """The years of a journal that the per-year harvest already downloaded,
+        for a journal's first delta sync. Like _is_year_downloaded, a year with
+        any DOIs counts as downloaded. Its works were fetched no earlier than
+        the newest of them was published, so anything crossref changed after
+        that harvest was updated after that date too.
+
+        :param issn: Journal ISSN
+        :type issn: str
+        :param start_year: First published year
+        :type start_year: int
+        :param end_year: Last published year
+        :type end_year: int
+        :return: (years with DOIs, newest published date among them as a
+            datetime, or None if there are none)
+        :rtype: tuple
+        """
+        query = """select YEAR(published_date), max(published_date) from collections_papers.dois
+                   where issn = %s and published_date between %s and %s
+                   group by YEAR(published_date)"""
+        results = DBConnection.execute_query(query, [issn, f"{start_year}-01-01", f"{end_year}-12-31"])
+        years = set()
+        newest = None
+        for year, published_date in results:
+            years.add(int(year))
+            if isinstance(published_date, str):
+                published_date = date.fromisoformat(published_date[:10])
+            if newest is None or published_date > newest:
+                newest = published_date
+        if newest is None:
+            return years, None
+        return years, datetime.combine(newest, datetime.min.time())
+
+    def _force_journal_update(self, issn, year, journal, type):
+        self.download_issn(issn, year, year)
+        self._update_journal_record(issn, journal, type)
+
+    def _harvest(self, operation, tasks):
+        """Runs crossref harvest tasks, [crossref] harvest_threads of them at
+        once. The threads share one RateLimiter, which paces every crossref
+        request to the rate crossref advertises and cuts concurrency when
+        responses slow down. Each task runs on its own shallow copy of this
+        object, so per-ingest state (bulk loaders, existence filter) stays
+        with its thread. With one thread, tasks run in order as before.
+
+        :param operation: DoiDatabase method to call with each task's arguments
+        :type operation: function
+        :param tasks: Argument tuples, e.g. (issn, year, journal, type)
+        :type tasks: list[tuple]
+        """
+        threads = self.config.get_int('crossref', 'harvest_threads', fallback=1)
+        if threads <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                operation(self, *task)
+            return
+        rate_limiter = RateLimiter(max_concurrency=threads)
+        logging.info(f"Harvesting {len(tasks)} journal years from crossref with {threads} threads")
+
+        def run(task):
+            worker = copy.copy(self)
+            worker.rate_limiter = rate_limiter
+            operation(worker, *task)
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='harvest') as pool:
+            # re-raises the first failure once every task has finished
+            for _ in pool.map(run, tasks):
+                pass
+        logging.info(f"Harvest took {time.time() - start:.0f}s, rate limiter: {rate_limiter.get_stats()}")
 
     def _is_year_downloaded(self, issn, year):
         """Check if there are any DOI entries for the given ISSN in the specified year.
@@ -160,16 +304,16 @@ class DoiDatabase(Utils):
         :return: True if there are DOI entries in the specified year, False otherwise.
         :rtype: bool
         """
-        query = f"""
-        SELECT COUNT(*) FROM collections_papers.dois
-        WHERE issn = \"{issn}\" AND YEAR(published_date) = {year}
+        # a range on the bare column (not YEAR(published_date)) can use the
+        # issn/date index
+        query = """
+        SELECT 1 FROM collections_papers.dois
+        WHERE issn = %s AND published_date BETWEEN %s AND %s
+        LIMIT 1
         """
-        results = DBConnection.execute_query(query)
-
-        if len(results) >= 1 and results[0][0] > 0:
-            return True
-        else:
-            return False
+        year = int(year)
+        results = DBConnection.execute_query(query, [issn, f"{year}-01-01", f"{year}-12-31"])
+        return len(results) >= 1
 
     def _update_journal_record(self, issn, name, type):
         """
@@ -182,11 +326,10 @@ class DoiDatabase(Utils):
         :param type: the type of the journal, either 'online' or 'print'
         :type type: str
         """
-        name = name.replace("'", "''")
         logging.info(f"{issn}\t{name}\t{type}")
-        sql = f"REPLACE INTO journals (issn,name, type) VALUES ('{issn}','{name}','{type}')"
+        sql = "REPLACE INTO journals (issn,name, type) VALUES (%s,%s,%s)"
 
-        DBConnection.execute_query(sql)
+        DBConnection.execute_query(sql, [issn, name, type])
 
 
     def download_dois_by_journal_size(self,
@@ -216,14 +359,16 @@ class DoiDatabase(Utils):
         if randomize:
             random.shuffle(journals)
 
+        # one load for every journal's report header; each report filters it in memory
+        catalog = None if suppress_journal_report_header else DoiCatalog.load(start_year, end_year)
         for journal, issn, doi_count in journals:
             # journal = journal[0]
             # issn = journal[1]
             logging.info(f"Attempting downloads for journal: {journal}:{issn}")
             if not suppress_journal_report_header:
-                report = DatabaseReport(self, start_year, end_year, journal)
+                report = DatabaseReport(self, start_year, end_year, issn, catalog=catalog)
                 logging.info("\n")
-                logging.info(report.report(journal=issn, summary=False))
+                logging.info(report.report(issn=issn, summary=False))
             self.download_dois(start_year, end_year, journal=journal, issn=issn)
 
     def generate_select_sql(self, start_year, end_year, journal_issn, downloaded, limit=None, offset=None):
@@ -244,11 +389,13 @@ class DoiDatabase(Utils):
         :type limit: int or None
         :param offset: The offset of the first row to return.
         :type offset: int or None
-        :return: The SQL query for selecting DOI entries based on the provided criteria.
-        :rtype: str
+        :return: The SQL query for selecting DOI entries based on the provided criteria,
+                 and the arguments for its placeholders.
+        :rtype: Tuple[str, list]
         """
 
         conditions = []
+        args = []
 
         if downloaded is not None:
             downloaded_value = "TRUE" if downloaded else "FALSE"
@@ -258,19 +405,22 @@ class DoiDatabase(Utils):
             conditions.append(self.sql_year_restriction(start_year, end_year))
 
         if journal_issn is not None:
-            conditions.append(f'issn = "{journal_issn}"')
+            conditions.append("issn = %s")
+            args.append(journal_issn)
 
         where_clause = " where " + " and ".join(conditions) if conditions else ""
 
         select_dois = f"select * from dois{where_clause}"
 
         if limit is not None:
-            select_dois += f" LIMIT {limit}"
+            select_dois += " LIMIT %s"
+            args.append(int(limit))
 
         if offset is not None:
-            select_dois += f" OFFSET {offset}"
+            select_dois += " OFFSET %s"
+            args.append(int(offset))
 
-        return select_dois
+        return select_dois, args
 
     def get_dois(self, start_year, end_year, journal_issn=None, downloaded=True, limit=None, offset=None):
         """
@@ -290,16 +440,16 @@ class DoiDatabase(Utils):
         :param offset: The offset of the first row to return, defaults to None.
         :type offset: int, optional
         :return: A list of DOI entries that match the specified criteria.
-        :rtype: List[DoiEntry]
+        :rtype: List[DoiRecord]
         """
 
-        sql = self.generate_select_sql(start_year, end_year, journal_issn, downloaded, limit, offset)
-        dois = DoiFactory(sql).dois
+        sql, args = self.generate_select_sql(start_year, end_year, journal_issn, downloaded, limit, offset)
+        dois = DoiFactory(sql, args).dois
         return dois
 
     def get_doi(self, doi):
-        sql = f"select * from dois where doi = '{doi}'"
-        doi = DoiFactory(sql).dois
+        sql = "select * from dois where doi = %s"
+        doi = DoiFactory(sql, [doi], cache=True).dois
         if len(doi) != 1:
             raise FileNotFoundError(f"No such doi: {doi} or multiple results")
         return doi[0]
@@ -324,10 +474,14 @@ class DoiDatabase(Utils):
         :type year: int
         """
         logging.info(f"Loading DOIs for the year {year} to check for files..")
-        dois = self.get_dois(year, year, downloaded=None)
-        total_dois = len(dois)
+        count_sql = f"select count(*) from dois where {self.sql_year_restriction(year, year)}"
+        total_dois = DBConnection.execute_query(count_sql)[0][0]
         logging.info(f"Checking paths for {total_dois} DOIs in {year}")
+        # streamed; a year can be hundreds of thousands of rows
+        dois = DoiFactory.iterate(*self.generate_select_sql(year, year, None, downloaded=None))
         linefeed=0
+        # changed rows are written together, a few statements per thousand
+        changed = []
         for index, doi_entry in enumerate(dois, start=1):
             if index % 1000 == 0 or index == total_dois:
                 if linefeed > 0:
@@ -336,8 +490,12 @@ class DoiDatabase(Utils):
                 print(f"Processed {index}/{total_dois} DOIs.")
             if doi_entry.get_downloaded_status() != doi_entry.check_and_update_file_path_variables():
                 self._print_update_progress(linefeed, doi_entry.get_downloaded_status())
-                doi_entry.update_database()
+                changed.append(doi_entry)
                 linefeed += 1
+                if len(changed) >= 1000:
+                    DoiEntry.bulk_update_status(changed)
+                    changed = []
+        DoiEntry.bulk_update_status(changed)
 
     def _print_update_progress(self, index, downloaded_status):
         """Print progress based on the downloaded status.
@@ -382,24 +540,24 @@ class DoiDatabase(Utils):
         :param issn: The ISSN (International Standard Serial Number) used as a filter for DOI entries. If True, the ISSN will be used to filter DOI entries; if False, it will not be used for filtering.
         :type issn: bool
         """        
-        select_dois = self.generate_select_sql(start_year, end_year, issn, downloaded=False)
+        select_dois, args = self.generate_select_sql(start_year, end_year, issn, downloaded=False)
         downloaders = Downloaders()
-        logging.info(f"SQL: {select_dois}")
+        logging.info(f"SQL: {select_dois} {args}")
 
-        doif = DoiFactory(select_dois)
-        dois = doif.dois
-        logging.info(f"  Pending download count: {len(dois)}")
-        download_list = []
-        for doi_entry in dois:
-            if journal is None or doi_entry.issn == issn:
-                download_list.append(doi_entry)
+        doif = DoiFactory(select_dois, args)
+        logging.info(f"  Pending download count: {doif.count()}")
+        # lazy: downloads start with the first chunk of DOIs
+        download_list = (doi_entry for doi_entry in doif if journal is None or doi_entry.issn == issn)
 
         downloaders.download_list(download_list)
 
     def is_downloaded(self, doi_entry):
+        pending = WriteBehind.peek('doi_download_status', doi_entry.doi)
+        if pending is not None:
+            return pending[0]
         return doi_entry.downloaded
 
-    def download_issn(self, issn, start_year, end_year):
+    def download_issn(self, issn, start_year, end_year, updated_since=None):
         """    Download data for a specific ISSN from a given start year to an end year
         using crossref API. This is "dumb"; it will re-download all years regardless
         of whether they have been downloaded before.
@@ -413,35 +571,124 @@ class DoiDatabase(Utils):
         :type start_year: str
         :param end_year: The end year for filtering the data
         :type end_year: str
+        :param updated_since: Only fetch works crossref has had updated since
+            this date ([crossref] delta_sync_date_filter), and update the ones
+            already stored; defaults to None (fetch everything, keep what is stored)
+        :type updated_since: datetime.date, optional
+        :return: False if the download was aborted part way
+        :rtype: bool
         """
         journal_url = f'https://api.crossref.org/journals/{issn}'
-        base_url = f"{journal_url}/works?filter=from-pub-date:{start_year},until-pub-date:{end_year}&rows=1000&cursor="
-        cursor = "*"
-        done = False
+        filters = f"from-pub-date:{start_year},until-pub-date:{end_year}"
+        if updated_since is not None:
+            date_filter = self.config.get_string('crossref', 'delta_sync_date_filter', fallback='from-update-date')
+            filters += f",{date_filter}:{updated_since.isoformat()}"
+        base_url = f"{journal_url}/works?filter={filters}&rows=1000&cursor="
         total_items_processed = 0
-        total_results = 0
         logging.info(f"Processing issn:{issn}")
 
-        response = requests.get(journal_url)
+        response = requests.get(journal_url) if self.rate_limiter is None else self.rate_limiter.get(journal_url)
 
         if response.status_code == 404 and response.text == "Resource not found.":
             print(f"There is no crossref data for journal {issn}")
-            return
+            return True
 
-        while not done:
-            try:
-                cursor, total_results, items_processed = self._download_chunk(base_url, cursor, start_year)
-                total_items_processed += items_processed
+        self._upsert = updated_since is not None
+        # a delta is small and exists to update rows: no bulk merge or existence filter
+        if not self._upsert:
+            if self.config.get_boolean('bulk_load', 'enabled', fallback=False):
+                batch_rows = self.config.get_int('bulk_load', 'batch_rows', fallback=50000)
+                self._bulk_loaders = {'dois': BulkLoader('dois', batch_rows=batch_rows),
+                                      'crossref_journal_data': BulkLoader('crossref_journal_data',
+                                                                          batch_rows=batch_rows)}
+            self._existence_filter = DoiExistenceFilter.load(
+                issn, start_year, end_year,
+                set_limit=self.config.get_int('crossref', 'existence_filter_set_limit', fallback=1000000),
+                error_rate=float(self.config.get_string('crossref', 'existence_filter_error_rate',
+                                                        fallback='0.001')),
+                false_positive_budget=float(self.config.get_string(
+                    'crossref', 'existence_filter_false_positive_budget', fallback='1')))
+        # a fetcher thread follows the cursor PREFETCH_PAGES pages ahead while
+        # this one writes, so network and database time overlap
+        pages = queue.Queue(maxsize=DoiDatabase.PREFETCH_PAGES)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=self._fetch_pages, args=(base_url, start_year, pages, stop),
+                                   name=f"crossref-fetch-{issn}", daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                message = pages.get()
+                if message is None:
+                    logging.info(f"Done, {total_items_processed} items.")
+                    break
+                if isinstance(message, Exception):
+                    raise message
+                total_items_processed += self._ingest_chunk(message['items'])
                 logging.info("Continuing...")
-            except ConnectionError:
-                if total_items_processed >= total_results:
-                    done = True
-                    logging.info("Done.")
-                else:
+        except RetriesExceededException as rex:
+            logging.info(f"Retries exceeded: {rex}, aborting.")
+            return False
+        finally:
+            # a fetcher blocked on a full queue or sleeping between retries exits on its own
+            stop.set()
+            # whatever was fetched before an abort is still good data
+            if self._bulk_loaders is not None:
+                for loader in self._bulk_loaders.values():
+                    loader.flush()
+                self._bulk_loaders = None
+            if self._existence_filter is not None:
+                logging.info(f"Existing DOI filter for {issn}: {self._existence_filter.stats}")
+            self._existence_filter = None
+            self._upsert = False
+        return True
+
+    def _fetch_pages(self, url, start_year, pages, stop):
+        """Fetcher thread for download_issn: follows the cursor from the first
+        page to the last, putting each page's message on the queue, then None.
+        An exception ends the stream and is put on the queue for the writer to
+        raise. Stops early once stop is set.
+
+        :param url: Works URL, ending in "cursor="
+        :type url: str
+        :param start_year: The start year for filtering the data
+        :type start_year: str
+        :param pages: Bounded queue to the writer
+        :type pages: queue.Queue
+        :param stop: Set by the writer when it has finished or failed
+        :type stop: threading.Event
+        """
+        cursor = "*"
+        items_fetched = 0
+        try:
+            while not stop.is_set():
+                message = self._fetch_chunk(url, cursor, start_year)
+                if len(message['items']) == 0:
+                    if items_fetched >= message['total-results']:
+                        break
+                    logging.error("No items left.")
                     logging.info("retrying....")
-            except RetriesExceededException as rex:
-                logging.info(f"Retries exceeded: {rex}, aborting.")
-                return
+                    continue
+                items_fetched += len(message['items'])
+                if not self._put_page(pages, message, stop):
+                    return
+                cursor = message['next-cursor']
+            self._put_page(pages, None, stop)
+        except Exception as e:
+            self._put_page(pages, e, stop)
+
+    @staticmethod
+    def _put_page(pages, message, stop):
+        """
+        :return: False if the writer stopped before there was room on the queue
+        :rtype: bool
+        """
+        while not stop.is_set():
+            try:
+                pages.put(message, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
     def _handle_connection_error(self, retries, max_retries, url, cursor, start_year, e):
         """    Handles connection errors during downloading.
@@ -459,20 +706,57 @@ class DoiDatabase(Utils):
         :param e: The connection error that occurred.
         :type e: Exception
         :raises RetriesExceededException: If the maximum number of retries is exceeded.
-        :return: The result of the _download_chunk function call.
-        :rtype: Result of _download_chunk function call.
+        :return: The result of the _fetch_chunk function call.
+        :rtype: Result of _fetch_chunk function call.
         """        
         logging.info(f"Connection error: {e}, retries: {retries}. Sleeping 60 and retrying.")
         time.sleep(60)
         if retries >= max_retries:
             raise RetriesExceededException(f"Retried {retries} times, aborting.")
-        return self._download_chunk(url, cursor, start_year, retries)
+        return self._fetch_chunk(url, cursor, start_year, retries)
+
+    @staticmethod
+    def _ingest_page(doi_entries, journal_entries, check_dois=None):
+        """Writes one crossref page: a single IN (...) lookup drops the DOIs we
+        already have, then the rest go in as multi-row inserts, along with their
+        compressed crossref metadata. Runs in one
+        transaction (see run_in_transaction), so a page is stored whole or not at all.
+
+        :param doi_entries: Parsed journal-article items, unique by DOI
+        :type doi_entries: list[DoiEntry]
+        :param journal_entries: Parsed journal items
+        :type journal_entries: list[CrossrefJournalEntry]
+        :param check_dois: The DOIs that may already be stored and are looked up;
+            with an existence filter only its unconfirmed matches, possibly none.
+            Defaults to None, every DOI on the page
+        :type check_dois: list[str], optional
+        :return: The looked up DOIs that were already stored
+        :rtype: set
+        """
+        if check_dois is None:
+            check_dois = [doi_entry.doi for doi_entry in doi_entries]
+        existing = DoiEntry.existing_dois(check_dois) if check_dois else set()
+        if existing:
+            logging.info(f"{len(existing)} DOIs already in database, skipping")
+        # INSERT IGNORE as well: another worker may store the same DOI meanwhile
+        new_entries = [doi_entry for doi_entry in doi_entries if doi_entry.doi not in existing]
+        DoiEntry.insert_many(new_entries, ignore_existing=True)
+        CrossrefMetadata.insert_many([doi_entry.details for doi_entry in new_entries])
+        CrossrefJournalEntry.insert_many(journal_entries)
+        return existing
+
+    @staticmethod
+    def _upsert_page(doi_entries, journal_entries):
+        """Delta sync version of _ingest_page: new DOIs are inserted, stored
+        ones get crossref's current issn, date, titles and metadata.
+        """
+        DoiEntry.upsert_many(doi_entries)
+        CrossrefMetadata.insert_many([doi_entry.details for doi_entry in doi_entries], replace=True)
+        CrossrefJournalEntry.insert_many(journal_entries)
 
-    def _download_chunk(self, url, cursor, start_year, retries=0):
+    def _fetch_chunk(self, url, cursor, start_year, retries=0):
         """
-        Downloads a chuck of DOIS from crossref. Creates a crossref journal entry for
-        journals or a DOI for papers and stores it in the database if there isn't
-        already a database entry there.
+        Downloads a chuck of DOIS from crossref, retrying connection errors.
 
         :param url: The URL (crossref api) to download the data from
         :type url: str
@@ -482,15 +766,14 @@ class DoiDatabase(Utils):
         :type start_year: str
         :param retries:  The number of retries attempted, defaults to 0
         :type retries: int, optional
-        :raises ConnectionError: Raises a ConnectionError if a connection error occurs
-        :return: The 'next cursor' value, message['total-results'], and number of items processed.
-        :rtype: Tuple[str, dict(not sure about this), int]
-        
+        :raises RetriesExceededException: If the page still can't be fetched after max_retries
+        :return: The response's message: 'items', 'total-results' and 'next-cursor'
+        :rtype: dict
         """        
         max_retries = 3
         safe_cursor = urllib.parse.quote(cursor, safe="")
         try:
-            results = self._get_url_(url + safe_cursor, self.headers)
+            results = self._get_url_(url + safe_cursor, self.headers, rate_limiter=self.rate_limiter)
         except ConnectionError as e:
             retries += 1
             return self._handle_connection_error(retries, max_retries, url, cursor, start_year, e)
@@ -499,33 +782,66 @@ class DoiDatabase(Utils):
             return self._handle_connection_error(retries, max_retries, url, cursor, start_year, e)
 
         logging.info(f"Querying: {url + safe_cursor}")
-        message = results['message']
-        items = message['items']
-        total_results = message['total-results']
+        return results['message']
+
+    def _ingest_chunk(self, items):
+        """
+        Creates a crossref journal entry for journals or a DOI for papers and
+        stores it in the database if there isn't already a database entry there.
+
+        :param items: One page of crossref work items
+        :type items: list[dict]
+        :return: Number of items processed
+        :rtype: int
+        """
         items_processed = 0
+        new_entries = {}
+        journal_entries = []
+        bulk_loaders = self._bulk_loaders
+        existence_filter = self._existence_filter
         for item in items:
             items_processed += 1
             # logging.info(f"Processing DOI: {item['DOI']}")
             type = item['type']
             if type == 'journal':
-                CrossrefJournalEntry(item)
+                journal_entries.append(CrossrefJournalEntry(item, insert=False))
             elif type == "journal-article":
-                try:
-                    DoiEntry('download_chunk', item)
-                except EntryExistsException as e:
-                    # logging.warning(f"DOI already in database, skipping: {e}")
-                    logging.info(".")
+                # existing DOIs are dropped for the whole page at once below
+                doi_entry = DoiEntry('download_chunk', item, insert=False, check_exists=False, config=self.config)
+                # crossref occasionally repeats a DOI within a page
+                new_entries[doi_entry.doi] = doi_entry
             else:
                 # "journal-issue"
                 # logging.info(f"got type: {type}")
                 pass
-
-        if len(items) == 0:
-            logging.error("No items left.")
-            raise ConnectionError()
-        else:
-            logging.info(f"Processed {len(items)} items")
-        return message['next-cursor'], total_results, items_processed
+        doi_entries = list(new_entries.values())
+        check_dois = None
+        if existence_filter is not None:
+            known, check_dois = existence_filter.classify(list(new_entries))
+            if known:
+                logging.info(f"{len(known)} DOIs already in database, skipping")
+            doi_entries = [doi_entry for doi_entry in doi_entries if doi_entry.doi not in known]
+        if self._upsert:
+            if doi_entries or journal_entries:
+                DBConnection.run_in_transaction(self._upsert_page, doi_entries, journal_entries)
+        elif bulk_loaders is not None:
+            if check_dois:
+                existing = DoiEntry.existing_dois(check_dois)
+                existence_filter.confirmed(check_dois, existing)
+                doi_entries = [doi_entry for doi_entry in doi_entries if doi_entry.doi not in existing]
+            # the merge drops DOIs that already exist
+            bulk_loaders['crossref_journal_data'].extend(entry.bulk_row() for entry in journal_entries)
+            bulk_loaders['dois'].extend(doi_entry._insert_args() for doi_entry in doi_entries)
+            # binary, so not staged through the loaders' TSV files
+            CrossrefMetadata.insert_many([doi_entry.details for doi_entry in doi_entries])
+        elif doi_entries or journal_entries:
+            existing = DBConnection.run_in_transaction(self._ingest_page, doi_entries, journal_entries, check_dois)
+            if check_dois:
+                existence_filter.confirmed(check_dois, existing)
+        if existence_filter is not None:
+            existence_filter.add(doi_entry.doi for doi_entry in doi_entries)
+        logging.info(f"Processed {len(items)} items")
+        return items_processed
 
     # Not used, not yet tested, but potentially handy nonetheless. Delete
     # if not used after major revisions.
@@ -2,9 +2,12 @@ from utils_mixin import Utils
 
 import json
 import os
+import re
 import datetime
 
 from db_connection import DBConnection
+from crossref_metadata import CrossrefMetadata
+from write_behind import WriteBehind
 import logging
 from config import Config
 
@@ -21,44 +24,138 @@ headers = {
 class DoiFactory:
     # TODO: Odd and bad that there are two ways to set up DoiEntry objects. We should use
     # one or the other and enforce it, or at the very least clarify the two cases in comments.
-    def __init__(self, sql):
-        """Initialize an object of the class by executing query, extract the fields from 
-        query results, create a new DoiEntry object, populate the DoiEntry object with
-        the extracted data, add the new DoiEntry object to the results list, and set the 
-        dois attribute of the current object to the results list.
+
+    # "select * from dois [where ...]" with no ORDER BY/LIMIT of its own can be
+    # paged on the primary key; anything else is read in one go
+    _pageable = re.compile(r"^\s*select\s+\*\s+from\s+(?:collections_papers\.)?dois"
+                           r"(?:\s+where\s+(?P<where>.*?))?\s*;?\s*$", re.IGNORECASE | re.DOTALL)
+    _unpageable_clause = re.compile(r"\b(?:limit|order\s+by|group\s+by|union)\b", re.IGNORECASE)
+
+    def __init__(self, sql, args=None, cache=False, chunk_size=1000):
+        """Set up a lazy DOI query. Nothing is read until the factory is
+        iterated or .dois is used.
+
+        Iterating builds DoiRecords on demand. A plain "select * from dois"
+        query is read in chunks of chunk_size rows, in doi order, each chunk
+        starting after the last doi of the one before (keyset paging). Memory
+        stays bounded and no connection is held between chunks, however long
+        the caller spends on each DOI. Other queries are read in one go.
 
         :param sql: The SQL query to fetch DOI-related data.
         :type sql: str
+        :param args: Arguments for the query, defaults to None
+        :type args: list, optional
+        :param cache: Allow the rows to come from the query cache, defaults to False
+        :type cache: bool, optional
+        :param chunk_size: Rows read per query when paging, defaults to 1000
+        :type chunk_size: int, optional
         """
         #  TODO: All this junk probably belongs in doi_database.
-        doi_sql_results = DBConnection.execute_query(sql)
-
-        results = []
-        for cur_doi_json in doi_sql_results:
-            doi = cur_doi_json[0]
-            issn = cur_doi_json[1]
-            published_date = cur_doi_json[2]
-            journal_title = cur_doi_json[3]
-            downloaded = cur_doi_json[4]
-            full_path = cur_doi_json[5]
-            article_title = cur_doi_json[6]
-            new_doi = DoiEntry()
-
-            new_doi.doi = doi
-            new_doi.issn = issn
-            new_doi.published_date = published_date
-            new_doi.journal_title = journal_title
-            new_doi.downloaded = downloaded
-            new_doi.full_path = full_path
-            new_doi.article_title = article_title
-            results.append(new_doi)
-        self.dois = results
+        self.sql = sql
+        self.args = list(args) if args is not None else []
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self._dois = None
+        self._config = None
+        self._pdf_directory = None
+
+    @property
+    def dois(self):
+        """
+        :return: Every matching DOI, loaded on first use
+        :rtype: list[DoiRecord]
+        """
+        if self._dois is None:
+            self._dois = list(self._records())
+        return self._dois
+
+    def __iter__(self):
+        if self._dois is not None:
+            return iter(self._dois)
+        return self._records()
+
+    def count(self):
+        """
+        :return: Number of rows the query matches, without loading them
+        :rtype: int
+        """
+        sql = f"select count(*) from ({self.sql.strip().rstrip(';')}) as counted"
+        return DBConnection.execute_query(sql, self.args or None)[0][0]
+
+    def _record(self, row):
+        if self._config is None:
+            # config.ini is read once per factory, not once per row
+            self._config = Config()
+            self._pdf_directory = self._config.get_string("downloaders", "pdf_directory")
+        record = DoiRecord(row, self._config, self._pdf_directory)
+        pending = WriteBehind.peek('doi_download_status', record.doi)
+        if pending is not None:
+            # the download status hasn't been flushed to the database yet
+            record.downloaded, record.full_path = pending[0], pending[1]
+        return record
+
+    def _records(self):
+        match = DoiFactory._pageable.match(self.sql)
+        if self.cache or match is None or DoiFactory._unpageable_clause.search(self.sql):
+            for row in DBConnection.execute_query(self.sql, self.args or None, cache=self.cache):
+                yield self._record(row)
+            return
+        where = match.group('where')
+        conditions = f"({where}) and doi > %s" if where else "doi > %s"
+        # doi is the whole primary key, so "doi > last" neither skips nor repeats
+        # a row at a chunk boundary
+        sql = f"select * from dois where {conditions} order by doi limit %s"
+        last_doi = ''
+        while True:
+            rows = DBConnection.execute_query(sql, self.args + [last_doi, self.chunk_size])
+            for row in rows:
+                yield self._record(row)
+            if len(rows) < self.chunk_size:
+                return
+            last_doi = rows[-1][0]
+
+    @staticmethod
+    def entry_from_row(cur_doi_json, config=None):
+        """Builds a full DoiEntry from a "select * from dois" result row.
+
+        :param cur_doi_json: One row of the dois table
+        :type cur_doi_json: tuple
+        :param config: Shared configuration, defaults to reading config.ini
+        :type config: Config, optional
+        :return: The populated entry
+        :rtype: DoiEntry
+        """
+        new_doi = DoiEntry(config=config)
+
+        new_doi.doi = cur_doi_json[0]
+        new_doi.issn = cur_doi_json[1]
+        new_doi.published_date = cur_doi_json[2]
+        new_doi.journal_title = cur_doi_json[3]
+        new_doi.downloaded = cur_doi_json[4]
+        new_doi.full_path = cur_doi_json[5]
+        new_doi.article_title = cur_doi_json[6]
+        return new_doi
+
+    @staticmethod
+    def iterate(sql, args=None, fetch_size=1000):
+        """Shorthand for iterating DoiFactory(sql, args, chunk_size=fetch_size).
+
+        :param sql: The SQL query to fetch DOI-related data.
+        :type sql: str
+        :param args: Arguments for the query, defaults to None
+        :type args: list, optional
+        :param fetch_size: Rows read per query, defaults to 1000
+        :type fetch_size: int, optional
+        :return: Iterator of DoiRecord objects
+        :rtype: iterator
+        """
+        return iter(DoiFactory(sql, args, chunk_size=fetch_size))
 
 
 class DoiEntry(Utils):
     # if json is populated
     # Valid setup_type: None, 'download_chunk', 'import_pdfs'
-    def __init__(self, setup_type=None, doi_details=None):
+    def __init__(self, setup_type=None, doi_details=None, insert=True, check_exists=True, config=None):
         """Initialize a DoiEntry object based on the provided setup type and DOI details.
         Will not create a new entry if one already exists, will raise EntityExistsException
 
@@ -66,49 +163,62 @@ class DoiEntry(Utils):
         :type setup_type: str, optional
         :param doi_details: Details related to the DOI, defaults to None.
         :type doi_details: dict, optional
+        :param insert: Write the new entry to the database immediately. Pass False
+            to collect entries and write them together with insert_many(), defaults to True.
+        :type insert: bool, optional
+        :param check_exists: Raise EntryExistsException if the DOI is already in the
+            database. Bulk loads skip the lookup and let the merge drop duplicates, defaults to True.
+        :type check_exists: bool, optional
+        :param config: Shared configuration, defaults to reading config.ini
+        :type config: Config, optional
         :raises ValueError: Raised when an invalid setup_type is provided.
         :raises EntityExistsException: Raised when an attempt is made to create a duplicate entry
 
         """        
-        super().__init__()
+        super().__init__(config)
         self.PDF_DIRECTORY = self.config.get_string("downloaders", "pdf_directory")
         if setup_type == None:
             return
         elif setup_type == 'download_chunk':
-            self._setup(doi_details)
+            self._setup(doi_details, check_exists)
             self.downloaded = False
             self.full_path = None
         elif setup_type == 'import_pdfs':
-            self._setup(doi_details)
+            self._setup(doi_details, check_exists)
             self.downloaded = True
             self.full_path = self.generate_file_path()
         else:
             raise ValueError(f"DoiEntry __init__: Invalid setup_type '{setup_type}'")
-        self.insert_database()
+        if insert:
+            self.insert_database()
 
 
-    def _setup(self, doi_details):
+    def _setup(self, doi_details, check_exists=True):
 
         """Sets up the object and
         checks if DOI is of type "journal-article". If it's not, raise errors.
 
         :param doi_details: decoded json results of DOI from crossref.org
         :type doi_details: dict
+        :param check_exists: Look the DOI up in the database, defaults to True
+        :type check_exists: bool, optional
 
         :raises EntryExistsException: If the length of the DOI string
             in the database is greater than or equal to 1.
         :raises TypeError: if DOI is of type 'journal'.
         :raises TypeError: if DOI is not of type 'journal-article'.
         """
+        self._details = doi_details
         self.issn = doi_details['ISSN'][0]
         self.doi = doi_details['DOI']
         # should be duplicate of ISSN reference, but we'll leave it for now
         self.journal_title = doi_details['container-title'][0]
         # logging.info(f"attempting DOI with New date: {self.get_date()}")
         self.article_title = doi_details['title'][0]
-        if self._check_exists():
+        if check_exists and self._check_exists():
             raise EntryExistsException(self.doi)
-        self.published_date = self._get_date(doi_details)
+        # a DATE column; keep the same type DoiFactory reads back
+        self.published_date = self._get_date(doi_details).date()
         if doi_details['type'] == 'journal':
             raise TypeError("DOI type is 'journal', not 'journal-article'.")
         if doi_details['type'] != "journal-article":
@@ -121,7 +231,44 @@ class DoiEntry(Utils):
         """        
         self.downloaded = True
         self.full_path = self.generate_file_path()
-        self.update_database()
+        # only these two columns change; buffered when [write_behind] is enabled
+        WriteBehind.write('doi_download_status', self.doi, [self.downloaded, self.full_path, self.doi])
+
+    @staticmethod
+    def _write_download_status(rows):
+        DoiEntry._update_status_rows([(doi, downloaded, full_path) for downloaded, full_path, doi in rows])
+
+    @staticmethod
+    def bulk_update_status(entries, batch_size=500):
+        """Writes the downloaded and full_path columns of many DOIs, with one
+        CASE-based UPDATE per batch_size entries instead of one per DOI. The
+        other columns are left alone.
+
+        :param entries: DoiEntry or DoiRecord objects with the new values set
+        :type entries: iterable
+        :param batch_size: Rows per UPDATE statement, defaults to 500
+        :type batch_size: int, optional
+        :return: Number of entries written
+        :rtype: int
+        """
+        rows = [(entry.doi, entry.downloaded, entry.full_path) for entry in entries]
+        DBConnection.run_in_transaction(DoiEntry._update_status_rows, rows, batch_size)
+        return len(rows)
+
+    @staticmethod
+    def _update_status_rows(rows, batch_size=500):
+        # rows: (doi, downloaded, full_path)
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            cases = " ".join(["WHEN %s THEN %s"] * len(batch))
+            sql = f"""UPDATE dois SET
+                         downloaded = CASE doi {cases} END,
+                         full_path = CASE doi {cases} END
+                     WHERE doi IN ({','.join(['%s'] * len(batch))})"""
+            args = [value for doi, downloaded, _ in batch for value in (doi, downloaded)]
+            args += [value for doi, _, full_path in batch for value in (doi, full_path)]
+            args += [doi for doi, _, _ in batch]
+            DBConnection.execute_query(sql, args, prepare=False)
 
     def _check_exists(self):
         """Checks if the length of DOI string in database >= 1.
@@ -130,8 +277,8 @@ class DoiEntry(Utils):
             False if otherwise
         :rtype: bool
         """        
-        query = f"select doi from dois where doi=\"{self.doi}\""
-        results = DBConnection.execute_query(query)
+        query = "select doi from dois where doi = %s"
+        results = DBConnection.execute_query(query, [self.doi])
         # logging.info(f"Check exists query: {query}")
         if len(results) >= 1:
             return True
@@ -163,7 +310,7 @@ class DoiEntry(Utils):
         details  using sql query
         """        
 
-        sql_update = f"""
+        sql_update = """
             UPDATE dois SET 
                 issn = %s,
                 published_date = %s,
@@ -171,7 +318,7 @@ class DoiEntry(Utils):
                 downloaded = %s,
                 full_path = %s,
                 article_title = %s
-            WHERE doi = "{self.doi}"
+            WHERE doi = %s
         """
 
         args = [self.issn,
@@ -179,24 +326,26 @@ class DoiEntry(Utils):
                 self.journal_title,
                 self.downloaded,  # Convert boolean to 1 or 0
                 self.full_path,
-                self.article_title]
+                self.article_title,
+                self.doi]
         # logging.info(f"SQL: {sql_update}")
         DBConnection.execute_query(sql_update, args)
 
-    def insert_database(self):
-        sql_insert = f"""insert into dois (doi,
-                                            issn,
-                                            published_date,
-                                            journal_title,
-                                            downloaded,
-                                            full_path,
-                                            article_title
-                                            )
-                        VALUES (%s, %s, %s, %s, %s, %s, %s)                
-        """
+    INSERT_SQL = """insert into dois (doi,
+                                      issn,
+                                      published_date,
+                                      journal_title,
+                                      downloaded,
+                                      full_path,
+                                      article_title
+                                      )
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """
+
+    def _insert_args(self):
         self.article_title = self.article_title[:8100]
 
-        args = [self.doi,
+        return [self.doi,
                 self.issn,
                 self.published_date,
                 self.journal_title,
@@ -205,10 +354,81 @@ class DoiEntry(Utils):
                 self.article_title
                 ]
 
-
+    def insert_database(self):
         # logging.info(f"SQL insert {sql_insert}")
-        # logging.debug(f"Args: {args}")
-        DBConnection.execute_query(sql_insert, args)
+        DBConnection.execute_query(DoiEntry.INSERT_SQL, self._insert_args())
+
+    @staticmethod
+    def insert_many(doi_entries, ignore_existing=False):
+        """Insert many new entries into the dois table using multi-row inserts,
+        one round trip and one commit per batch.
+
+        :param doi_entries: Entries created with insert=False
+        :type doi_entries: list[DoiEntry]
+        :param ignore_existing: INSERT IGNORE, so a row whose key already exists
+            is skipped instead of failing the batch, defaults to False
+        :type ignore_existing: bool, optional
+        """
+        rows = [doi_entry._insert_args() for doi_entry in doi_entries]
+        sql = DoiEntry.INSERT_SQL
+        if ignore_existing:
+            sql = sql.replace("insert into", "insert ignore into", 1)
+        if rows:
+            DBConnection.execute_many(sql, rows)
+
+    @staticmethod
+    def upsert_many(doi_entries):
+        """Insert new entries and refresh the crossref fields (issn, date and
+        titles) of existing ones, in multi-row statements. The download status
+        and file path of existing rows are kept.
+
+        :param doi_entries: Entries created with insert=False
+        :type doi_entries: list[DoiEntry]
+        """
+        rows = [doi_entry._insert_args() for doi_entry in doi_entries]
+        sql = DoiEntry.INSERT_SQL + """ ON DUPLICATE KEY UPDATE issn = VALUES(issn),
+                                                   published_date = VALUES(published_date),
+                                                   journal_title = VALUES(journal_title),
+                                                   article_title = VALUES(article_title)"""
+        if rows:
+            DBConnection.execute_many(sql, rows)
+
+    @staticmethod
+    def existing_dois(dois, batch_size=1000):
+        """Set-based version of _check_exists.
+
+        :param dois: DOI strings to look up
+        :type dois: list[str]
+        :param batch_size: DOIs per IN (...) query, defaults to 1000
+        :type batch_size: int, optional
+        :return: Those of the DOIs already in the dois table
+        :rtype: set
+        """
+        dois = list(dois)
+        existing = set()
+        for start in range(0, len(dois), batch_size):
+            batch = dois[start:start + batch_size]
+            query = f"select doi from dois where doi in ({','.join(['%s'] * len(batch))})"
+            existing.update(row[0] for row in DBConnection.execute_query(query, batch, prepare=False))
+        return existing
+
+    def _get_details(self):
+        # unset until found, which also survives pickling to a worker; a miss
+        # isn't kept, so metadata written later is still picked up
+        try:
+            return self._details
+        except AttributeError:
+            details = CrossrefMetadata.get(self.doi)
+            if details is not None:
+                self._details = details
+            return details
+
+    def _set_details(self, details):
+        self._details = details
+
+    # crossref item for this DOI, read from crossref_metadata on first use;
+    # None if it was ingested before metadata was kept
+    details = property(_get_details, _set_details)
 
     def get_journal(self):
         """Retrieve the title of the journal associated with this object.
@@ -337,5 +557,57 @@ class DoiEntry(Utils):
         print(self)
 
 
+class DoiRecord(object):
+    """A dois row as read by DoiFactory: the same fields and read methods
+    as DoiEntry, without re-reading config.ini for every row. Fields can be
+    changed in memory (check_and_update_file_path_variables does); anything
+    that writes to the database promotes the record to a full DoiEntry first.
+    """
+    __slots__ = ('doi', 'issn', 'published_date', 'journal_title', 'downloaded', 'full_path', 'article_title',
+                 'config', 'PDF_DIRECTORY', '_details')
+
+    def __init__(self, row, config, pdf_directory):
+        """
+        :param row: One "select * from dois" result row
+        :type row: tuple
+        :param config: Configuration shared by every record from the same query
+        :type config: Config
+        :param pdf_directory: [downloaders] pdf_directory, resolved once per query
+        :type pdf_directory: str
+        """
+        (self.doi, self.issn, self.published_date, self.journal_title,
+         self.downloaded, self.full_path, self.article_title) = row[:7]
+        self.config = config
+        self.PDF_DIRECTORY = pdf_directory
+
+    details = DoiEntry.details
+    get_journal = DoiEntry.get_journal
+    get_downloaded_status = DoiEntry.get_downloaded_status
+    get_date = DoiEntry.get_date
+    get_title = DoiEntry.get_title
+    generate_file_path = DoiEntry.generate_file_path
+    check_and_update_file_path_variables = DoiEntry.check_and_update_file_path_variables
+    get_filename_from_doi_entry = Utils.get_filename_from_doi_entry
+
+    def promote(self):
+        """
+        :return: A full DoiEntry with this record's current field values
+        :rtype: DoiEntry
+        """
+        return DoiFactory.entry_from_row([self.doi, self.issn, self.published_date, self.journal_title,
+                                          self.downloaded, self.full_path, self.article_title], self.config)
+
+    def mark_successful_download(self):
+        self.promote().mark_successful_download()
+        self.downloaded = True
+        self.full_path = self.generate_file_path()
+
+    def update_database(self):
+        self.promote().update_database()
+
+
+WriteBehind.register('doi_download_status', DoiEntry._write_download_status)
+
+
 class EntryExistsException(Exception):
     pass
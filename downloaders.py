@@ -6,6 +6,7 @@ from datetime import datetime
 import logging
 import random
 from doi_entry import DoiEntry
+from write_behind import WriteBehind
 
 
 class Downloaders:
@@ -56,17 +57,20 @@ class Downloaders:
         If the download is successful, the DOI entry is marked as a successful download using
         the `mark_successful_download` method.
 
-        :param doi_list: A list of DOIEntry objects representing the DOI entries to be downloaded.
-        :type doi_list: List[DOIEntry]
+        :param doi_list: DOI entries to be downloaded. Any iterable; a lazy one is
+            consumed as it goes unless randomize_download_order needs the whole list.
+        :type doi_list: Iterable[DOIEntry]
         """        
         randomize = self.config.get_boolean("downloaders","randomize_download_order")
         if randomize:
+            doi_list = list(doi_list)
             random.shuffle(doi_list)
 
         for doi_entry in doi_list:
         # logging.warning(f"journal:{doi_entry.journal_title} not found: {doi_entry.not_found_count} doi: {doi_entry.doi}")
             if self.download(doi_entry):
                 doi_entry.mark_successful_download()
+        WriteBehind.flush_pending()
 
 
 
@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import math
+import time
+from db_connection import DBConnection
+
+
+class BloomFilter(object):
+    """Set membership in a fixed bit array: no false negatives, false
+    positives at about error_rate once capacity items have been added.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        :param capacity: Expected number of items
+        :type capacity: int
+        :param error_rate: Acceptable false positive rate at capacity, defaults to 0.001
+        :type error_rate: float, optional
+        """
+        capacity = max(capacity, 1)
+        self.bit_count = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(self.bit_count / capacity * math.log(2))))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # double hashing: position i is h1 + i * h2, from one 128 bit digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.bit_count for i in range(self.hash_count))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        # repeats are counted too, which only overstates the error rate
+        self.count += 1
+
+    def false_positive_rate(self):
+        """
+        :return: Chance that an item never added tests positive, at the current fill
+        :rtype: float
+        """
+        return (1 - math.exp(-self.hash_count * self.count / self.bit_count)) ** self.hash_count
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class DoiExistenceFilter(object):
+    """The DOIs already stored for one ISSN and year range, loaded with one
+    query so that crossref ingest can drop known DOIs without a lookup per
+    page. Up to set_limit DOIs are held in a set; above that in a Bloom
+    filter.
+
+    A Bloom filter match is trusted while the expected number of new DOIs
+    it has wrongly matched stays within false_positive_budget. Each DOI the
+    filter reports as new adds its odds of having been a false positive
+    had it been new and matched. Once the budget is spent, a page's matches
+    are returned for confirmation instead, which the caller folds into the
+    lookup it makes for the page anyway. A re-harvest, where nearly every
+    DOI is already stored, spends almost nothing and so needs no lookups.
+
+    DOIs stored under another ISSN or outside the window aren't in the
+    filter; they are reported as new and the INSERT IGNORE on ingest skips
+    them.
+    """
+
+    def __init__(self, members, exact, false_positive_budget=1.0):
+        """
+        :param members: A set of DOIs, or a BloomFilter over them
+        :param exact: True if members is a set
+        :type exact: bool
+        :param false_positive_budget: Expected new DOIs a Bloom filter may drop
+            unconfirmed; 0 confirms every match. Defaults to 1.0
+        :type false_positive_budget: float, optional
+        """
+        self.members = members
+        self.exact = exact
+        self.false_positive_budget = false_positive_budget
+        self.expected_false_positives = 0.0
+        self.stats = {'known': 0, 'confirmed': 0, 'false_positives': 0, 'new': 0}
+
+    @classmethod
+    def load(cls, issn, start_year, end_year, set_limit, error_rate=0.001, false_positive_budget=1.0):
+        """
+        :param issn: Journal ISSN
+        :type issn: str
+        :param start_year: First published year
+        :type start_year: int
+        :param end_year: Last published year
+        :type end_year: int
+        :param set_limit: Most DOIs to hold in an exact set
+        :type set_limit: int
+        :param error_rate: Bloom filter false positive rate, defaults to 0.001
+        :type error_rate: float, optional
+        :param false_positive_budget: See DoiExistenceFilter, defaults to 1.0
+        :type false_positive_budget: float, optional
+        :return: The filter
+        :rtype: DoiExistenceFilter
+        """
+        start = time.time()
+        args = [issn, f"{start_year}-01-01", f"{end_year}-12-31"]
+        where = "where issn = %s and published_date BETWEEN %s AND %s"
+        count = DBConnection.execute_query(f"select count(*) from dois {where}", args)[0][0]
+        dois = (row[0] for row in DBConnection.iter_query(f"select doi from dois {where}", args, fetch_size=10000))
+        if count <= set_limit:
+            existence_filter = cls(set(dois), exact=True, false_positive_budget=false_positive_budget)
+        else:
+            members = BloomFilter(count, error_rate)
+            for doi in dois:
+                members.add(doi)
+            existence_filter = cls(members, exact=False, false_positive_budget=false_positive_budget)
+        logging.info(f"Loaded {count} existing DOIs for {issn} {start_year}-{end_year} into "
+                     f"{'a set' if existence_filter.exact else 'a Bloom filter'} in {time.time() - start:.1f}s")
+        return existence_filter
+
+    def classify(self, dois):
+        """Splits a page's DOIs by what the filter knows about them.
+
+        :param dois: DOI strings
+        :type dois: list[str]
+        :return: The DOIs known to be stored, and the matches that still have
+            to be looked up (see confirmed); any other DOI is new
+        :rtype: tuple(set, list[str])
+        """
+        candidates = [doi for doi in dois if doi in self.members]
+        unconfirmed = []
+        if not self.exact and candidates:
+            rate = self.members.false_positive_rate()
+            # odds that a new DOI would have matched, times the DOIs found new
+            expected = (len(dois) - len(candidates)) * rate / (1 - rate)
+            spent = self.expected_false_positives + expected
+            if 0 < self.false_positive_budget and spent <= self.false_positive_budget:
+                self.expected_false_positives = spent
+            else:
+                unconfirmed, candidates = candidates, []
+        self.stats['known'] += len(candidates)
+        self.stats['new'] += len(dois) - len(candidates) - len(unconfirmed)
+        return set(candidates), unconfirmed
+
+    def confirmed(self, unconfirmed, existing):
+        """Records the result of looking up the matches classify() returned.
+
+        :param unconfirmed: The DOIs that were looked up
+        :type unconfirmed: list[str]
+        :param existing: Those of them found stored
+        :type existing: set
+        """
+        self.stats['confirmed'] += len(unconfirmed)
+        self.stats['false_positives'] += len(unconfirmed) - len(existing)
+        self.stats['known'] += len(existing)
+        self.stats['new'] += len(unconfirmed) - len(existing)
+
+    def add(self, dois):
+        """Records DOIs that have just been stored.
+
+        :param dois: DOI strings
+        :type dois: iterable
+        """
+        for doi in dois:
+            self.members.add(doi)
@@ -14,8 +14,8 @@ class KnownGoodPapers():
 
     def _build_title_doi_map(self, start_year, end_year):
         self.doi_title_map = {}
-        sql = f"select * from dois where published_date BETWEEN \'{start_year}-01-01\' AND \'{end_year}-12-31\'"
-        dois = DoiFactory(sql).dois
+        sql = "select * from dois where published_date BETWEEN %s AND %s"
+        dois = DoiFactory(sql, [f"{start_year}-01-01", f"{end_year}-12-31"])
         for doi_entry in dois:
             doi_title = self.clean_html(doi_entry.get_title())
             self.doi_title_map[doi_entry.doi] = doi_title
@@ -58,16 +58,16 @@ class KnownGoodPapers():
         return matched_dois
 
     def _get_title_association(self,title):
-        query = f"select title from associations where title=\"{title}\""
-        results = DBConnection.execute_query(query)
+        query = "select title from associations where title = %s"
+        results = DBConnection.execute_query(query, [title])
         # logging.info(f"Check exists query: {query}")
         if len(results) >= 1:
             return results
         return None
 
     def _check_association_doi_exists(self,doi):
-        query = f"select doi from associations where doi=\"{doi}\""
-        results = DBConnection.execute_query(query)
+        query = "select doi from associations where doi = %s"
+        results = DBConnection.execute_query(query, [doi])
         # logging.info(f"Check exists query: {query}")
         if len(results) >= 1:
             return True
@@ -82,7 +82,7 @@ class KnownGoodPapers():
                 sql_insert = f"INSERT INTO associations (doi, title) VALUES (%s, %s)"
                 args = [doi, title]
             else:
-                sql_insert = f"INSERT INTO associations (title) VALUES (?)"
+                sql_insert = f"INSERT INTO associations (title) VALUES (%s)"
                 args = [title]
             DBConnection.execute_query(sql_insert, args)
         except Exception as e:
@@ -10,6 +10,7 @@ from config import Config
 from downloaders import Downloaders
 from copyout import CopyOut
 from crossref_journal_entry import CrossrefJournalEntry
+from write_behind import WriteBehind
 import journal_finder
 import logging
 
@@ -29,11 +30,11 @@ def download_single_doi(doi):
     Limitations here: if doi specified is shown 
     """
     logging.info("Single DOI download mode")
-    select_doi = f"""select * from dois where doi='{doi}'"""
-    doif = DoiFactory(select_doi)
+    select_doi = """select * from dois where doi = %s"""
+    doif = DoiFactory(select_doi, [doi], cache=True)
     doi_list = doif.dois
     if len(doi_list) == 0:
-        logging.critical(f"Single download failed - DOI not in system: {select_doi} ")
+        logging.critical(f"Single download failed - DOI not in system: {doi} ")
         raise ValueError("DOI not found in the system")
         # above line used to be "sys.exit(1)", but it prevents sphinx autodoc from working
 
@@ -69,6 +70,7 @@ def retry_failed_unpaywall_links(config):
     for doi_entry in doi_list:
         if downloaders.download(doi_entry):
             doi_entry.mark_successful_download()
+    WriteBehind.flush_pending()
 
 
 #  More may need to be added here; this is for efficency;
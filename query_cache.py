@@ -0,0 +1,194 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+
+class QueryCache(object):
+    """In-process LRU cache of SELECT results, for the small lookups that run
+    over and over (journal titles, single-DOI rows, unpaywall rows).
+
+    Entries expire after a per-table TTL; a query over several tables uses
+    the shortest. Every table also has a generation number that is bumped
+    whenever this process writes to it. An entry remembers the generations
+    it was read at and is ignored once any of them moves on, so local
+    writes invalidate immediately and in O(1). Writes made by other
+    processes or containers are only picked up when the TTL runs out, so
+    keep TTLs short for tables that other workers update.
+    """
+
+    _from_clause = re.compile(r"\bfrom\s+(.+?)(?=\bwhere\b|\bgroup\b|\border\b|\blimit\b|\bhaving\b"
+                              r"|\b(?:left|right|inner|outer|cross|straight)?\s*join\b|\)|;|$)",
+                              re.IGNORECASE | re.DOTALL)
+    _join_table = re.compile(r"\bjoin\s+([\w.`]+)", re.IGNORECASE)
+    _write_table = re.compile(r"^\s*(?:insert(?:\s+(?:or\s+)?ignore)?\s+into|replace\s+into|update|delete\s+from"
+                              r"|truncate(?:\s+table)?|drop\s+table(?:\s+if\s+exists)?|alter\s+table"
+                              r"|create\s+table(?:\s+if\s+not\s+exists)?|create\s+(?:unique\s+)?index\s+\w+\s+on)"
+                              r"\s+([\w.`]+)",
+                              re.IGNORECASE)
+
+    def __init__(self, max_entries=10000, default_ttl_seconds=60, table_ttls=None):
+        """
+        :param max_entries: Results kept before the least recently used is dropped, defaults to 10000
+        :type max_entries: int, optional
+        :param default_ttl_seconds: TTL for tables not listed in table_ttls, defaults to 60
+        :type default_ttl_seconds: float, optional
+        :param table_ttls: Per-table TTL in seconds, defaults to None
+        :type table_ttls: dict, optional
+        """
+        self.max_entries = max_entries
+        self.default_ttl_seconds = default_ttl_seconds
+        self.table_ttls = dict(table_ttls or {})
+        # (query, args) -> (expires, ((table, generation), ...), rows)
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0,
+                      'misses': 0,
+                      'expired': 0,
+                      'invalidated': 0,
+                      'evictions': 0}
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _table_name(name):
+        # collections_papers.dois -> dois
+        return name.strip('`').split('.')[-1].strip('`').lower()
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def tables_read(query):
+        """
+        :param query: A SELECT statement
+        :type query: str
+        :return: The tables it reads from
+        :rtype: frozenset
+        """
+        tables = set()
+        for table_list in QueryCache._from_clause.findall(query):
+            for item in table_list.split(','):
+                words = item.split()
+                if words and not words[0].startswith('('):
+                    tables.add(QueryCache._table_name(words[0]))
+        for table in QueryCache._join_table.findall(query):
+            tables.add(QueryCache._table_name(table))
+        return frozenset(tables)
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def table_written(query):
+        """
+        :param query: Any statement
+        :type query: str
+        :return: The table a write statement modifies, or None for reads
+        :rtype: str or None
+        """
+        match = QueryCache._write_table.match(query)
+        if match is None:
+            return None
+        return QueryCache._table_name(match.group(1))
+
+    @staticmethod
+    def _key(query, args):
+        return query, tuple(args) if args is not None else None
+
+    def snapshot(self, query):
+        """Table generations to pass to put(). Take it before running the
+        query: a write that lands while the query runs then makes the stored
+        result stale at once instead of leaving it cached.
+
+        :param query: The SELECT about to run
+        :type query: str
+        :return: ((table, generation), ...)
+        :rtype: tuple
+        """
+        with self._lock:
+            return tuple((table, self._generations.get(table, 0))
+                         for table in QueryCache.tables_read(query))
+
+    def get(self, query, args):
+        """
+        :return: (True, rows) on a hit, (False, None) on a miss
+        :rtype: tuple
+        """
+        key = QueryCache._key(query, args)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return False, None
+            expires, generations, rows = entry
+            if time.monotonic() >= expires:
+                del self._entries[key]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return False, None
+            for table, generation in generations:
+                if self._generations.get(table, 0) != generation:
+                    del self._entries[key]
+                    self.stats['invalidated'] += 1
+                    self.stats['misses'] += 1
+                    return False, None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return True, list(rows)
+
+    def put(self, query, args, rows, generations):
+        """
+        :param rows: The SELECT's result
+        :type rows: list
+        :param generations: What snapshot(query) returned before the query ran
+        :type generations: tuple
+        """
+        if not generations:
+            # couldn't tell which tables it reads; never safe to cache
+            return
+        ttl = min(self.table_ttls.get(table, self.default_ttl_seconds) for table, _ in generations)
+        if ttl <= 0:
+            return
+        key = QueryCache._key(query, args)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, generations, tuple(rows))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, query):
+        """Marks cached reads of the table a write statement modifies as stale.
+
+        :param query: A statement that was just executed
+        :type query: str
+        :return: The table written, or None if the statement wasn't a write
+        :rtype: str or None
+        """
+        table = QueryCache.table_written(query)
+        if table is not None:
+            self.invalidate_table(table)
+        return table
+
+    def invalidate_table(self, table):
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """
+        :return: Counters plus current size and hit rate
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._entries)
+            stats['max_entries'] = self.max_entries
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
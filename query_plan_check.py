@@ -0,0 +1,337 @@
+import argparse
+import contextlib
+import datetime
+import io
+import logging
+import random
+import re
+import sys
+from config import Config
+from db_connection import DBConnection
+from sql_profiler import SqlProfiler
+from doi_database import DoiDatabase
+from database_report import DatabaseReport
+from doi_catalog import DoiCatalog
+from existence_filter import DoiExistenceFilter
+from validator import Validator, Match
+from copyout import CopyOut
+from scan import Scan
+from doi_entry import DoiFactory
+from unpaywall_downloader import UnpaywallDownloader
+
+
+class StatementRecorder(object):
+    """Stands in for DBConnection.profiler while a code path runs, keeping
+    every statement it executes. A configured SqlProfiler still gets them.
+    """
+
+    def __init__(self, profiler=None):
+        self.profiler = profiler
+        self.statements = []
+
+    def record(self, query, args, seconds, rows):
+        self.statements.append((query, args))
+        if self.profiler is not None:
+            self.profiler.record(query, args, seconds, rows)
+
+
+class SyntheticDataset(object):
+    """Deterministic fake collection: DOIs spread evenly over journals and
+    years, half of them downloaded, with scans, found lines, unpaywall
+    attempts and matches in roughly production proportions.
+    """
+
+    PREFIX = '10.99999/plan-check.'
+    FIRST_YEAR = 2000
+    YEARS = 25
+    JOURNALS = 200
+    LINES_PER_SCAN = 3
+
+    def __init__(self, doi_count):
+        self.doi_count = doi_count
+        self.issns = [f"9999-{index:04d}" for index in range(SyntheticDataset.JOURNALS)]
+        self.last_year = SyntheticDataset.FIRST_YEAR + SyntheticDataset.YEARS - 1
+        # a year in the middle, so ranges on both sides have data
+        self.year = SyntheticDataset.FIRST_YEAR + SyntheticDataset.YEARS // 2
+        self.rows_per_year = doi_count // SyntheticDataset.YEARS
+        self.rows_per_journal_year = max(1, self.rows_per_year // SyntheticDataset.JOURNALS)
+
+    def doi(self, index):
+        return f"{SyntheticDataset.PREFIX}{index:08d}"
+
+    def loaded_count(self):
+        sql = "select count(*) from dois where doi like %s"
+        return DBConnection.execute_query(sql, [SyntheticDataset.PREFIX + '%'])[0][0]
+
+    def has_foreign_rows(self):
+        sql = "select doi from dois where doi not like %s limit 1"
+        return len(DBConnection.execute_query(sql, [SyntheticDataset.PREFIX + '%'])) > 0
+
+    def load(self, batch_rows=5000):
+        """Inserts the dataset; rows that are already there are kept."""
+        rng = random.Random(42)
+        dois, scans, lines, unpaywall, matches = [], [], [], [], []
+        for index in range(self.doi_count):
+            doi = self.doi(index)
+            issn = self.issns[index % SyntheticDataset.JOURNALS]
+            year = SyntheticDataset.FIRST_YEAR + (index // SyntheticDataset.JOURNALS) % SyntheticDataset.YEARS
+            published_date = datetime.date(year, 1 + index % 12, 1 + index % 28)
+            downloaded = index % 2 == 0
+            full_path = f"./pdf/{issn}/{year}/{doi.replace('/', '_')}.pdf" if downloaded else None
+            dois.append([doi, issn, published_date, f"Journal {issn}", downloaded, full_path, f"Article {index}"])
+            if downloaded and index % 4 == 0:
+                score = rng.randint(-100, 900)
+                scans.append([doi, full_path[:-3] + 'txt', score, False, f"Article {index}"])
+                for line in range(SyntheticDataset.LINES_PER_SCAN):
+                    lines.append([doi, f"line {line} of {doi}", rng.randint(0, 300), 'CAS'])
+                if index % 40 == 0:
+                    matches.append([doi, 'botany', index % 80 == 0, published_date, '', None])
+            elif not downloaded:
+                open_url = f"https://example.org/{index}.pdf" if index % 3 == 0 else None
+                unpaywall.append([doi, open_url, datetime.datetime(year, 6, 1), None, 404 if index % 5 == 0 else None,
+                                  open_url is None])
+        tables = [("insert ignore into dois (doi, issn, published_date, journal_title, downloaded, full_path, "
+                   "article_title) values (%s, %s, %s, %s, %s, %s, %s)", dois),
+                  ("insert ignore into scans (doi, textfile_path, score, cannot_convert, title) "
+                   "values (%s, %s, %s, %s, %s)", scans),
+                  ("insert into found_scan_lines (doi, line, score, matched_string) values (%s, %s, %s, %s)", lines),
+                  ("insert ignore into unpaywall_downloader (doi, open_url, most_recent_attempt, "
+                   "most_recent_firefox_failure, error_code, not_available) values (%s, %s, %s, %s, %s, %s)",
+                   unpaywall),
+                  ("insert ignore into matches (doi, collection, `skip`, date_added, notes, digital_only) "
+                   "values (%s, %s, %s, %s, %s, %s)", matches),
+                  ("insert ignore into journals (issn, name, type) values (%s, %s, %s)",
+                   [[issn, f"Journal {issn}", 'print'] for issn in self.issns])]
+        # found_scan_lines has no key to ignore duplicates on
+        DBConnection.execute_query("delete from found_scan_lines where doi like %s", [SyntheticDataset.PREFIX + '%'])
+        for sql, rows in tables:
+            logging.info(f"Loading {len(rows)} rows: {sql.split('(')[0].strip()}")
+            DBConnection.execute_many(sql, rows, batch_size=batch_rows)
+
+
+class PlanCheck(object):
+    """One hot code path and what its statements may cost.
+
+    run() exercises the application code; every SELECT, UPDATE and DELETE
+    it executes is explained. The check fails if a plan reads a whole table
+    that isn't listed in allow_scan (by the name or alias the plan shows),
+    or, on MySQL, if the estimated rows examined exceed max_rows.
+    """
+
+    def __init__(self, name, run, max_rows, allow_scan=()):
+        self.name = name
+        self.run = run
+        self.max_rows = max_rows
+        self.allow_scan = set(allow_scan)
+
+    def problems(self, unexpected, examined):
+        """
+        :param unexpected: Tables read in full that allow_scan doesn't list
+        :type unexpected: set
+        :param examined: Estimated rows examined, None where the database gives no estimate
+        :type examined: int or None
+        :return: What is over budget, empty if nothing
+        :rtype: list[str]
+        """
+        problems = []
+        if unexpected:
+            problems.append(f"full scan of {', '.join(sorted(unexpected))}")
+        if examined is not None and examined > self.max_rows:
+            problems.append(f"~{examined} rows examined, budget {self.max_rows}")
+        return problems
+
+
+class QueryPlanChecker(object):
+    """Guards against statements that stop using an index. Loads a
+    synthetic dataset into the configured database, runs each hot code
+    path, explains the statements it issued and compares the plans against
+    per-path budgets. Exits non-zero if any plan is over budget, so it can
+    gate a deploy.
+
+    Run it against a scratch database only (e.g. database_backend: sqlite
+    with its own sqlite_path in vm/vm_passwords.yml): it refuses to load
+    into a dois table that holds anything but synthetic rows.
+
+        python query_plan_check.py --dois 300000
+
+    tests/test_query_plans.py runs the same checks on a few thousand DOIs in
+    a temporary SQLite database, so a plan regression also fails pytest. Its
+    row budgets only run against MySQL (see tests/conftest.py).
+
+    SQLite's EXPLAIN QUERY PLAN has no row estimates, so there only the
+    full-scan rule applies.
+    """
+
+    _explainable = re.compile(r"^\s*(select|update|delete)\b", re.IGNORECASE)
+    _sqlite_scan = re.compile(r"^SCAN (?:TABLE )?(\S+)")
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.config = Config()
+        self.doi_db = DoiDatabase(self.config)
+        UnpaywallDownloader.create_tables()
+
+    def checks(self):
+        data = self.dataset
+        issn = data.issns[len(data.issns) // 2]
+        year = data.year
+        doi = data.doi(data.doi_count // 2 - (data.doi_count // 2) % 4)
+        missing_doi = SyntheticDataset.PREFIX + 'missing'
+        per_journal_year = data.rows_per_journal_year * 10
+
+        def select_dois(start_year, end_year, journal_issn, downloaded):
+            DoiFactory(*self.doi_db.generate_select_sql(start_year, end_year, journal_issn, downloaded)).dois
+
+        def journal_report():
+            report = DatabaseReport(self.doi_db, year, year, issn=issn, catalog=DoiCatalog.load(year, year, issn))
+            report.report(issn=issn, summary=False)
+            report._get_downloaded(issn)
+            report._get_not_downloaded(issn)
+            report._get_unpaywall_has_err_code(issn)
+            report._get_unpaywall_failed_download(issn)
+
+        def summary_report():
+            report = DatabaseReport(self.doi_db, year, year)
+            report._get_downloaded()
+            report._get_not_downloaded()
+
+        def scan_lines():
+            Match(doi, 0, '', None, None).generate_notes()
+            Scan.clear_db_entry(missing_doi)
+
+        def copy_out_lookups():
+            copy_out = CopyOut(year, self.config)
+            copy_out.generate_file_path(doi)
+            copy_out.get_textfile_path(doi)
+
+        def audit():
+            validator = Validator()
+            DBConnection.execute_query(validator.audit_sql(year, year))
+
+        return [
+            PlanCheck("dois to download for one journal and year",
+                      lambda: select_dois(year, year, issn, False), per_journal_year),
+            PlanCheck("downloaded dois for one year, paged for scanning",
+                      lambda: next(iter(DoiFactory(*self.doi_db.generate_select_sql(year, year, None, True),
+                                                   chunk_size=500)), None),
+                      data.rows_per_year * 2),
+            PlanCheck("is a journal year downloaded",
+                      lambda: self.doi_db._is_year_downloaded(issn, year), per_journal_year),
+            PlanCheck("existing dois for one journal and year, before ingest",
+                      lambda: DoiExistenceFilter.load(issn, year, year, set_limit=per_journal_year),
+                      per_journal_year),
+            PlanCheck("single doi lookups",
+                      copy_out_lookups, 10),
+            PlanCheck("found_scan_lines by doi",
+                      scan_lines, SyntheticDataset.LINES_PER_SCAN * 10),
+            PlanCheck("report for one journal and year",
+                      journal_report, per_journal_year * 2),
+            # summary counts and the catalog over a year: reading the whole year
+            # is expected, scores are looked up by scans' primary key
+            PlanCheck("summary report for one year",
+                      summary_report, data.doi_count, allow_scan=['dois']),
+            # candidates are driven from the (much smaller) scans table
+            PlanCheck("audit candidates for one year",
+                      audit, data.doi_count, allow_scan=['scans']),
+            PlanCheck("copy-out matches for one year",
+                      lambda: CopyOut(year, self.config).get_matches(), data.doi_count // 10, allow_scan=['matches']),
+        ]
+
+    def record(self, run):
+        """
+        :return: The explainable statements run() executed, one per distinct fingerprint
+        :rtype: list
+        """
+        recorder = StatementRecorder(DBConnection.profiler)
+        DBConnection.profiler = recorder
+        if DBConnection.query_cache is not None:
+            DBConnection.query_cache.clear()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                run()
+        finally:
+            DBConnection.profiler = recorder.profiler
+        statements = {}
+        for query, args in recorder.statements:
+            if QueryPlanChecker._explainable.match(query):
+                statements.setdefault(SqlProfiler.fingerprint(query), (query, args))
+        return list(statements.values())
+
+    def explain(self, query, args):
+        """
+        :return: (tables read in full, estimated rows examined or None, plan lines)
+        :rtype: tuple
+        """
+        if DBConnection.get_backend().name == 'sqlite':
+            plan = DBConnection.execute_query("EXPLAIN QUERY PLAN " + query, args)
+            details = [row[3] for row in plan]
+            scans = set()
+            for detail in details:
+                match = QueryPlanChecker._sqlite_scan.match(detail)
+                if match is not None and match.group(1) not in ('CONSTANT', 'SUBQUERY'):
+                    scans.add(match.group(1))
+            return scans, None, details
+        # id, select_type, table, partitions, type, possible_keys, key, key_len, ref, rows, filtered, Extra
+        plan = DBConnection.execute_query("EXPLAIN " + query, args)
+        scans = set()
+        examined = 0
+        join_rows = {}
+        for row in plan:
+            select_id, table, access, key, rows = row[0], row[2], row[4], row[6], row[9] or 0
+            if table is not None and not table.startswith('<') and access in ('ALL', 'index'):
+                scans.add(table)
+            # nested loop: each table is read once per row of the tables before it
+            join_rows[select_id] = join_rows.get(select_id, 1) * max(int(rows), 1)
+            examined += join_rows[select_id]
+        details = [f"{row[2]}: type={row[4]} key={row[6]} rows={row[9]} {row[11] or ''}" for row in plan]
+        return scans, examined, details
+
+    def plans(self, check):
+        """
+        :param check: The code path to check
+        :type check: PlanCheck
+        :return: (statement fingerprint, tables read in full that allow_scan
+            doesn't list, estimated rows examined or None, plan lines) for each
+            statement it executed
+        :rtype: list
+        """
+        results = []
+        for query, args in self.record(check.run):
+            scans, examined, details = self.explain(query, args)
+            results.append((SqlProfiler.fingerprint(query), scans - check.allow_scan, examined, details))
+        return results
+
+    def run(self):
+        """
+        :return: Number of failed checks
+        :rtype: int
+        """
+        failures = 0
+        for check in self.checks():
+            for statement, unexpected, examined, details in self.plans(check):
+                problems = check.problems(unexpected, examined)
+                if problems:
+                    failures += 1
+                    logging.error(f"FAIL {check.name}: {'; '.join(problems)}\n  {statement}\n  " +
+                                  "\n  ".join(details))
+                else:
+                    logging.info(f"ok   {check.name}: {statement[:100]}")
+        return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the query plans of the hot SQL statements")
+    parser.add_argument('--dois', type=int, default=300000, help="synthetic DOIs to load")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    dataset = SyntheticDataset(args.dois)
+    checker = QueryPlanChecker(dataset)
+    if dataset.has_foreign_rows():
+        logging.error("dois holds rows that aren't synthetic; point vm_passwords.yml at a scratch database")
+        sys.exit(2)
+    if dataset.loaded_count() < args.dois:
+        dataset.load()
+    failed = checker.run()
+    logging.info(f"{failed} statement(s) over budget")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,157 @@
+import logging
+import re
+import threading
+import time
+import requests
+
+
+class RateLimiter(object):
+    """A token bucket plus a concurrency limit, shared by every thread that
+    talks to one API (crossref).
+
+    The bucket starts at DEFAULT_LIMIT requests per DEFAULT_INTERVAL and
+    follows the X-Rate-Limit-Limit / X-Rate-Limit-Interval headers of each
+    response. Concurrency adapts to the API's health: it halves when the
+    average response time rises above slow_seconds or on a 429, and grows
+    by one after success_streak fast responses in a row, up to
+    max_concurrency.
+    """
+
+    DEFAULT_LIMIT = 5
+    DEFAULT_INTERVAL = 1.0
+    # weight of the newest response in the average response time
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, max_concurrency, slow_seconds=4.0, success_streak=10):
+        """
+        :param max_concurrency: Most requests in flight at once
+        :type max_concurrency: int
+        :param slow_seconds: Average response time above which concurrency
+            is cut, defaults to 4.0
+        :type slow_seconds: float, optional
+        :param success_streak: Fast responses in a row before concurrency
+            grows again, defaults to 10
+        :type success_streak: int, optional
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.slow_seconds = slow_seconds
+        self.success_streak = success_streak
+        self.concurrency = self.max_concurrency
+        self.rate = RateLimiter.DEFAULT_LIMIT / RateLimiter.DEFAULT_INTERVAL
+        self.capacity = float(RateLimiter.DEFAULT_LIMIT)
+        self.tokens = self.capacity
+        self.latency = None
+        self.stats = {'requests': 0, 'waited_seconds': 0.0, 'throttled': 0}
+        self._in_flight = 0
+        self._streak = 0
+        self._refilled = time.monotonic()
+        self._condition = threading.Condition()
+
+    def get(self, url, **kwargs):
+        """requests.get under the limiter.
+
+        :param url: The URL
+        :type url: str
+        :return: The response
+        :rtype: requests.Response
+        """
+        self.acquire()
+        start = time.monotonic()
+        response = None
+        try:
+            response = requests.get(url, **kwargs)
+            return response
+        finally:
+            self.release(response, time.monotonic() - start)
+
+    def acquire(self):
+        """Waits for a concurrency slot and a token."""
+        start = time.monotonic()
+        with self._condition:
+            while True:
+                self._refill()
+                if self._in_flight < self.concurrency and self.tokens >= 1:
+                    break
+                if self._in_flight >= self.concurrency:
+                    self._condition.wait()
+                else:
+                    self._condition.wait((1 - self.tokens) / self.rate)
+            self.tokens -= 1
+            self._in_flight += 1
+            self.stats['requests'] += 1
+            self.stats['waited_seconds'] += time.monotonic() - start
+
+    def release(self, response, elapsed):
+        """Gives the slot back and learns from the response.
+
+        :param response: The response, None if the request raised
+        :type response: requests.Response or None
+        :param elapsed: Seconds the request took
+        :type elapsed: float
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if response is not None:
+                self._update_rate(response.headers)
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += RateLimiter.LATENCY_SMOOTHING * (elapsed - self.latency)
+            if response is not None and response.status_code == 429:
+                self.stats['throttled'] += 1
+                self._decrease("throttled (429)")
+            elif self.latency > self.slow_seconds:
+                self._decrease(f"average response time {self.latency:.1f}s")
+            else:
+                self._streak += 1
+                if self._streak >= self.success_streak and self.concurrency < self.max_concurrency:
+                    self.concurrency += 1
+                    self._streak = 0
+            self._condition.notify_all()
+
+    def _refill(self):
+        # caller holds the lock
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _decrease(self, reason):
+        # caller holds the lock
+        self._streak = 0
+        if self.concurrency > 1:
+            self.concurrency = max(1, self.concurrency // 2)
+            logging.info(f"Crossref {reason}; concurrency down to {self.concurrency}")
+            # let the average recover before the next cut
+            self.latency = self.slow_seconds / 2
+
+    def _update_rate(self, headers):
+        # caller holds the lock; e.g. X-Rate-Limit-Limit: 50, X-Rate-Limit-Interval: 1s
+        limit = headers.get('X-Rate-Limit-Limit')
+        interval = RateLimiter.parse_interval(headers.get('X-Rate-Limit-Interval'))
+        if limit is None or interval is None or not limit.isdigit() or int(limit) == 0:
+            return
+        rate = int(limit) / interval
+        if rate != self.rate:
+            logging.info(f"Crossref rate limit: {limit} requests per {interval:g}s")
+            self.rate = rate
+            self.capacity = float(limit)
+            self.tokens = min(self.tokens, self.capacity)
+
+    @staticmethod
+    def parse_interval(interval):
+        """
+        :param interval: e.g. '1s', '500ms', '1m'
+        :type interval: str or None
+        :return: Seconds, or None if it can't be parsed
+        :rtype: float or None
+        """
+        match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h)?\s*", interval or '')
+        if match is None or float(match.group(1)) == 0:
+            return None
+        return float(match.group(1)) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[match.group(2) or 's']
+
+    def get_stats(self):
+        with self._condition:
+            stats = dict(self.stats)
+            stats.update(concurrency=self.concurrency, rate=self.rate, latency=self.latency)
+        return stats
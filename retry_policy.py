@@ -0,0 +1,122 @@
+import os
+import random
+import threading
+import time
+
+
+class RetryPolicy(object):
+    """Decides whether a failed database call is retried and how long to wait.
+
+    Backoff is exponential with full jitter: attempt n sleeps a random time
+    between 0 and min(max_delay, base_delay * 2**n). Concurrent workers that
+    collided on a deadlock therefore spread out instead of waking together
+    and colliding again.
+
+    A retry budget stops retries from piling up when the database is down
+    or overloaded. Each retry spends one token. Each successful call earns
+    budget_ratio of a token, and the bucket also refills slowly over time,
+    up to budget_max tokens. With an empty bucket, errors are raised
+    immediately rather than retried.
+    """
+    DEADLOCK = 'deadlock'
+    CONNECTION = 'connection'
+
+    def __init__(self, max_attempts=5, base_delay_ms=10, max_delay_ms=5000,
+                 budget_ratio=0.1, budget_max=20, budget_refill_per_second=0.5):
+        """
+        :param max_attempts: Tries per call, including the first, defaults to 5
+        :type max_attempts: int, optional
+        :param base_delay_ms: Backoff ceiling for the first retry, defaults to 10
+        :type base_delay_ms: int, optional
+        :param max_delay_ms: Upper bound on any single backoff, defaults to 5000
+        :type max_delay_ms: int, optional
+        :param budget_ratio: Retry tokens earned per successful call, defaults to 0.1
+        :type budget_ratio: float, optional
+        :param budget_max: Most tokens that can be banked, and the starting balance, defaults to 20
+        :type budget_max: int, optional
+        :param budget_refill_per_second: Tokens earned per second regardless of traffic, defaults to 0.5
+        :type budget_refill_per_second: float, optional
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay_ms / 1000.0
+        self.max_delay = max_delay_ms / 1000.0
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+        self.budget_refill_per_second = budget_refill_per_second
+        self._lock = threading.Lock()
+        self._tokens = float(budget_max)
+        self._last_refill = time.monotonic()
+        self.stats = {'successes': 0,
+                      'retries': 0,
+                      'deadlock_retries': 0,
+                      'reconnects': 0,
+                      'budget_exhausted': 0,
+                      'gave_up': 0,
+                      'backoff_seconds': 0.0}
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.budget_max, self._tokens + elapsed * self.budget_refill_per_second)
+
+    def record_success(self):
+        """Counts a call that completed, earning back part of a retry token."""
+        with self._lock:
+            self.stats['successes'] += 1
+            self._tokens = min(self.budget_max, self._tokens + self.budget_ratio)
+
+    def allow_retry(self, kind, attempt):
+        """Whether a call that just failed should be tried again. Spends a
+        budget token when it says yes.
+
+        :param kind: RetryPolicy.DEADLOCK or RetryPolicy.CONNECTION
+        :type kind: str
+        :param attempt: Zero-based number of the attempt that failed
+        :type attempt: int
+        :return: True to retry
+        :rtype: bool
+        """
+        with self._lock:
+            if attempt + 1 >= self.max_attempts:
+                self.stats['gave_up'] += 1
+                return False
+            self._refill(time.monotonic())
+            if self._tokens < 1:
+                self.stats['budget_exhausted'] += 1
+                self.stats['gave_up'] += 1
+                return False
+            self._tokens -= 1
+            self.stats['retries'] += 1
+            if kind == RetryPolicy.DEADLOCK:
+                self.stats['deadlock_retries'] += 1
+            else:
+                self.stats['reconnects'] += 1
+            return True
+
+    def backoff(self, attempt):
+        """
+        :param attempt: Zero-based number of the attempt that failed
+        :type attempt: int
+        :return: Seconds to wait before the next attempt
+        :rtype: float
+        """
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = random.uniform(0, ceiling)
+        with self._lock:
+            self.stats['backoff_seconds'] += delay
+        return delay
+
+    def get_stats(self):
+        """
+        :return: Counters plus the current retry budget
+        :rtype: dict
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            stats = dict(self.stats)
+            stats['budget_tokens'] = round(self._tokens, 2)
+        return stats
@@ -2,6 +2,7 @@ import re
 import os
 from config import Config
 from db_connection import DBConnection
+from write_behind import WriteBehind
 from doi_entry import DoiFactory
 import logging
 from io import StringIO
@@ -40,16 +41,21 @@ class Scan:
         if doi_object is None and doi_string is None:
             raise NotImplementedError("Provide an object or a string")
         if doi_string is not None and doi_object is None:
-            select_doi = f"""select * from dois where doi = '{doi_string}'"""
-            doi_object = DoiFactory(select_doi).dois
+            select_doi = """select * from dois where doi = %s"""
+            doi_object = DoiFactory(select_doi, [doi_string], cache=True).dois
             if len(doi_object) != 1:
-                raise RecordNotFoundException(f"{select_doi}")
+                raise RecordNotFoundException(f"{select_doi} {doi_string}")
             else:
                 doi_object = doi_object[0]
 
         doi_string = doi_object.doi
-        sql = f"""select * from scans where doi = '{doi_string}'"""
-        scan_db_results = DBConnection.execute_query(sql)
+        pending = WriteBehind.peek('scan', doi_string)
+        if pending is not None:
+            # the last scan of this DOI hasn't been flushed to the database yet
+            scan_db_results = [pending[1]]
+        else:
+            sql = """select * from scans where doi = %s"""
+            scan_db_results = DBConnection.execute_query(sql, [doi_string])
         if len(scan_db_results) == 1:
             # logging.debug(f"{scan_db_results}")
             self.doi_string = scan_db_results[0][0]
@@ -66,10 +72,10 @@ class Scan:
 
     @classmethod
     def clear_db_entry(self, doi):
-        sql = f"delete from scans where doi='{doi}'"
-        DBConnection.execute_query(sql)
-        sql = f"delete from found_scan_lines where doi='{doi}'"
-        DBConnection.execute_query(sql)
+        sql = "delete from scans where doi = %s"
+        DBConnection.execute_query(sql, [doi])
+        sql = "delete from found_scan_lines where doi = %s"
+        DBConnection.execute_query(sql, [doi])
 
     def _write_to_db(self, write_scan_lines=False, clear_existing_records=False):
         """Stores information about a scan operation in the database. It inserts or replaces records in the 'scans'
@@ -81,23 +87,51 @@ class Scan:
         :param clear_existing_records: If True, clear existing records before writing, defaults to False
         :type clear_existing_records: bool, optional
         """
-        if clear_existing_records:
-            Scan.clear_db_entry(self.doi_string)
-        sql_insert = f"""replace into scans (doi, textfile_path,score,cannot_convert,title) VALUES (%s,%s,%s,%s,%s)"""
         args = [self.doi_string,
                 self.textfile_path,
                 self.score,
                 self.broken_converter,
                 self.doi_object.get_title()]
-        DBConnection.execute_query(sql_insert, args)
-        if write_scan_lines and len(self.found_lines) > 0:
-            for score_tuple in self.found_lines:
-                sql_insert = f"""insert into found_scan_lines (doi, line, score, matched_string) VALUES (%s,%s,%s,%s)"""
-                args = [self.doi_string,
-                        score_tuple[0],
-                        score_tuple[1],
-                        score_tuple[2]]
-                DBConnection.execute_query(sql_insert, args)
+        scan_lines = self.scan_line_rows() if write_scan_lines else []
+        # one commit for the delete, the scans row and all found lines; buffered
+        # when [write_behind] is enabled
+        WriteBehind.write('scan', self.doi_string, (clear_existing_records, args, scan_lines))
+
+    @staticmethod
+    def _write_scan_results(results):
+        """
+        :param results: (clear_existing_records, scans row, found_scan_lines rows) per DOI
+        :type results: list
+        """
+        for clear_existing_records, args, _ in results:
+            if clear_existing_records:
+                Scan.clear_db_entry(args[0])
+        # an insert (unlike replace) is sent as one multi-row statement by execute_many
+        sql_insert = f"""insert into scans (doi, textfile_path,score,cannot_convert,title) VALUES (%s,%s,%s,%s,%s)
+                         on duplicate key update textfile_path=VALUES(textfile_path), score=VALUES(score),
+                         cannot_convert=VALUES(cannot_convert), title=VALUES(title)"""
+        DBConnection.execute_many(sql_insert, [args for _, args, _ in results])
+        scan_lines = [row for _, _, rows in results for row in rows]
+        if len(scan_lines) > 0:
+            sql_insert = f"""insert into found_scan_lines (doi, line, score, matched_string) VALUES (%s,%s,%s,%s)"""
+            DBConnection.execute_many(sql_insert, scan_lines)
+
+    @staticmethod
+    def _combine_scan_results(pending, new):
+        # a clearing write supersedes whatever was pending; otherwise both sets of lines get written
+        if new[0]:
+            return new
+        return pending[0], new[1], pending[2] + new[2]
+
+    def scan_line_rows(self):
+        """
+        :return: found_scan_lines rows (doi, line, score, matched_string) for this scan
+        :rtype: list
+        """
+        return [[self.doi_string,
+                 score_tuple[0],
+                 score_tuple[1],
+                 score_tuple[2]] for score_tuple in self.found_lines]
 
     def _init_from_object(self, doi_object):
         """Initializes the object using information from a DOI object.
@@ -125,7 +159,10 @@ class Scan:
         return self.score < other.score
 
     def __str__(self):
-        str = f"{self.score}   {self.doi_string}:({self.doi_object.get_journal()})  {self.doi_object.details['title'][0]}"
+        details = self.doi_object.details
+        # DOIs ingested before crossref metadata was kept have no details
+        title = details['title'][0] if details is not None and details.get('title') else self.doi_object.get_title()
+        str = f"{self.score}   {self.doi_string}:({self.doi_object.get_journal()})  {title}"
         return str
 
     def extract_text_from_pdf(self, pdf_path):
@@ -372,11 +409,14 @@ class Scan:
         return string_set_pre_reference
 
 
-    def scan(self, clear_existing_records=False):
+    def scan(self, clear_existing_records=False, write_scan_lines=True):
         """Perform a scan on the text content, evaluating various conditions to determine a score.
 
         :param clear_existing_records: Clear existing records if True, defaults to False
         :type clear_existing_records: bool, optional
+        :param write_scan_lines: Write the found lines to found_scan_lines. Pass False to
+            bulk load them later from scan_line_rows(), defaults to True
+        :type write_scan_lines: bool, optional
         :return: True if scanning is successful and results are logged, False otherwise
         :rtype: bool
         """
@@ -406,7 +446,7 @@ class Scan:
 
         if self.score > 0:
             logging.info(f"{self.score}\t{self.title}")
-        self._write_to_db(write_scan_lines=True, clear_existing_records=clear_existing_records)
+        self._write_to_db(write_scan_lines=write_scan_lines, clear_existing_records=clear_existing_records)
 
         return True
 
@@ -527,5 +567,8 @@ class Scan:
         #     logging.debug(f"Score change. From {old_score} to {self.score}")
 
 
+WriteBehind.register('scan', Scan._write_scan_results, Scan._combine_scan_results)
+
+
 class RecordNotFoundException(Exception):
     pass
@@ -1,8 +1,12 @@
 from db_connection import DBConnection
+from schema_migrations import SchemaMigrations
+from bulk_loader import BulkLoader
+from write_behind import WriteBehind
 from scan import Scan
 from utils_mixin import Utils
 from doi_database import DoiFactory
 import logging
+import itertools
 import random
 from scan import RecordNotFoundException
 from concurrent.futures import ProcessPoolExecutor
@@ -30,9 +34,9 @@ class ScanDatabase(Utils):
 
     @classmethod
     def create_tables(self, reset_tables=False):
-        """Creates two database tables: "scans" and "found_scan_lines". 
-        It also includes an optional parameter reset_tables to determine 
-        whether existing tables should be dropped before creating new ones
+        """Creates three database tables: "scans", "found_scan_lines" and
+        "matched_specimen_ids". It also includes an optional parameter reset_tables
+        to determine whether the scan tables should be dropped before creating new ones
 
         :param reset_tables: determine whether existing tables should be 
         dropped before creating new ones, defaults to False
@@ -45,9 +49,10 @@ class ScanDatabase(Utils):
             except Exception:
                 pass
             try:
-
-                sql = "drop table found_scan_lines"
-                DBConnection.execute_query(sql)
+                # a partitioned found_scan_lines is emptied in place so it keeps its partitions
+                if not SchemaMigrations.truncate_table('found_scan_lines'):
+                    sql = "drop table found_scan_lines"
+                    DBConnection.execute_query(sql)
             except Exception:
                 pass
 
@@ -67,6 +72,24 @@ class ScanDatabase(Utils):
                                             matched_string varchar(1024)
                                         ); """
         DBConnection.execute_query(sql_create_database_table)
+        if reset_tables:
+            SchemaMigrations.ensure_table_indexes('found_scan_lines')
+
+        self._create_matched_specimen_ids_table()
+
+    @classmethod
+    def _create_matched_specimen_ids_table(self, reset_tables=False):
+        if reset_tables:
+            sql = "drop table matched_specimen_ids"
+            DBConnection.execute_query(sql)
+
+        sql_create_database_table = """ CREATE TABLE IF NOT EXISTS matched_specimen_ids (
+                                            doi varchar(255),
+                                            identifier varchar(1024)
+                                        ); """
+        DBConnection.execute_query(sql_create_database_table)
+        if reset_tables:
+            SchemaMigrations.ensure_table_indexes('matched_specimen_ids')
 
     def scan_single_doi(self, doi):
         scan = Scan(doi_string=doi)
@@ -84,15 +107,28 @@ class ScanDatabase(Utils):
             if scan.broken_converter is not True:
                 scan.scan()
 
-    def process_doi(self, doi_entry):
+    def process_doi(self, doi_entry, write_scan_lines=True):
+        """Scans one DOI; runs in a worker process.
+
+        :param write_scan_lines: Write found lines from the worker. If False they
+            are returned for the parent to bulk load, defaults to True
+        :type write_scan_lines: bool, optional
+        :return: The found_scan_lines rows not yet written
+        :rtype: list
+        """
         logging.debug(f"Scanning doi: {doi_entry.doi}")
         try:
             scan = Scan(doi_string=doi_entry.doi)
-            scan.scan(clear_existing_records=True)
+            scan.scan(clear_existing_records=True, write_scan_lines=write_scan_lines)
+            if not write_scan_lines:
+                # the parent loads these lines next; this DOI's clear must land first
+                WriteBehind.flush_pending()
+                return scan.scan_line_rows()
         except FileNotFoundError as e:
             logging.error(f"File not found: {e}")
         except Exception as e:
             logging.error(f"Error processing DOI {doi_entry.doi}: {e}")
+        return []
 
     def scan_pdfs(self, start_year, end_year, rescore=False, directory="./"):
         """Scans PDFs for DOIs within the specified year range. It retrieves DOIs that 
@@ -112,38 +148,46 @@ class ScanDatabase(Utils):
         """
 
         batch_size = 500
-        offset = 0
         total_dois_processed = 0
         num_workers = os.cpu_count()  # Number of CPUs for parallel processing
         max_workers = self.config.get_int('scan','max_pdf_conversion_threads')
         logging.info("Loading entries from database...")
         num_workers = min(num_workers,max_workers)
+        scan_line_loader = None
+        if self.config.get_boolean('bulk_load', 'enabled', fallback=False):
+            scan_line_loader = BulkLoader('found_scan_lines', batch_rows=self.config.get_int('bulk_load', 'batch_rows', fallback=50000))
+        # rescore or not, the same downloaded DOIs are selected. Read lazily in
+        # doi order, batch_size at a time; unlike LIMIT/OFFSET pages, later
+        # batches don't re-read the rows of the earlier ones
+        # selects on the downloaded flag, so buffered download status goes first
+        WriteBehind.flush_pending()
+        sql, args = self.doi_db.generate_select_sql(start_year, end_year, None, True)
+        doi_iterator = iter(DoiFactory(sql, args, chunk_size=batch_size))
         with ProcessPoolExecutor(max_workers=num_workers) as executor:
             while True:
-                if not rescore:
-                    sql = self.doi_db.generate_select_sql(start_year, end_year, None, True, batch_size, offset)
-                    dois = DoiFactory(sql).dois
-                else:
-                    dois = self.doi_db.get_dois(start_year=start_year, end_year=end_year, journal_issn=None,
-                                                downloaded=True, limit=batch_size, offset=offset)
-
+                dois = list(itertools.islice(doi_iterator, batch_size))
                 if not dois:
                     break  # No more DOIs to process
                 random.shuffle(dois)
 
                 # Submit DOIs to the executor for processing
-                future_to_doi = {executor.submit(self.process_doi, doi_entry): doi_entry for doi_entry in dois}
+                future_to_doi = {executor.submit(self.process_doi, doi_entry, scan_line_loader is None): doi_entry
+                                 for doi_entry in dois}
 
                 # Process future results as they complete
                 for future in as_completed(future_to_doi):
                     try:
-                        future.result()  # Wait for the result to make sure no exceptions are thrown
+                        scan_lines = future.result()  # Wait for the result to make sure no exceptions are thrown
+                        if scan_line_loader is not None:
+                            scan_line_loader.extend(scan_lines)
                     except Exception as exc:
                         doi_entry = future_to_doi[future]
                         logging.error(f"DOI {doi_entry.doi} generated an exception: {exc}")
+                if scan_line_loader is not None:
+                    # the workers have cleared these DOIs' old lines by now
+                    scan_line_loader.flush()
 
                 total_dois_processed += len(dois)
-                offset += batch_size
                 logging.info(f"Processed {total_dois_processed} DOIs so far")
 
 
@@ -158,15 +202,10 @@ class ScanDatabase(Utils):
         and recreates it, defaults to False.
         :type reset_tables: bool, optional
         """        
-        if reset_tables:
-            sql = "drop table matched_specimen_ids"
-            DBConnection.execute_query(sql)
-
-        sql_create_database_table = """ CREATE TABLE IF NOT EXISTS matched_specimen_ids (
-                                            doi varchar(255),
-                                            identifier varchar(1024)
-                                        ); """
-        DBConnection.execute_query(sql_create_database_table)
+        self._create_matched_specimen_ids_table(reset_tables)
+        specimen_id_loader = None
+        if self.config.get_boolean('bulk_load', 'enabled', fallback=False):
+            specimen_id_loader = BulkLoader('matched_specimen_ids', batch_rows=self.config.get_int('bulk_load', 'batch_rows', fallback=50000))
         select_dois = f"""select doi from matches where skip = 0"""
         matched_dois = DBConnection.execute_query(select_dois)
         for doi in matched_dois:
@@ -183,17 +222,23 @@ class ScanDatabase(Utils):
             results = scan.scan_specimen_ids()
             if results:
                 logging.info(f"Title: {scan.title}")
+                rows = []
                 for result in results:
-                    sql_insert = f"""insert into matched_specimen_ids (doi, identifier) VALUES (%s,%s)"""
                     result = result.strip()
                     if result.startswith("("):
                         result = result[1:]
-                    args = [doi,
-                            result]
-                    DBConnection.execute_query(sql_insert, args)
+                    rows.append([doi,
+                                 result])
                     # if '-' in result:
                     #     logging.debug(f"doi: {doi} title: {scan.title}")
                     #     logging.debug(f" Got bad: {result}")
+                if specimen_id_loader is not None:
+                    specimen_id_loader.extend(rows)
+                else:
+                    sql_insert = f"""insert into matched_specimen_ids (doi, identifier) VALUES (%s,%s)"""
+                    DBConnection.execute_many(sql_insert, rows)
+        if specimen_id_loader is not None:
+            specimen_id_loader.flush()
 
 
 
@@ -0,0 +1,205 @@
+import logging
+import datetime
+import mysql.connector
+import sqlite3
+from db_connection import DBConnection
+
+
+class SchemaMigrations(object):
+    """Versioned schema changes on top of the CREATE TABLE IF NOT EXISTS
+    statements in the various create_tables() methods.
+
+    Each migration runs once per database and is recorded in the
+    schema_version table. Migrations must be idempotent: several containers
+    may start at the same moment and race to apply the same version.
+
+    Secondary indexes are declared in INDEXES by table. Tables that get
+    dropped and recreated on a reset lose their indexes with them, so
+    create_tables() calls ensure_table_indexes() after recreating one.
+
+    A migration method may return False when it doesn't apply yet (e.g. an
+    opt-in feature that is switched off). It is then not recorded, and is
+    tried again on the next run.
+    """
+
+    # table -> [(index name, columns)]
+    INDEXES = {
+        'dois': [('idx_dois_issn_published_date', ('issn', 'published_date')),
+                 ('idx_dois_downloaded_published_date', ('downloaded', 'published_date'))],
+        'found_scan_lines': [('idx_found_scan_lines_doi', ('doi',))],
+        'matched_specimen_ids': [('idx_matched_specimen_ids_doi', ('doi',))],
+        'matches': [('idx_matches_skip', ('skip',))],
+    }
+
+    # (version, description, method name); append only, never renumber
+    MIGRATIONS = [
+        (1, "Secondary indexes for issn/date, download status, per-doi scan lines and matches.skip",
+         '_add_hot_query_indexes'),
+        (2, "Partition found_scan_lines by doi",
+         '_partition_tables'),
+    ]
+
+    FOUND_SCAN_LINES_PARTITIONS = 16
+
+    @staticmethod
+    def create_tables():
+        sql_create_database_table = """ CREATE TABLE IF NOT EXISTS schema_version (
+                                            version     integer        not null primary key,
+                                            description varchar(1024)  not null,
+                                            applied_at  datetime       not null
+                                        ); """
+        DBConnection.execute_query(sql_create_database_table)
+
+    @staticmethod
+    def applied_versions():
+        """
+        :return: Versions recorded in schema_version
+        :rtype: set
+        """
+        return {int(row[0]) for row in DBConnection.execute_query("select version from schema_version")}
+
+    @staticmethod
+    def current_version():
+        """
+        :return: The highest applied migration, 0 on a fresh database
+        :rtype: int
+        """
+        return max(SchemaMigrations.applied_versions(), default=0)
+
+    @staticmethod
+    def migrate():
+        """Applies every migration that hasn't been recorded yet, in order.
+
+        :return: The schema version after migrating
+        :rtype: int
+        """
+        SchemaMigrations.create_tables()
+        applied = SchemaMigrations.applied_versions()
+        for migration_version, description, migration in SchemaMigrations.MIGRATIONS:
+            if migration_version in applied:
+                continue
+            logging.info(f"Applying schema migration {migration_version}: {description}")
+            if getattr(SchemaMigrations, migration)() is False:
+                logging.info(f"Schema migration {migration_version} doesn't apply to this database yet, skipped")
+                continue
+            sql = "INSERT IGNORE INTO schema_version (version, description, applied_at) VALUES (%s,%s,%s)"
+            DBConnection.execute_query(sql, [migration_version, description, datetime.datetime.now()])
+            applied.add(migration_version)
+        return max(applied, default=0)
+
+    @staticmethod
+    def _add_hot_query_indexes():
+        for table in SchemaMigrations.INDEXES:
+            SchemaMigrations.ensure_table_indexes(table)
+
+    @staticmethod
+    def _partition_tables():
+        """Opt-in (database_partitioning in vm_passwords.yml), MySQL only.
+
+        found_scan_lines is hashed on doi, so each per-DOI lookup and delete
+        reads one partition and a reset can truncate them in place. dois is
+        not partitioned: MySQL would need published_date in its primary key,
+        which stops the key from keeping DOIs unique, and every lookup by doi
+        (download status, existence checks, metadata joins) would then have
+        to probe every year's partition to save the year-range reads, which
+        the (issn, published_date) and (downloaded, published_date) indexes
+        already serve.
+        """
+        backend = DBConnection.get_backend()
+        if backend.name != 'mysql' or not backend.db_config.get('database_partitioning', False):
+            return False
+        if not SchemaMigrations.is_partitioned('found_scan_lines'):
+            DBConnection.execute_query(f"ALTER TABLE found_scan_lines PARTITION BY KEY(doi) "
+                                       f"PARTITIONS {SchemaMigrations.FOUND_SCAN_LINES_PARTITIONS}")
+        return True
+
+    @staticmethod
+    def partition_names(table):
+        """
+        :return: The table's partitions in order, empty if it isn't partitioned
+        :rtype: list[str]
+        """
+        if DBConnection.get_backend().name != 'mysql':
+            return []
+        sql = """select partition_name from information_schema.partitions
+                 where table_schema = database() and table_name = %s and partition_name is not null
+                 order by partition_ordinal_position"""
+        return [row[0] for row in DBConnection.execute_query(sql, [table])]
+
+    @staticmethod
+    def is_partitioned(table):
+        return len(SchemaMigrations.partition_names(table)) > 0
+
+    @staticmethod
+    def truncate_table(table):
+        """Empties a table. A partitioned table keeps its partition layout,
+        which dropping and recreating it would lose.
+
+        :param table: Table name
+        :type table: str
+        :return: True if the table was partitioned and has been truncated; False
+            means the caller should drop and recreate it as usual
+        :rtype: bool
+        """
+        if not SchemaMigrations.is_partitioned(table):
+            return False
+        DBConnection.execute_query(f"ALTER TABLE {table} TRUNCATE PARTITION ALL")
+        return True
+
+    @staticmethod
+    def _table_exists(table):
+        if DBConnection.get_backend().name == 'sqlite':
+            sql = "select name from sqlite_master where type = 'table' and name = %s"
+        else:
+            sql = """select table_name from information_schema.tables
+                     where table_schema = database() and table_name = %s"""
+        return len(DBConnection.execute_query(sql, [table])) > 0
+
+    @staticmethod
+    def _index_exists(table, index_name):
+        if DBConnection.get_backend().name == 'sqlite':
+            sql = "select name from sqlite_master where type = 'index' and tbl_name = %s and name = %s"
+        else:
+            sql = """select index_name from information_schema.statistics
+                     where table_schema = database() and table_name = %s and index_name = %s"""
+        return len(DBConnection.execute_query(sql, [table, index_name])) > 0
+
+    @staticmethod
+    def ensure_index(table, index_name, columns):
+        """Creates an index unless it is already there. A table that doesn't
+        exist yet is skipped; its create_tables() adds the index later.
+
+        :param table: Table name
+        :type table: str
+        :param index_name: Index name, unique within the table
+        :type index_name: str
+        :param columns: Indexed columns, in order
+        :type columns: tuple
+        :return: True if the index was created
+        :rtype: bool
+        """
+        if not SchemaMigrations._table_exists(table):
+            return False
+        if SchemaMigrations._index_exists(table, index_name):
+            return False
+        column_list = ", ".join(f"`{column}`" for column in columns)
+        sql = f"CREATE INDEX {index_name} ON {table} ({column_list})"
+        try:
+            DBConnection.execute_query(sql)
+        except (mysql.connector.errors.ProgrammingError, sqlite3.OperationalError) as e:
+            # another process won the race (1061: duplicate key name)
+            if getattr(e, 'errno', None) != 1061 and 'already exists' not in str(e):
+                raise e
+            return False
+        logging.info(f"Created index {index_name} on {table}({column_list})")
+        return True
+
+    @staticmethod
+    def ensure_table_indexes(table):
+        """Creates any of the table's declared secondary indexes that are missing.
+
+        :param table: Table name, a key of INDEXES
+        :type table: str
+        """
+        for index_name, columns in SchemaMigrations.INDEXES.get(table, []):
+            SchemaMigrations.ensure_index(table, index_name, columns)
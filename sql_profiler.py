@@ -0,0 +1,193 @@
+import atexit
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import traceback
+from functools import lru_cache
+from multiprocessing import util
+
+
+class FingerprintStats(object):
+    """Running totals for one statement fingerprint. Latency percentiles
+    come from a fixed-size reservoir sample, so memory per fingerprint is
+    bounded no matter how often the statement runs.
+    """
+    __slots__ = ('count', 'total_seconds', 'max_seconds', 'rows', 'samples', 'reservoir_size')
+
+    def __init__(self, reservoir_size):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.samples = []
+        self.reservoir_size = reservoir_size
+
+    def add(self, seconds, rows):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.rows += rows or 0
+        if len(self.samples) < self.reservoir_size:
+            self.samples.append(seconds)
+        else:
+            slot = random.randrange(self.count)
+            if slot < self.reservoir_size:
+                self.samples[slot] = seconds
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class SqlProfiler(object):
+    """Per-statement SQL profiling cheap enough to leave on.
+
+    Every statement is reduced to a fingerprint (literals and placeholders
+    replaced with ?, IN lists and multi-row VALUES collapsed) and counted.
+    A stack trace is only captured for the sampled fraction of statements
+    and for anything slower than the slow-query threshold; those are
+    written to the log as JSON lines, one event per line. dump() appends
+    one summary line per fingerprint and runs automatically at exit, and
+    at the end of each forked multiprocessing worker for that worker's
+    statements.
+    """
+
+    _string_literal = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+    _number_literal = re.compile(r"\b\d+(?:\.\d+)?\b")
+    _placeholder = re.compile(r"%s|\?")
+    _in_list = re.compile(r"\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)")
+    _values_list = re.compile(r"\bvalues\s*(\([^()]*\))(?:\s*,\s*\([^()]*\))*")
+    _whitespace = re.compile(r"\s+")
+
+    def __init__(self, log_path='./sql.log', sample_rate=0.0, slow_query_ms=1000, reservoir_size=256):
+        """
+        :param log_path: JSON lines file for sampled/slow statements and summaries, defaults to './sql.log'
+        :type log_path: str, optional
+        :param sample_rate: Fraction of statements logged with a stack trace, defaults to 0.0
+        :type sample_rate: float, optional
+        :param slow_query_ms: Statements at least this slow are always logged, defaults to 1000
+        :type slow_query_ms: int, optional
+        :param reservoir_size: Latency samples kept per fingerprint for p50/p99, defaults to 256
+        :type reservoir_size: int, optional
+        """
+        self.log_path = log_path
+        self.sample_rate = sample_rate
+        self.slow_query_seconds = slow_query_ms / 1000.0
+        self.reservoir_size = reservoir_size
+        self.stats = {}
+        self._lock = threading.Lock()
+        # the process whose atexit dumps the summary
+        self._pid = os.getpid()
+        self._finalizer = None
+        atexit.register(self.dump)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # the child reports its own statements, not a copy of the parent's
+        self._lock = threading.Lock()
+        self.stats = {}
+        self._finalizer = None
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def fingerprint(query):
+        """Normalizes a statement so that executions differing only in their
+        literal values share one fingerprint.
+
+        :param query: The SQL statement
+        :type query: str
+        :return: The fingerprint
+        :rtype: str
+        """
+        fingerprint = SqlProfiler._string_literal.sub('?', query)
+        fingerprint = SqlProfiler._placeholder.sub('?', fingerprint)
+        fingerprint = SqlProfiler._number_literal.sub('?', fingerprint)
+        fingerprint = SqlProfiler._whitespace.sub(' ', fingerprint).strip().lower()
+        fingerprint = SqlProfiler._in_list.sub('in (?+)', fingerprint)
+        fingerprint = SqlProfiler._values_list.sub(r'values \1+', fingerprint)
+        return fingerprint
+
+    def record(self, query, args, seconds, rows):
+        """Counts one execution and logs it if sampled or slow.
+
+        :param query: The SQL statement as executed
+        :type query: str
+        :param args: Arguments it was executed with
+        :type args: list or None
+        :param seconds: Wall time spent executing and fetching
+        :type seconds: float
+        :param rows: Rows returned (SELECT) or affected (writes)
+        :type rows: int
+        """
+        fingerprint = SqlProfiler.fingerprint(query)
+        with self._lock:
+            stats = self.stats.get(fingerprint)
+            if stats is None:
+                stats = self.stats[fingerprint] = FingerprintStats(self.reservoir_size)
+            stats.add(seconds, rows)
+            if self._finalizer is None and os.getpid() != self._pid:
+                # multiprocessing workers leave through os._exit and skip atexit, and
+                # drop finalizers inherited from the parent, so register in this process
+                self._finalizer = util.Finalize(self, self.dump, exitpriority=10)
+
+        slow = seconds >= self.slow_query_seconds
+        if slow or (self.sample_rate > 0 and random.random() < self.sample_rate):
+            event = {'type': 'query',
+                     'time': time.time(),
+                     'pid': os.getpid(),
+                     'fingerprint': fingerprint,
+                     'query': query,
+                     'args': args,
+                     'elapsed_ms': round(seconds * 1000, 3),
+                     'rows': rows,
+                     'slow': slow,
+                     # drop this frame
+                     'stack': traceback.format_stack()[:-1]}
+            self._write([event])
+
+    def summary(self):
+        """
+        :return: One dict per fingerprint, most total time first
+        :rtype: list[dict]
+        """
+        with self._lock:
+            items = list(self.stats.items())
+        results = []
+        for fingerprint, stats in items:
+            results.append({'type': 'summary',
+                            'pid': os.getpid(),
+                            'fingerprint': fingerprint,
+                            'count': stats.count,
+                            'total_ms': round(stats.total_seconds * 1000, 3),
+                            'mean_ms': round(stats.total_seconds * 1000 / stats.count, 3),
+                            'p50_ms': round(stats.percentile(0.50) * 1000, 3),
+                            'p99_ms': round(stats.percentile(0.99) * 1000, 3),
+                            'max_ms': round(stats.max_seconds * 1000, 3),
+                            'rows': stats.rows})
+        return sorted(results, key=lambda x: x['total_ms'], reverse=True)
+
+    def dump(self):
+        """Appends the per-fingerprint summary to the log."""
+        summary = self.summary()
+        if summary:
+            self._write(summary)
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+    def _write(self, events):
+        lines = ''.join(json.dumps(event, default=str) + '\n' for event in events)
+        try:
+            with self._lock:
+                with open(self.log_path, 'a') as log_file:
+                    log_file.write(lines)
+        except OSError as e:
+            logging.warning(f"Unable to write SQL profile to {self.log_path}: {e}")
@@ -0,0 +1,90 @@
+import logging
+from collections import OrderedDict
+
+
+class StatementCache(object):
+    """A per-connection LRU of server-side prepared statements, keyed by the
+    statement text.
+
+    Each entry is a prepared cursor. Executing it again with new arguments
+    skips the server's parse step, so the hot per-DOI lookups are parsed
+    once per connection rather than once per call. When the cache is full
+    the least recently used cursor is closed, which deallocates its
+    statement on the server.
+
+    Only fixed-shape statements belong here. SQL whose placeholder count
+    follows its batch size is run unprepared (see
+    MySQLBackend.statement_cache and execute_query's prepare argument).
+
+    A cache belongs to exactly one connection and, like the connection, is
+    only used by one thread at a time.
+    """
+
+    def __init__(self, max_size=64):
+        """
+        :param max_size: Prepared statements kept open on the connection, defaults to 64.
+        :type max_size: int, optional
+        """
+        self.max_size = max_size
+        # query text -> (query, prepared cursor)
+        self._statements = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, connection, query):
+        """Returns the prepared cursor for a statement, creating it on a miss.
+
+        The driver only re-uses a prepared statement when it is executed with
+        the very same string object it was prepared from, so callers must
+        execute the returned cursor with the returned query, not their own copy.
+
+        :param connection: The connection this cache belongs to
+        :type connection: connection
+        :param query: The statement, with %s placeholders
+        :type query: str
+        :return: (query, cursor)
+        :rtype: tuple
+        """
+        entry = self._statements.get(query)
+        if entry is not None:
+            self._statements.move_to_end(query)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        entry = (query, connection.cursor(prepared=True))
+        self._statements[query] = entry
+        if len(self._statements) > self.max_size:
+            evicted_query, (_, evicted_cursor) = self._statements.popitem(last=False)
+            self.evictions += 1
+            self._close(evicted_cursor)
+        return entry
+
+    def discard(self, query):
+        """Drops a statement, e.g. after it failed and its cursor state is unknown.
+
+        :param query: The statement text
+        :type query: str
+        """
+        entry = self._statements.pop(query, None)
+        if entry is not None:
+            self._close(entry[1])
+
+    @staticmethod
+    def _close(cursor):
+        try:
+            cursor.close()
+        except Exception as e:
+            logging.debug(f"Unable to close prepared statement: {e}")
+
+    def get_stats(self):
+        """
+        :return: Hit, miss and eviction counters plus the current size.
+        :rtype: dict
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._statements),
+                'max_size': self.max_size}
@@ -0,0 +1,48 @@
+import os
+import shutil
+import sys
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the modules live at the top of the repository, not in a package
+sys.path.insert(0, REPO)
+
+from db_connection import DBConnection
+
+
+def _reset_connection():
+    if DBConnection.pool is not None:
+        DBConnection.pool.close_idle()
+    DBConnection.pool = None
+    DBConnection.replica_pool = None
+    DBConnection.backend = None
+    DBConnection.query_cache = None
+    DBConnection.profiler = None
+
+
+@pytest.fixture(scope='module')
+def scratch_database(tmp_path_factory):
+    """Runs the module's tests from a directory holding its own config.ini
+    (from config.template.ini) and a vm/vm_passwords.yml that points at a
+    scratch SQLite database, or, when the TEST_VM_PASSWORDS environment
+    variable names one, a copy of that vm_passwords.yml (e.g. for a scratch
+    MySQL schema; the tests write to it).
+
+    :return: The directory
+    """
+    workdir = tmp_path_factory.mktemp('scratch_database')
+    shutil.copy(os.path.join(REPO, 'config.template.ini'), workdir / 'config.ini')
+    (workdir / 'vm').mkdir()
+    if os.environ.get('TEST_VM_PASSWORDS'):
+        shutil.copy(os.environ['TEST_VM_PASSWORDS'], workdir / 'vm' / 'vm_passwords.yml')
+    else:
+        (workdir / 'vm' / 'vm_passwords.yml').write_text(f"database_backend: sqlite\n"
+                                                         f"sqlite_path: {workdir / 'test.db'}\n")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    _reset_connection()
+    try:
+        yield workdir
+    finally:
+        _reset_connection()
+        os.chdir(cwd)
@@ -0,0 +1,49 @@
+import pytest
+from bulk_loader import BulkLoader
+from db_connection import DBConnection
+# scan_database can only be imported by way of doi_database
+from doi_database import DoiDatabase
+from scan_database import ScanDatabase
+
+
+@pytest.fixture(scope='module')
+def scan_tables(scratch_database):
+    ScanDatabase.create_tables()
+
+
+@pytest.mark.parametrize('table', sorted(BulkLoader.TARGETS))
+def test_stage_table_doesnt_copy_the_target_definition(table):
+    # CREATE ... LIKE copies a partitioned target's partitioning, and MySQL
+    # refuses partitioned temporary tables (error 1562)
+    sql = BulkLoader(table).create_stage_sql(f"bulk_stage_{table}")
+    assert ' LIKE ' not in sql.upper()
+    assert 'PARTITION' not in sql.upper()
+    assert sql.endswith(f"SELECT {','.join(BulkLoader.TARGETS[table])} FROM {table} LIMIT 0")
+
+
+def test_stage_table_holds_the_loaded_columns(scan_tables):
+    loader = BulkLoader('found_scan_lines')
+    stage = 'bulk_stage_test'
+    row = ['10.1/stage', 'a line', 7, 'CAS']
+
+    def load_stage():
+        # one transaction, so one connection: temporary tables are per connection
+        DBConnection.execute_query(loader.create_stage_sql(stage))
+        try:
+            DBConnection.execute_query(f"INSERT INTO {stage} ({','.join(loader.columns)}) VALUES (%s,%s,%s,%s)",
+                                       row)
+            return DBConnection.execute_query(f"SELECT * FROM {stage}")
+        finally:
+            DBConnection.execute_query(f"DROP TABLE {stage}")
+
+    assert DBConnection.run_in_transaction(load_stage) == [tuple(row)]
+
+
+def test_flush_merges_rows(scan_tables):
+    DBConnection.execute_query("delete from found_scan_lines where doi = %s", ['10.1/flush'])
+    loader = BulkLoader('found_scan_lines', batch_rows=2)
+    loader.extend([['10.1/flush', f"line {index}", index, 'CAS'] for index in range(3)])
+    loader.flush()
+    assert loader.total_rows == 3
+    sql = "select count(*) from found_scan_lines where doi = %s"
+    assert DBConnection.execute_query(sql, ['10.1/flush'])[0][0] == 3
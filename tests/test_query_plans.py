@@ -0,0 +1,52 @@
+import pytest
+from db_connection import DBConnection
+from query_plan_check import QueryPlanChecker, SyntheticDataset
+
+# enough for every journal to have DOIs in every year
+DOI_COUNT = 5000
+
+
+@pytest.fixture(scope='module')
+def checker(scratch_database):
+    """A QueryPlanChecker over a synthetic dataset in the scratch database."""
+    dataset = SyntheticDataset(DOI_COUNT)
+    checker = QueryPlanChecker(dataset)
+    if dataset.has_foreign_rows():
+        pytest.skip("dois holds rows that aren't synthetic; TEST_VM_PASSWORDS must name a scratch database")
+    dataset.load()
+    return checker
+
+
+@pytest.fixture(scope='module')
+def plans(checker):
+    """(check, statement, unexpected full scans, estimated rows examined, plan lines) per statement"""
+    results = []
+    for check in checker.checks():
+        check_plans = checker.plans(check)
+        assert check_plans, f"{check.name} executed no explainable statements"
+        results.extend((check, *plan) for plan in check_plans)
+    return results
+
+
+def _report(check, statement, problems, details):
+    return f"{check.name}: {'; '.join(problems)}\n  {statement}\n  " + "\n  ".join(details)
+
+
+def test_dataset_loaded(checker):
+    assert checker.dataset.loaded_count() >= DOI_COUNT
+
+
+def test_no_unexpected_full_scans(plans):
+    failures = [_report(check, statement, check.problems(unexpected, None), details)
+                for check, statement, unexpected, examined, details in plans if unexpected]
+    assert not failures, "\n".join(failures)
+
+
+def test_rows_examined_within_budget(plans):
+    if DBConnection.get_backend().name == 'sqlite':
+        pytest.skip("SQLite's EXPLAIN QUERY PLAN gives no row estimates, so the row budgets can't be checked; "
+                    "set TEST_VM_PASSWORDS to the vm_passwords.yml of a scratch MySQL schema to run them")
+    failures = [_report(check, statement, check.problems(set(), examined), details)
+                for check, statement, unexpected, examined, details in plans
+                if check.problems(set(), examined)]
+    assert not failures, "\n".join(failures)
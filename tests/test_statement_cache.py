@@ -0,0 +1,32 @@
+from db_connection import MySQLBackend
+from statement_cache import StatementCache
+
+
+class _Connection(object):
+    # stands in for a mysql connection; only used as the cache's key
+    pass
+
+
+def _backend(**db_config):
+    backend = MySQLBackend(db_config)
+    connection = _Connection()
+    backend._statement_caches[connection] = StatementCache(backend.statement_cache_size)
+    return backend, connection
+
+
+def test_fixed_shape_statement_is_prepared():
+    backend, connection = _backend()
+    assert backend.statement_cache(connection, "select doi from dois where doi = %s", ['10.1/a']) is not None
+
+
+def test_unparameterized_statement_is_not_prepared():
+    backend, connection = _backend()
+    assert backend.statement_cache(connection, "select count(*) from dois", None) is None
+
+
+def test_batch_above_placeholder_limit_is_not_prepared():
+    backend, connection = _backend(database_prepared_statement_max_params=4)
+    dois = [f'10.1/{i}' for i in range(5)]
+    query = f"select doi from dois where doi in ({','.join(['%s'] * len(dois))})"
+    assert backend.statement_cache(connection, query, dois) is None
+    assert backend.statement_cache(connection, query, dois[:4]) is not None
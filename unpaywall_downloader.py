@@ -6,6 +6,7 @@ from requests import exceptions
 import requests
 from datetime import datetime
 from db_connection import DBConnection
+from write_behind import WriteBehind
 from utils_mixin import Utils
 import time
 import logging
@@ -68,12 +69,20 @@ class UnpaywallDownloader(Downloader, Utils):
         :param doi: The DOI for which the download information is to be updated in the database.
         :type doi: str
         """
-
-        # sql = "INSERT OR REPLACE INTO unpaywall_downloader(doi, open_url, most_recent_attempt, most_recent_firefox_failure,error_code,not_available) VALUES(%s,%s,%s,%s,%s,%s)"
-        sql = "REPLACE INTO unpaywall_downloader(doi, open_url, most_recent_attempt, most_recent_firefox_failure, error_code, not_available) VALUES(%s, %s, %s, %s, %s, %s)"
         args = [doi, self.open_url, datetime.now(), self.most_recent_firefox_failure, self.error_code,
                 self.not_available]
-        DBConnection.execute_query(sql, args)
+        # written from the write-behind buffer when [write_behind] is enabled
+        WriteBehind.write('unpaywall', doi, args)
+
+    @staticmethod
+    def _write_unpaywall_rows(rows):
+        # sql = "INSERT OR REPLACE INTO unpaywall_downloader(doi, open_url, most_recent_attempt, most_recent_firefox_failure,error_code,not_available) VALUES(%s,%s,%s,%s,%s,%s)"
+        # an INSERT (unlike REPLACE) is sent as one multi-row statement by execute_many
+        sql = """INSERT INTO unpaywall_downloader(doi, open_url, most_recent_attempt, most_recent_firefox_failure, error_code, not_available) VALUES(%s, %s, %s, %s, %s, %s)
+                 ON DUPLICATE KEY UPDATE open_url=VALUES(open_url), most_recent_attempt=VALUES(most_recent_attempt),
+                 most_recent_firefox_failure=VALUES(most_recent_firefox_failure), error_code=VALUES(error_code),
+                 not_available=VALUES(not_available)"""
+        DBConnection.execute_many(sql, rows)
 
     def download(self, doi_entry):
         """Attempts to download a DOI entry from Unpaywall. The method first retrieves the
@@ -96,8 +105,13 @@ class UnpaywallDownloader(Downloader, Utils):
         populate_not_available_only = self.config.get_boolean('unpaywall_downloader', 'populate_not_available_only')
 
         # logging.debug(f"Download unpaywall:{doi_entry}")
-        sql = f"select most_recent_attempt, open_url, most_recent_firefox_failure,error_code,not_available from unpaywall_downloader where doi='{doi_entry.doi}'"
-        results = DBConnection.execute_query(sql)
+        pending = WriteBehind.peek('unpaywall', doi_entry.doi)
+        if pending is not None:
+            # the last attempt hasn't reached the database yet
+            results = [[pending[2], pending[1], pending[3], pending[4], pending[5]]]
+        else:
+            sql = "select most_recent_attempt, open_url, most_recent_firefox_failure,error_code,not_available from unpaywall_downloader where doi = %s"
+            results = DBConnection.execute_query(sql, [doi_entry.doi], cache=True)
         if len(results) == 0:
             self.most_recent_attempt = None
         else:
@@ -158,7 +172,7 @@ class UnpaywallDownloader(Downloader, Utils):
     # from HTML
     def _download_link(self, doi_entry):
         """Attempts to download the DOI entry using a direct link if available
-          in the DOI entry details (dois table, details column). The method 
+          in the DOI entry details (crossref_metadata table). The method 
           first checks if the DOI entry has a 'link' field in its details. If 
           the field exists, it retrieves the direct link to the PDF file and 
           attempts to download the PDF. If the download is successful, it 
@@ -169,8 +183,9 @@ class UnpaywallDownloader(Downloader, Utils):
             :return: True if the download is successful, False otherwise.
             :rtype: bool
         """
-        if 'link' in doi_entry.details:
-            direct_link = doi_entry.details['link'][0]['URL']
+        details = doi_entry.details
+        if details is not None and details.get('link'):
+            direct_link = details['link'][0]['URL']
         else:
             return False
         logging.info(f"Direct link cited; attempting link: {direct_link}")
@@ -299,3 +314,6 @@ class UnpaywallDownloader(Downloader, Utils):
             logging.error(f"Firefox download failed: {e}")
             self.most_recent_firefox_failure = datetime.now()
             return False
+
+
+WriteBehind.register('unpaywall', UnpaywallDownloader._write_unpaywall_rows)
@@ -8,12 +8,13 @@ import logging
 from config import Config
 
 class Utils:
-    def __init__(self):
-        self.config = Config()
+    def __init__(self, config=None):
+        # pass a shared Config to avoid re-reading config.ini
+        self.config = config if config is not None else Config()
 
         self.response_time = 0
 
-    def _get_url_(self, url, headers=None, decode_json=True):
+    def _get_url_(self, url, headers=None, decode_json=True, rate_limiter=None):
         """Perform an HTTP GET request to "https://api.crossref.org/works/{doi_string}"
             and return JSON response, decoded
 
@@ -27,6 +28,10 @@ class Utils:
             response as JSON, defaults to True.
         :type decode_json: bool, optional
 
+        :param rate_limiter: Shared limiter to send the request through; it
+            replaces the fixed back-off below, defaults to None
+        :type rate_limiter: RateLimiter, optional
+
         :raises ConnectionError: If request to url fails. Provides the url.
         :raises ConnectionError: If there is an error decoding the JSON response.
             Provides the string representation of the caught exceptions.
@@ -34,7 +39,10 @@ class Utils:
         :return: The response from the URL, either as a decoded JSON object (if `decode_json` is True) or as a raw response.
         :rtype: dict or requests.Response
         """        
-        if self.response_time > 20:
+        if rate_limiter is not None:
+            # pacing is the rate limiter's job
+            pass
+        elif self.response_time > 20:
             logging.info(f"Long wait time ({self.response_time} seconds), backing off 60 seconds on request {url}")
             time.sleep(60)
         elif self.response_time > 10:
@@ -46,10 +54,11 @@ class Utils:
 
         start = time.time()
 
+        get = requests.get if rate_limiter is None else rate_limiter.get
         if headers is None:
-            response = requests.get(url, allow_redirects=True)
+            response = get(url, allow_redirects=True)
         else:
-            response = requests.get(url, allow_redirects=True, headers=headers)
+            response = get(url, allow_redirects=True, headers=headers)
         self.response_time = time.time() - start
         logging.info(f"Request took {self.response_time}")
         if response.status_code != 200:
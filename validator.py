@@ -1,4 +1,5 @@
 from db_connection import DBConnection
+from schema_migrations import SchemaMigrations
 from utils_mixin import Utils
 import subprocess
 import os
@@ -9,10 +10,17 @@ import logging
 from html import unescape
 from bs4 import BeautifulSoup
 
-ncbi = NCBITaxa()
+# created on first use: NCBITaxa() downloads the taxonomy database when it
+# isn't installed yet, which shouldn't happen just by importing this module
+ncbi = None
 
 
-# ncbi.update_taxonomy_database()
+def get_ncbi():
+    global ncbi
+    if ncbi is None:
+        ncbi = NCBITaxa()
+        # ncbi.update_taxonomy_database()
+    return ncbi
 
 
 # f"{Fore.MAGENTA + self.chromosome.id + Fore.WHITE}:" \
@@ -48,8 +56,8 @@ class Match(Utils):
         """        
 
         flag_notes = ['inaturalist', 'antweb', 'antcat', 'catalog of fishes']
-        sql = f"select line,score from found_scan_lines where doi = '{self.doi}'"
-        lines = DBConnection.execute_query(sql)
+        sql = "select line,score from found_scan_lines where doi = %s"
+        lines = DBConnection.execute_query(sql, [self.doi])
         matches = {}
         for line in lines:
             matched_line = line[0]
@@ -96,8 +104,8 @@ class Match(Utils):
 
         :return: None
         """        
-        sql = f"select line,score,matched_string from found_scan_lines where doi = '{self.doi}'"
-        lines = DBConnection.execute_query(sql)
+        sql = "select line,score,matched_string from found_scan_lines where doi = %s"
+        lines = DBConnection.execute_query(sql, [self.doi])
         for line in lines:
             matched_line = line[0]
             color = Fore.BLUE
@@ -194,6 +202,8 @@ class Validator(Utils):
 
 
         DBConnection.execute_query(sql_create_database_table)
+        if reset_matches_database:
+            SchemaMigrations.ensure_table_indexes('matches')
 
     def copy_matches(self, target_dir):
         sql = """select dois.doi, dois.full_path, dois.published_date from dois,matches,scans
@@ -224,18 +234,12 @@ class Validator(Utils):
         :type end_year: int
         """        
 
-        sql = f"""select dois.doi, dois.full_path, dois.published_date, dois.article_title , scans.score from scans,dois
-                                    left join matches m on dois.doi = m.doi
-                                    where
-                                    scans.doi = dois.doi and
-                                    dois.{self.sql_year_restriction(start_year, end_year)} and
-                                    scans.score is not null and
-                                    m.doi is NULL and
-                                    score > 0
-                                    order by score desc """
-        
-        candidates = DBConnection.execute_query(sql)
-        for candidate in candidates:
+        sql = self.audit_sql(start_year, end_year)
+
+        # streamed: only the Match objects are kept, not the raw result set.
+        # Prompting starts after the stream is drained so the cursor isn't
+        # held open while waiting on the user.
+        for candidate in DBConnection.iter_query(sql):
             doi = candidate[0]
             full_path = candidate[1]
             published_date = candidate[2]
@@ -251,6 +255,21 @@ class Validator(Utils):
             match.generate_notes()
             self.prompt(match)
 
+    def audit_sql(self, start_year, end_year):
+        """
+        :return: The query audit() reads its candidates from
+        :rtype: str
+        """
+        return f"""select dois.doi, dois.full_path, dois.published_date, dois.article_title , scans.score from scans,dois
+                                    left join matches m on dois.doi = m.doi
+                                    where
+                                    scans.doi = dois.doi and
+                                    dois.{self.sql_year_restriction(start_year, end_year)} and
+                                    scans.score is not null and
+                                    m.doi is NULL and
+                                    score > 0
+                                    order by score desc """
+
     def audit_digital_only(self, start_year, end_year):
         sql = f"""select dois.doi, matches.collection, dois.full_path, dois.published_date, scans.title, scans.score, matches.notes
                     from scans,
@@ -293,7 +312,7 @@ class Validator(Utils):
         :return: A list of taxonomic names representing the lineage of the given word.
         :rtype: list[str]
         """        
-        name2taxid = ncbi.get_name_translator([word])
+        name2taxid = get_ncbi().get_name_translator([word])
         if len(name2taxid) == 0:
             return None
         if verbose:
@@ -302,8 +321,8 @@ class Validator(Utils):
         name = list(name2taxid.keys())[0]
         taxid = name2taxid[name][0]
         # logging.debug(f"   taxid: {taxid}")
-        lineage = ncbi.get_lineage(taxid)
-        names_dict = ncbi.get_taxid_translator(lineage)
+        lineage = get_ncbi().get_lineage(taxid)
+        names_dict = get_ncbi().get_taxid_translator(lineage)
         lineage_names = [names_dict[taxid] for taxid in lineage]
 
         names = [item.lower() for item in lineage_names]
@@ -44,10 +44,34 @@ if [ -s running-vms.txt ]; then
 
                     # Analyze the log file for the specified SQL query pattern
                     echo "Analyzing log file for container $containerName..."
-                    grep -A 20 "UPDATE dois SET" "sql_$containerName.log" | 
-                    grep -B 20 "File \"/app/main.py\", line 258, in <module>" | 
-#                    awk '/WHERE doi/{doi=$4} /downloaded =/{downloaded=$3; print "DOI: " doi ", Downloaded: " downloaded}'
-                    awk -F "'" '/WHERE doi/{doi=$(NF-1)} /downloaded =/{downloaded=$(NF-1); if (downloaded != "True") print "DOI: " doi ", Downloaded: " downloaded}'
+                    # sql.log is JSON lines written by sql_profiler.py: sampled/slow
+                    # "query" events with a stack, plus per-fingerprint "summary" lines
+                    python3 - "sql_$containerName.log" <<'PYEOF'
+import json, sys
+for line in open(sys.argv[1]):
+    try:
+        event = json.loads(line)
+    except ValueError:
+        continue
+    if event.get('type') == 'summary':
+        print(f"{event['count']:>8} {event['total_ms']:>12.1f}ms p50 {event['p50_ms']:.1f}ms p99 {event['p99_ms']:.1f}ms  {event['fingerprint'][:100]}")
+    elif event.get('type') == 'query' and event['fingerprint'].startswith('update dois set'):
+        args = event.get('args') or []
+        if not any('/app/main.py' in frame for frame in event.get('stack', [])):
+            continue
+        if 'case doi' in event['fingerprint']:
+            # DoiEntry bulk status update: (doi, downloaded) pairs, (doi, full_path) pairs, then the IN list
+            count = len(args) // 5
+            statuses = [(args[i], args[i + 1]) for i in range(0, 2 * count, 2)]
+        elif len(args) > 6:
+            # DoiEntry.update_database: issn, published_date, journal_title, downloaded, full_path, article_title, doi
+            statuses = [(args[6], args[3])]
+        else:
+            statuses = []
+        for doi, downloaded in statuses:
+            if str(downloaded) not in ('True', '1'):
+                print(f"doi = {doi}, Downloaded: {downloaded}")
+PYEOF
   # Clear the log file in the container
                     $sshCommand "sudo docker exec $containerName bash -c '> /app/sql.log'" < /dev/null
 
@@ -0,0 +1,284 @@
+import atexit
+import logging
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import util
+from config import Config
+from db_connection import DBConnection
+
+
+class WriteBehind(object):
+    """Buffers status and audit writes (unpaywall attempts, download status,
+    scan results) and persists them from a background thread, so the
+    download and scan loops don't wait on the database after every DOI.
+
+    Writes are keyed, e.g. by DOI. A second write for a key that is still
+    pending replaces the first, or is merged with it by the kind's combine
+    function. The buffer is flushed once flush_rows keys are pending or
+    flush_seconds have passed, one transaction per kind, and synchronously
+    at exit, at the end of a multiprocessing worker and on SIGTERM.
+
+    A full buffer blocks the writer until the next flush, which keeps memory
+    bounded when the database falls behind. A failed flush is logged and its
+    writes are put back (behind any newer write for the same key) to be
+    retried on the next one.
+
+    Pending writes aren't in the database yet: readers of single rows check
+    peek() first, and queries that filter on a buffered column call flush()
+    before they run. Enable with [write_behind] enabled in config.ini; when
+    it is off (the default), write() runs the handler immediately.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+    # kind -> (handler, combine)
+    _handlers = {}
+
+    def __init__(self, max_pending=10000, flush_rows=500, flush_seconds=2.0):
+        """
+        :param max_pending: Pending keys before write() blocks, defaults to 10000
+        :type max_pending: int, optional
+        :param flush_rows: Pending keys that trigger a flush, defaults to 500
+        :type flush_rows: int, optional
+        :param flush_seconds: Longest a write waits before it is flushed, defaults to 2.0
+        :type flush_seconds: float, optional
+        """
+        self.max_pending = max_pending
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.stats = {'writes': 0,
+                      'coalesced': 0,
+                      'flushes': 0,
+                      'rows_flushed': 0,
+                      'errors': 0,
+                      'blocked': 0}
+        self._reset()
+        atexit.register(self.close)
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # a forked child must not flush (and so repeat) the parent's pending writes
+        # (kind, key) -> payload, oldest first
+        self._pending = OrderedDict()
+        # the batch being written by flush(); still visible to peek()
+        self._flushing = OrderedDict()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    @classmethod
+    def register(cls, kind, handler, combine=None):
+        """
+        :param kind: Name for one sort of write, e.g. 'unpaywall'
+        :type kind: str
+        :param handler: Called with a list of payloads; writes them all. It
+            runs inside a transaction.
+        :type handler: callable
+        :param combine: Called with (pending payload, new payload) for the same
+            key, returns the payload to keep; defaults to keeping the new one
+        :type combine: callable, optional
+        """
+        cls._handlers[kind] = (handler, combine)
+
+    @classmethod
+    def get_instance(cls):
+        """
+        :return: The process-wide buffer, or None when write-behind is disabled
+        :rtype: WriteBehind or None
+        """
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    config = Config()
+                    if not config.get_boolean('write_behind', 'enabled', fallback=False):
+                        cls._instance = False
+                    else:
+                        cls._instance = WriteBehind(
+                            max_pending=config.get_int('write_behind', 'max_pending', fallback=10000),
+                            flush_rows=config.get_int('write_behind', 'flush_rows', fallback=500),
+                            flush_seconds=float(config.get_string('write_behind', 'flush_seconds', fallback='2.0')))
+                        cls._instance.install_signal_handler()
+        return cls._instance or None
+
+    @classmethod
+    def write(cls, kind, key, payload):
+        """Queues a write, or performs it right away when write-behind is disabled.
+
+        :param kind: A registered kind
+        :type kind: str
+        :param key: Identifies what is written, e.g. the DOI
+        :type key: str
+        :param payload: Passed to the kind's handler
+        """
+        instance = cls.get_instance()
+        if instance is None:
+            handler, _ = cls._handlers[kind]
+            DBConnection.run_in_transaction(handler, [payload])
+        else:
+            instance.submit(kind, key, payload)
+
+    @classmethod
+    def peek(cls, kind, key):
+        """
+        :return: The payload still waiting to be written for this key, or None
+        """
+        instance = cls.get_instance()
+        if instance is None:
+            return None
+        with instance._lock:
+            payload = instance._pending.get((kind, key))
+            if payload is None:
+                payload = instance._flushing.get((kind, key))
+            return payload
+
+    @classmethod
+    def flush_pending(cls):
+        """Flushes the process-wide buffer, if there is one."""
+        instance = cls.get_instance()
+        if instance is not None:
+            instance.flush()
+
+    def submit(self, kind, key, payload):
+        if kind not in WriteBehind._handlers:
+            raise ValueError(f"No write-behind handler registered for '{kind}'")
+        with self._lock:
+            if self._closed:
+                raise WriteBehindClosedException(f"{kind} write for {key} after shutdown")
+            self._start()
+            while (kind, key) not in self._pending and len(self._pending) >= self.max_pending:
+                self.stats['blocked'] += 1
+                self._changed.notify_all()
+                self._changed.wait()
+            self._add(kind, key, payload)
+            self.stats['writes'] += 1
+            if len(self._pending) >= self.flush_rows:
+                self._changed.notify_all()
+
+    def _add(self, kind, key, payload):
+        # caller holds the lock
+        pending = self._pending.get((kind, key))
+        if pending is not None:
+            combine = WriteBehind._handlers[kind][1]
+            if combine is not None:
+                payload = combine(pending, payload)
+            self.stats['coalesced'] += 1
+        self._pending[(kind, key)] = payload
+
+    def _start(self):
+        # caller holds the lock; started lazily so a forked child gets its own thread
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+            # multiprocessing workers leave through os._exit and skip atexit, and
+            # drop finalizers inherited from the parent, so register in this process
+            util.Finalize(self, self.close, exitpriority=10)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                deadline = time.monotonic() + self.flush_seconds
+                while not self._closed and len(self._pending) < self.flush_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Write-behind flush failed; will retry")
+                time.sleep(self.flush_seconds)
+
+    def flush(self):
+        """Writes everything pending now, one transaction per kind.
+
+        :return: Number of keys written
+        :rtype: int
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = OrderedDict()
+                self._flushing = batch
+                self._changed.notify_all()
+            if not batch:
+                return 0
+            by_kind = OrderedDict()
+            for (kind, key), payload in batch.items():
+                by_kind.setdefault(kind, []).append((key, payload))
+            written = 0
+            try:
+                for kind, entries in by_kind.items():
+                    handler = WriteBehind._handlers[kind][0]
+                    DBConnection.run_in_transaction(handler, [payload for _, payload in entries])
+                    written += len(entries)
+                    for key, _ in entries:
+                        del batch[(kind, key)]
+            except Exception:
+                with self._lock:
+                    self.stats['errors'] += 1
+                    self._requeue(batch)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = OrderedDict()
+                    self.stats['flushes'] += 1
+                    self.stats['rows_flushed'] += written
+            return written
+
+    def _requeue(self, batch):
+        # caller holds the lock; newer writes made during the flush stay newer
+        newer = self._pending
+        self._pending = OrderedDict()
+        for (kind, key), payload in batch.items():
+            self._pending[(kind, key)] = payload
+        for (kind, key), payload in newer.items():
+            self._add(kind, key, payload)
+
+    def close(self):
+        """Stops the background thread and flushes what is left."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._changed.notify_all()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        if self._pending:
+            logging.info(f"Flushing {len(self._pending)} pending writes")
+            self.flush()
+
+    def install_signal_handler(self):
+        """Turns SIGTERM (docker stop) into a normal exit so the atexit flush
+        runs. Only from the main thread, and only if nothing else handles it.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        if signal.getsignal(signal.SIGTERM) is not signal.SIG_DFL:
+            return
+
+        def _handle_sigterm(signum, frame):
+            raise SystemExit(128 + signum)
+
+        signal.signal(signal.SIGTERM, _handle_sigterm)
+
+    def get_stats(self):
+        """
+        :return: Counters plus the number of keys pending
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['pending'] = len(self._pending)
+        return stats
+
+
+class WriteBehindClosedException(Exception):
+    pass